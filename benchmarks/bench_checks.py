@@ -0,0 +1,300 @@
+"""Run the three checks end to end against a synthetic /proc and stub tools, and compare with a stored baseline.
+
+The fixture is built once: `--pids` processes with `--fds` fds each (every `--deleted-every`th one on a
+deleted file), the first `--workers` of them running as Passenger workers, plus stub `sudo`, `lsof`,
+`passenger-status` and `passenger-config` executables whose output scales with the same numbers.
+Every scenario then runs in its own interpreter, so its peak RSS is its own, and reports per run:
+wall time, CPU time (the check's process plus reaped children), and subprocesses spawned.
+
+The medians are compared with benchmarks/baseline_checks.json when it was recorded with the same
+parameters; the script exits with status 1 when any of them regressed by more than `--tolerance`, or
+spawned more subprocesses. Usage:
+    python benchmarks/bench_checks.py [--pids 2000] [--fds 100] [--workers 200] [--threads 16] [--repeat 5]
+    python benchmarks/bench_checks.py --update-baseline
+"""
+import argparse
+import json
+import os
+import pwd
+import resource
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'checks.d'))
+sys.path.insert(0, ROOT)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_checks.json')
+SCENARIOS = ('files_descriptors_proc', 'files_descriptors_lsof', 'passenger_queue', 'passenger_mem_overload')
+METRICS = ('wall', 'cpu', 'peak_rss_mb', 'subprocesses')
+PARAMS = ('pids', 'fds', 'deleted_every', 'workers', 'threads', 'clients', 'queue')
+
+WORKER_CMDLINE = b'Passenger RubyApp: /srv/app (production)\0'
+OTHER_CMDLINE = b'/usr/sbin/nginx\0-g\0daemon off;\0'
+THRESHOLD_MB = 500
+SHARED_PAGES = 10000
+
+SUDO_STUB = '#!/bin/sh\nexec "$@"\n'
+CAT_STUB = '#!/bin/sh\nexec cat {path!r}\n'
+PASSENGER_STATUS_STUB = '''#!/bin/sh
+case "$*" in
+    *--show=xml*) exec cat {xml!r} ;;
+    *--show=requests*) exec cat {requests!r} ;;
+esac
+'''
+PASSENGER_CONFIG_STUB = '#!/bin/sh\necho "Process $2 detached."\n'
+
+LIMITS = ('Limit                     Soft Limit           Hard Limit           Units     \n'
+          'Max processes             63448                63448                processes \n'
+          'Max open files            {soft_limit:<21}1048576              files     \n')
+
+POOL_PROCESS = '''<process><pid>{pid}</pid><concurrency>1</concurrency><sessions>1</sessions>
+<busyness>2147483647</busyness><processed>{processed}</processed><life_status>ALIVE</life_status>
+<command>Passenger RubyApp: /srv/app (production)</command></process>
+'''
+
+
+def write_executable(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def resident_pages(pid):
+    """Resident pages of a synthetic worker; two workers in 20 are over THRESHOLD_MB of private memory."""
+    return 50000 + pid % 20 * 5000
+
+
+def build_proc(proc_root, args):
+    files_dir = os.path.join(os.path.dirname(proc_root), 'files')
+    os.makedirs(files_dir)
+    uid = os.getuid()
+    lsof = []
+    for pid in range(1, args.pids + 1):
+        pid_dir = os.path.join(proc_root, str(pid))
+        fd_dir = os.path.join(pid_dir, 'fd')
+        os.makedirs(fd_dir)
+        lsof.append(f'p{pid}\nu{uid}\n')
+        for fd in range(args.fds):
+            if fd % args.deleted_every:
+                target = '/dev/null'
+            else:
+                target = os.path.join(files_dir, f'{pid % 50}-{fd} (deleted)')
+                if not os.path.exists(target):
+                    with open(target, 'wb') as fh:
+                        fh.truncate(fd * 100)
+            os.symlink(target, os.path.join(fd_dir, str(fd)))
+            lsof.append(f'n{target}\n')
+        with open(os.path.join(pid_dir, 'cmdline'), 'wb') as fh:
+            fh.write(WORKER_CMDLINE if pid <= args.workers else OTHER_CMDLINE)
+        with open(os.path.join(pid_dir, 'stat'), 'w') as fh:
+            fh.write(f'{pid} (ruby) S 1 {pid} {pid} 0 -1 4194560' + ' 0' * 12 + f' {pid * 100} 0 0\n')
+        with open(os.path.join(pid_dir, 'statm'), 'w') as fh:
+            fh.write(f'200000 {resident_pages(pid)} {SHARED_PAGES} 100 0 90000 0\n')
+        with open(os.path.join(pid_dir, 'limits'), 'w') as fh:
+            fh.write(LIMITS.format(soft_limit=1024 + pid % 7 * 1024))
+    return ''.join(lsof)
+
+
+def build_pool_xml(args):
+    processes = ''.join(POOL_PROCESS.format(pid=pid, processed=pid * 10) for pid in range(1, args.workers + 1))
+    return (f'<?xml version="1.0" encoding="iso8859-1" ?>\n<info version="3"><process_count>{args.workers}'
+            f'</process_count><max>{args.workers}</max><capacity_used>{args.workers}</capacity_used>'
+            f'<get_wait_list_size>{args.queue}</get_wait_list_size><supergroups><supergroup>'
+            f'<name>/srv/app (production)</name><group><name>/srv/app (production)</name>'
+            f'<get_wait_list_size>0</get_wait_list_size><processes>{processes}</processes>'
+            f'</group></supergroup></supergroups></info>\n')
+
+
+def build_requests_json(args):
+    def client(number):
+        return {'connected_at': {'timestamp': 1700000000.0 + number, 'relative': '1s ago'},
+                'current_request': {'method': 'GET', 'path': f'/orders/{number}', 'host': 'shop.example.com',
+                                    'state': 'WAITING_FOR_APP_OUTPUT', 'content_length': 0}}
+
+    threads = {}
+    for thread in range(1, args.threads + 1):
+        clients = {f'{thread}-{number}': client(number) for number in range(args.clients)}
+        threads[f'thread{thread}'] = {
+            'active_client_count': len(clients), 'active_clients': clients,
+            'client_accept_speed': {'1m': {'averaged_over': '1 minute', 'per': 'minute', 'value': 1.0}},
+            'total_clients_accepted': thread * 1000, 'server_state': 'ACTIVE',
+        }
+    return json.dumps(threads, indent=3)
+
+
+def build_fixture(root, args):
+    proc_root = os.path.join(root, 'proc')
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    outputs = {
+        'lsof.txt': build_proc(proc_root, args),
+        'pool.xml': build_pool_xml(args),
+        'requests.json': build_requests_json(args),
+    }
+    for name, content in outputs.items():
+        with open(os.path.join(root, name), 'w') as fh:
+            fh.write(content)
+
+    write_executable(os.path.join(bin_dir, 'sudo'), SUDO_STUB)
+    write_executable(os.path.join(bin_dir, 'lsof'), CAT_STUB.format(path=os.path.join(root, 'lsof.txt')))
+    write_executable(os.path.join(bin_dir, 'passenger-status'), PASSENGER_STATUS_STUB.format(
+        xml=os.path.join(root, 'pool.xml'), requests=os.path.join(root, 'requests.json')))
+    write_executable(os.path.join(bin_dir, 'passenger-config'), PASSENGER_CONFIG_STUB)
+
+
+class CountingPopen(subprocess.Popen):
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.count += 1
+        super().__init__(*args, **kwargs)
+
+
+def make_scenario(name, root):
+    """(check, instance) of a scenario, configured to read the fixture under `root`."""
+    proc_root = os.path.join(root, 'proc')
+    if name.startswith('files_descriptors'):
+        from dd_check_files_descriptors import FilesDescriptorsCheck
+        check = FilesDescriptorsCheck()
+        check.init_config = {
+            'mon_user_list': [pwd.getpwuid(os.getuid()).pw_name],
+            'deleted_files_collector': name.rsplit('_', 1)[1],
+            'proc_root': proc_root,
+            'fd_usage_top_count': 5,
+            'shared_scan_interval': 0,
+            'process_snapshot_max_age': 0,
+        }
+        return check, {}
+    if name == 'passenger_queue':
+        from dd_check_passenger_queue import PassengerQueueCheck
+        return PassengerQueueCheck(), {'passenger_api': False, 'requests_metrics': True,
+                                       'snapshot_file': os.path.join(root, 'snapshots.ring')}
+    from dd_check_passenger_mem_overload import PassengerMemOverloadCheck
+    return PassengerMemOverloadCheck(), {'passenger_api': False, 'threshold': THRESHOLD_MB, 'proc_root': proc_root,
+                                         'process_snapshot_max_age': 0}
+
+
+def run_child(name, root, repeat):
+    """Run a scenario `repeat` times in this process and print one JSON object per run."""
+    import dd_logging
+
+    get_logger = dd_logging.get_logger
+    log_dir = os.path.join(root, 'log')
+    os.makedirs(log_dir, exist_ok=True)
+
+    def bench_logger(logger_name, filename, level=dd_logging.LOG_LEVEL):
+        return get_logger(logger_name, os.path.join(log_dir, os.path.basename(filename)), level)
+
+    check, instance = make_scenario(name, root)
+    # synthetic fd directories report no FD count in st_size, so count them like kernels older than 6.2
+    with patch('dd_logging.get_logger', side_effect=bench_logger), patch('subprocess.Popen', CountingPopen), \
+            patch('dd_process_snapshot.get_fd_count',
+                  side_effect=lambda fd_dir: len(os.listdir(fd_dir))):
+        for _ in range(repeat):
+            spawned = CountingPopen.count
+            self_usage = resource.getrusage(resource.RUSAGE_SELF)
+            children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.perf_counter()
+            check.check(instance)
+            wall = time.perf_counter() - start
+            cpu = sum(getattr(after, field) - getattr(before, field)
+                      for before, after in ((self_usage, resource.getrusage(resource.RUSAGE_SELF)),
+                                            (children_usage, resource.getrusage(resource.RUSAGE_CHILDREN)))
+                      for field in ('ru_utime', 'ru_stime'))
+            print(json.dumps({'wall': wall, 'cpu': cpu, 'subprocesses': CountingPopen.count - spawned,
+                              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+    dd_logging.stop()
+
+
+def run_scenario(name, root, repeat):
+    env = dict(os.environ, PATH=os.path.join(root, 'bin') + os.pathsep + os.environ['PATH'])
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, '--root', root,
+                             '--repeat', str(repeat)], env=env, capture_output=True, text=True, check=True)
+    runs = [json.loads(line) for line in result.stdout.splitlines()]
+    medians = {metric: statistics.median(run[metric] for run in runs) for metric in METRICS}
+    medians['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+    medians['subprocesses'] = max(run['subprocesses'] for run in runs)
+    return medians
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing the metrics that regressed against `baseline`."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(name, {}).get(metric)
+            if reference is None:
+                continue
+            limit = reference if metric == 'subprocesses' else reference * (1 + tolerance)
+            if value > limit:
+                regressions.append(f'{name} {metric}: {value:.4g} vs baseline {reference:.4g}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pids', type=int, default=2000)
+    parser.add_argument('--fds', type=int, default=100)
+    parser.add_argument('--deleted-every', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=200, help='Passenger workers among the PIDs')
+    parser.add_argument('--threads', type=int, default=16, help='core threads in --show=requests')
+    parser.add_argument('--clients', type=int, default=200, help='active clients per thread')
+    parser.add_argument('--queue', type=int, default=1000, help='requests waiting in the pool queue')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative regression of time and RSS')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.root, args.repeat)
+        return
+
+    params = {param: getattr(args, param) for param in PARAMS}
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        build_fixture(root, args)
+        print(f'fixture: {args.pids} pids, {args.pids * args.fds} fds, {args.workers} workers, '
+              f'{args.threads}x{args.clients} clients in {time.perf_counter() - start:.1f}s')
+        print(f'{"scenario":<24}{"wall":>10}{"cpu":>10}{"peak rss":>12}{"subprocesses":>14}')
+        for name in args.scenario or SCENARIOS:
+            results[name] = metrics = run_scenario(name, root, args.repeat)
+            print(f'{name:<24}{metrics["wall"]:>9.3f}s{metrics["cpu"]:>9.3f}s{metrics["peak_rss_mb"]:>9.1f} MB'
+                  f'{metrics["subprocesses"]:>14}')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as fh:
+            scenarios = {name: {metric: round(value, 4) for metric, value in metrics.items()}
+                         for name, metrics in results.items()}
+            json.dump({'params': params, 'scenarios': scenarios}, fh, indent=4, sort_keys=True)
+            fh.write('\n')
+        print(f'baseline written to {args.baseline}')
+        return
+
+    try:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    except FileNotFoundError:
+        print('no baseline, run with --update-baseline to record one')
+        return
+    if baseline['params'] != params:
+        print(f'baseline recorded with {baseline["params"]}, not comparing')
+        return
+    regressions = compare(results, baseline['scenarios'], args.tolerance)
+    for line in regressions:
+        print(f'REGRESSION {line}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
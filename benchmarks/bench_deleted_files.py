@@ -0,0 +1,95 @@
+"""Compare the /proc deleted-files scanner with the lsof collector.
+
+Usage:
+    python benchmarks/bench_deleted_files.py                  # both collectors on the live /proc
+    python benchmarks/bench_deleted_files.py --synthetic 500 200  # /proc scanner on 500 pids x 200 fds
+
+On the live /proc it also reports the CPU time of a whole fetch with and without deep_scan_delta. The
+shared scan and process snapshot caches are disabled there, so every repeat scans the host again.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'checks.d'))
+
+from dd_check_files_descriptors import FdInventoryCache, FilesDescriptorsCheck, scan_deleted_files  # noqa: E402
+from dd_process_snapshot import scan_processes  # noqa: E402
+
+
+def build_synthetic_proc(root, pids, fds_per_pid, deleted_every=10):
+    """Every `deleted_every`-th fd links to a real file named '... (deleted)' so it can be stat-ed."""
+    files_dir = os.path.join(root, 'files')
+    os.makedirs(files_dir)
+    for pid in range(1, pids + 1):
+        fd_dir = os.path.join(root, str(pid), 'fd')
+        os.makedirs(fd_dir)
+        for fd in range(fds_per_pid):
+            if fd % deleted_every == 0:
+                target = os.path.join(files_dir, f'app-{pid}-{fd}.log (deleted)')
+                open(target, 'w').close()
+            else:
+                target = f'/var/log/app-{pid}-{fd}.log'
+            os.symlink(target, os.path.join(fd_dir, str(fd)))
+
+
+def timed(func, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', nargs=2, type=int, metavar=('PIDS', 'FDS'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as proc_root:
+            build_synthetic_proc(proc_root, *args.synthetic)
+            pids, fds = args.synthetic
+            for pid in range(1, pids + 1):
+                with open(os.path.join(proc_root, str(pid), 'stat'), 'w') as fh:
+                    fh.write(f'{pid} (app) S' + ' 0' * 18 + ' 1000 0 0\n')
+            elapsed, deleted_fds = timed(lambda: scan_deleted_files(scan_processes(proc_root), proc_root=proc_root),
+                                         args.repeat)
+            print(f'proc  synthetic {pids}x{fds}: {len(deleted_fds)} deleted in {elapsed:.4f}s '
+                  f'(process snapshot included)')
+
+            cache = FdInventoryCache(max_age=300)
+            cache.scan(scan_processes(proc_root), proc_root=proc_root)
+            elapsed, deleted_fds = timed(lambda: cache.scan(scan_processes(proc_root), proc_root=proc_root),
+                                         args.repeat)
+            print(f'cache synthetic {pids}x{fds}: {len(deleted_fds)} deleted in {elapsed:.4f}s '
+                  f'(steady state, process snapshot included)')
+        return
+
+    uncached = {'shared_scan_interval': 0, 'process_snapshot_max_age': 0}
+    check = FilesDescriptorsCheck()
+    for collector in ('proc', 'lsof'):
+        check.init_config = dict(uncached, deleted_files_collector=collector)
+        try:
+            elapsed, deleted_fds = timed(check.get_deleted_files, args.repeat)
+        except Exception as exc:
+            print(f'{collector:5} live: unavailable ({exc!r})')
+        else:
+            print(f'{collector:5} live: {len(deleted_fds)} deleted in {elapsed:.4f}s')
+
+    for deep_scan_delta in (0, 1000):
+        check.init_config = dict(uncached, deleted_files_collector='proc', deep_scan_delta=deep_scan_delta)
+        start = time.process_time()
+        for _ in range(args.repeat):
+            check.fetch()
+        cpu = (time.process_time() - start) / args.repeat
+        print(f'fetch deep_scan_delta={deep_scan_delta}: {cpu:.4f}s CPU per run')
+
+
+if __name__ == '__main__':
+    main()
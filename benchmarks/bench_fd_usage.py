@@ -0,0 +1,66 @@
+"""Time the per-process FD usage scan against a budget.
+
+Builds a synthetic /proc of `--pids` processes, each with `--fds` fd symlinks, a stat and a limits file,
+and runs scan_fd_usage over a process snapshot of it, the snapshot walk included. FD counts come from
+listing each fd directory, the fallback used on kernels older than 6.2, so this is the slow path. Exits
+with status 1 when the mean run exceeds `--budget` seconds. Usage:
+    python benchmarks/bench_fd_usage.py --pids 5000 --fds 20 --budget 1.0
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'checks.d'))
+
+from dd_check_files_descriptors import scan_fd_usage  # noqa: E402
+from dd_process_snapshot import scan_processes  # noqa: E402
+
+LIMITS = ('Limit                     Soft Limit           Hard Limit           Units     \n'
+          'Max cpu time              unlimited            unlimited            seconds   \n'
+          'Max processes             63448                63448                processes \n'
+          'Max open files            {soft_limit:<21}1048576              files     \n'
+          'Max locked memory         8388608              8388608              bytes     \n')
+
+
+def build_synthetic_proc(root, pids, fds_per_pid):
+    for pid in range(1, pids + 1):
+        fd_dir = os.path.join(root, str(pid), 'fd')
+        os.makedirs(fd_dir)
+        for fd in range(fds_per_pid):
+            os.symlink('/dev/null', os.path.join(fd_dir, str(fd)))
+        with open(os.path.join(root, str(pid), 'stat'), 'w') as fh:
+            fh.write(f'{pid} (ruby) S 1 {pid} {pid} 0 -1 4194560' + ' 0' * 12 + f' {pid * 100} 0 0\n')
+        with open(os.path.join(root, str(pid), 'limits'), 'w') as fh:
+            fh.write(LIMITS.format(soft_limit=1024 + pid % 7 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pids', type=int, default=5000)
+    parser.add_argument('--fds', type=int, default=20)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=1.0, help='maximum seconds per scan')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as proc_root:
+        build_synthetic_proc(proc_root, args.pids, args.fds)
+        with patch('dd_process_snapshot.get_fd_count',
+                   side_effect=lambda fd_dir: len(os.listdir(fd_dir))):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                top = scan_fd_usage(scan_processes(proc_root), proc_root=proc_root, count=args.top)
+            elapsed = (time.perf_counter() - start) / args.repeat
+
+    print(f'synthetic {args.pids}x{args.fds}: top {len(top)} in {elapsed:.4f}s per scan (budget {args.budget}s)')
+    live_start = time.perf_counter()
+    live_top = scan_fd_usage(scan_processes(), count=args.top)
+    print(f'live /proc: top {len(live_top)} in {time.perf_counter() - live_start:.4f}s')
+    sys.exit(0 if elapsed <= args.budget else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Per-phase cost of dd_instrumentation, disabled and enabled, against a plain method call.
+
+A disabled phase must stay under a microsecond: the script exits with status 1 when the @timed
+decorator or the phase() context manager adds more than `--budget` seconds per call. Usage:
+    python benchmarks/bench_instrumentation.py [--calls 1000000] [--budget 1e-6]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'checks.d'))
+
+from dd_instrumentation import Instrumentation, phase, timed  # noqa: E402
+
+
+class Check:
+    instrumentation = None
+
+    def plain(self):
+        return 1
+
+    @timed
+    def decorated(self):
+        return 1
+
+    def with_phase(self):
+        with phase(self, 'with_phase'):
+            return 1
+
+
+def per_call(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=1000000)
+    parser.add_argument('--budget', type=float, default=1e-6, help='maximum overhead per disabled phase')
+    args = parser.parse_args()
+
+    check = Check()
+    baseline = per_call(check.plain, args.calls)
+    disabled = {name: per_call(getattr(check, name), args.calls) - baseline for name in ('decorated', 'with_phase')}
+
+    check.instrumentation = Instrumentation()
+    enabled_calls = args.calls // 100
+    enabled = {name: per_call(getattr(check, name), enabled_calls) - baseline for name in ('decorated', 'with_phase')}
+
+    print(f'{"phase":<12}{"disabled":>12}{"enabled":>12}')
+    for name in disabled:
+        print(f'{name:<12}{disabled[name] * 1e9:>10.0f}ns{enabled[name] * 1e9:>10.0f}ns')
+    sys.exit(0 if max(disabled.values()) <= args.budget else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Per-run logging cost of the former per-run FileHandler versus the shared queued logger.
+
+Each simulated check run logs `--lines` DEBUG lines of `--size` bytes, like log_if_urgent dumping
+request details. Time is measured on the calling thread only, which is what a check run pays. Usage:
+    python benchmarks/bench_logging.py --runs 1000 --lines 2 --size 200 20000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'checks.d'))
+
+import dd_logging  # noqa: E402
+
+
+def per_run_file_handler(log_dir, lines, message):
+    """The former get_logger/log_wrapper: open, write synchronously and close a FileHandler every run."""
+    logger = logging.getLogger('bench_logging.file_handler')
+    file_handler = logging.FileHandler(os.path.join(log_dir, 'file-handler-{:%Y-%m-%d}.log'.format(datetime.now())))
+    file_handler.setFormatter(logging.Formatter(dd_logging.FORMAT))
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+    for _ in range(lines):
+        logger.debug(message)
+    logger.removeHandler(file_handler)
+    file_handler.flush()
+    file_handler.close()
+
+
+def queued(log_dir, lines, message):
+    logger = dd_logging.get_logger('bench_logging.queued', os.path.join(log_dir, 'queued.log'))
+    for _ in range(lines):
+        logger.debug(message)
+
+
+def measure(run, runs, log_dir, lines, message):
+    start = time.perf_counter()
+    for _ in range(runs):
+        run(log_dir, lines, message)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--lines', type=int, default=2)
+    parser.add_argument('--size', type=int, nargs='+', default=[200, 20000])
+    args = parser.parse_args()
+
+    print(f'{"line bytes":>10}  {"file handler/run":>16}  {"queued/run":>10}')
+    for size in args.size:
+        message = 'x' * size
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_handler = measure(per_run_file_handler, args.runs, log_dir, args.lines, message)
+            queued_run = measure(queued, args.runs, log_dir, args.lines, message)
+            dd_logging.stop()
+        print(f'{size:>10}  {file_handler * 1e6:>14.1f}us  {queued_run * 1e6:>8.1f}us')
+
+
+if __name__ == '__main__':
+    main()
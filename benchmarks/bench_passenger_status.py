@@ -0,0 +1,86 @@
+"""Compare one `passenger-status --show=xml` run with the former text+awk and --show=requests runs.
+
+Both approaches call stub `sudo` and `passenger-status` executables that print the test samples, so the
+numbers reflect process spawning and parsing, not a live Passenger. Usage:
+    python benchmarks/bench_passenger_status.py [--repeat 20] [--startup-delay 0.2]
+"""
+import argparse
+import json
+import os
+import shlex
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'checks.d'))
+sys.path.insert(0, ROOT)
+
+from dd_check_passenger_queue import PassengerQueueCheck  # noqa: E402
+
+SUDO_STUB = '#!/bin/sh\nexec "$@"\n'
+
+PASSENGER_STATUS_STUB = '''#!{python}
+import sys, time
+sys.path.insert(0, {root!r})
+from tests.test_samples.pool_status_samples import TEST_POOL_XML
+from tests.test_samples.queue_requests_samples import TEST_REQUESTS
+time.sleep({startup_delay})
+if '--show=xml' in sys.argv:
+    sys.stdout.buffer.write(TEST_POOL_XML[0])
+elif '--show=requests' in sys.argv:
+    sys.stdout.buffer.write(TEST_REQUESTS[0])
+else:
+    sys.stdout.write('Requests in top-level queue : 2\\n  Requests in queue: 15\\n  Requests in queue: 3\\n')
+'''
+
+
+def write_executable(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def legacy_collect():
+    """The pre-XML collection: passenger-status | awk, then passenger-status --show=requests."""
+    pipe_1 = subprocess.Popen(shlex.split("sudo passenger-status"), stdout=subprocess.PIPE)
+    pipe_2 = subprocess.Popen(shlex.split("""awk /"Requests in queue"/'{print $4}'"""), stdin=pipe_1.stdout,
+                              stdout=subprocess.PIPE)
+    queue_size = int(pipe_2.communicate()[0].decode().split()[0])
+    pipe = subprocess.Popen(shlex.split("sudo passenger-status --show=requests --no-header"), stdout=subprocess.PIPE)
+    json.loads(pipe.communicate()[0])
+    return queue_size
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--startup-delay', type=float, default=0.0,
+                        help='seconds each stub sleeps, to mimic Ruby start-up of the real tool')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as bin_dir:
+        write_executable(os.path.join(bin_dir, 'sudo'), SUDO_STUB)
+        write_executable(os.path.join(bin_dir, 'passenger-status'), PASSENGER_STATUS_STUB.format(
+            python=sys.executable, root=os.path.abspath(ROOT), startup_delay=args.startup_delay))
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+        check = PassengerQueueCheck()
+        check.log = MagicMock()
+
+        print(f'legacy (3 processes): {timed(legacy_collect, args.repeat):.4f}s per run')
+        print(f'xml    (1 process):   {timed(check.get_pool_status, args.repeat):.4f}s per run')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Count the syscalls of one collection interval of the FD and memory checks running in the same agent.
+
+Both checks run in this process against a synthetic /proc of `--pids` processes (the first `--workers`
+of them Passenger workers), in two configurations: `default`, with no option set beyond the proc
+collector, and `tuned`, with the FD check reporting the top FD users and keeping its fd cache and the
+memory check tracking trends. Every interval starts with the shared caches cleared, after one warm-up
+interval has filled the fd cache. Synthetic fd directories are stat-ed once, as on kernels >= 6.2,
+though their size is not an FD count.
+
+Syscalls are those entered by this thread, read from a perf counter on the raw_syscalls:sys_enter
+tracepoint: run as root with tracefs mounted (mount -t tracefs nodev /sys/kernel/tracing). The
+medians are compared with benchmarks/baseline_process_snapshot.json, recorded before the checks shared
+a process snapshot and never rewritten, as this script cannot run that code any more. The script exits
+with status 1 when the `tuned` total is over `--target` times its baseline or the `default` total is
+over its baseline. `--live` counts the same intervals against the host /proc instead, without
+comparing. Usage:
+    python benchmarks/bench_process_snapshot.py [--pids 2000] [--workers 200] [--repeat 5] [--target 0.5]
+"""
+import argparse
+import ctypes
+import fcntl
+import json
+import os
+import pwd
+import statistics
+import struct
+import sys
+import tempfile
+from unittest.mock import patch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'checks.d'))
+sys.path.insert(0, ROOT)
+
+from bench_checks import build_proc  # noqa: E402
+from dd_check_files_descriptors import SHARED_SCANS, FilesDescriptorsCheck  # noqa: E402
+from dd_check_passenger_mem_overload import PassengerMemOverloadCheck  # noqa: E402
+from dd_process_snapshot import SNAPSHOTS  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_process_snapshot.json')
+SYS_ENTER_ID = '/sys/kernel/tracing/events/raw_syscalls/sys_enter/id'
+THRESHOLD_MB = 100000
+
+NR_PERF_EVENT_OPEN = 298
+PERF_TYPE_TRACEPOINT = 2
+PERF_ATTR_SIZE = 128
+PERF_EVENT_IOC_ENABLE = 0x2400
+PERF_EVENT_IOC_DISABLE = 0x2401
+PERF_EVENT_IOC_RESET = 0x2403
+
+
+class SyscallCounter:
+    """Syscalls entered by the calling thread between enter and exit, less the counter's own ioctl."""
+
+    def __init__(self):
+        with open(SYS_ENTER_ID, 'r') as fh:
+            tracepoint = int(fh.read())
+        attr = bytearray(PERF_ATTR_SIZE)
+        struct.pack_into('<IIQ', attr, 0, PERF_TYPE_TRACEPOINT, PERF_ATTR_SIZE, tracepoint)
+        struct.pack_into('<Q', attr, 40, 1)  # disabled until enabled
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.syscall(NR_PERF_EVENT_OPEN, ctypes.create_string_buffer(bytes(attr), PERF_ATTR_SIZE),
+                               0, -1, -1, 0)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'perf_event_open failed')
+        self.count = 0
+        self.overhead = 0
+        with self:
+            pass
+        self.overhead = self.count
+
+    def __enter__(self):
+        fcntl.ioctl(self.fd, PERF_EVENT_IOC_RESET)
+        fcntl.ioctl(self.fd, PERF_EVENT_IOC_ENABLE)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.ioctl(self.fd, PERF_EVENT_IOC_DISABLE)
+        self.count = struct.unpack('<Q', os.read(self.fd, 8))[0] - self.overhead
+        return False
+
+
+def stat_fd_dir(fd_dir):
+    return os.stat(fd_dir).st_size
+
+
+CONFIGS = {
+    'default': ({}, {}),
+    'tuned': ({'fd_usage_top_count': 5, 'fd_cache_max_age': 300}, {'trend_window': 10}),
+}
+
+
+def make_checks(proc_root, config):
+    fd_options, mem_options = CONFIGS[config]
+    fd_check = FilesDescriptorsCheck()
+    fd_check.init_config = dict({
+        'mon_user_list': [pwd.getpwuid(os.getuid()).pw_name],
+        'deleted_files_collector': 'proc',
+        'proc_root': proc_root,
+    }, **fd_options)
+    mem_check = PassengerMemOverloadCheck()
+    mem_instance = dict({'passenger_api': False, 'threshold': THRESHOLD_MB, 'proc_root': proc_root}, **mem_options)
+    return fd_check, mem_check, mem_instance
+
+
+def count_interval(counter, fd_check, mem_check, mem_instance):
+    """Syscalls of the FD check and of the memory check over one interval, caches shared between them cleared."""
+    SNAPSHOTS.clear()
+    SHARED_SCANS.clear()
+    with counter:
+        fd_check.check({})
+    fd_syscalls = counter.count
+    with counter:
+        mem_check.check(mem_instance)
+    return fd_syscalls, counter.count
+
+
+def run(counter, proc_root, repeat):
+    """Median syscalls per check and in total, per configuration."""
+    results = {}
+    for config in sorted(CONFIGS):
+        fd_check, mem_check, mem_instance = make_checks(proc_root, config)
+        count_interval(counter, fd_check, mem_check, mem_instance)
+        runs = [count_interval(counter, fd_check, mem_check, mem_instance) for _ in range(repeat)]
+        fd_syscalls = statistics.median(fd for fd, _ in runs)
+        mem_syscalls = statistics.median(mem for _, mem in runs)
+        results[config] = {'files_descriptors': fd_syscalls, 'passenger_mem_overload': mem_syscalls,
+                           'total': fd_syscalls + mem_syscalls}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pids', type=int, default=2000)
+    parser.add_argument('--fds', type=int, default=20)
+    parser.add_argument('--deleted-every', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--target', type=float, default=0.5, help='maximum tuned total as a fraction of its baseline')
+    parser.add_argument('--live', action='store_true', help='count against the host /proc')
+    args = parser.parse_args()
+
+    try:
+        counter = SyscallCounter()
+    except OSError as exc:
+        print(f'cannot count syscalls: {exc}; run as root with tracefs mounted', file=sys.stderr)
+        sys.exit(2)
+
+    with tempfile.TemporaryDirectory() as root, patch('dd_logging.get_logger'):
+        if args.live:
+            result = run(counter, '/proc', args.repeat)
+            print(json.dumps(result, sort_keys=True))
+            return
+        proc_root = os.path.join(root, 'proc')
+        build_proc(proc_root, args)
+        with patch('dd_process_snapshot.get_fd_count', side_effect=stat_fd_dir):
+            result = run(counter, proc_root, args.repeat)
+
+    params = {'pids': args.pids, 'fds': args.fds, 'deleted_every': args.deleted_every, 'workers': args.workers}
+    with open(BASELINE, 'r') as fh:
+        baseline = json.load(fh)
+    if baseline['params'] != params:
+        print(f'baseline recorded with {baseline["params"]}, not comparing', file=sys.stderr)
+        print(json.dumps(result, sort_keys=True))
+        return
+    for config, syscalls_by_check in sorted(result.items()):
+        for name, syscalls in sorted(syscalls_by_check.items()):
+            before = baseline['syscalls'][config][name]
+            print(f'{config:<8}{name:<24}{before:>10} -> {syscalls:>10} syscalls ({syscalls / before:.0%}, '
+                  f'{syscalls / args.pids:.1f} per process)')
+    targets = {'default': 1, 'tuned': args.target}
+    sys.exit(0 if all(result[config]['total'] <= target * baseline['syscalls'][config]['total']
+                      for config, target in targets.items()) else 1)
+
+
+if __name__ == '__main__':
+    main()
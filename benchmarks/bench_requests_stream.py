@@ -0,0 +1,73 @@
+"""Peak memory and time of json.loads versus the streaming parser on synthetic --show=requests dumps.
+
+Dumps are built from the thread objects in tests/test_samples/queue_requests_samples.py, with
+`--clients` active clients (each with one in-flight request) spread over the threads. Usage:
+    python benchmarks/bench_requests_stream.py --clients 100 1000 10000
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'checks.d'))
+sys.path.insert(0, ROOT)
+
+from dd_check_passenger_queue import stream_requests_summary  # noqa: E402
+from tests.test_samples.queue_requests_samples import TEST_REQUESTS  # noqa: E402
+
+
+def build_requests_dump(clients):
+    dump = json.loads(TEST_REQUESTS[0])
+    threads = [name for name, thread in dump.items() if isinstance(thread, dict)]
+    for client in range(clients):
+        thread = dump[threads[client % len(threads)]]
+        thread['active_clients'][f'{client % len(threads) + 1}-{client}'] = {
+            'connected_at': {'local': 'Mon Feb  1 10:00:00 2021', 'relative': '1s ago', 'timestamp': 1612173600.5},
+            'connection_state': 'ACTIVE',
+            'current_request': {
+                'app_response_http_state': 'PARSING_HEADERS',
+                'host': 'shop.example.com',
+                'http_state': 'COMPLETE',
+                'method': 'GET',
+                'path': f'/products/{client}?page=1&per_page=50',
+                'request_body_type': 'NO_BODY',
+                'started_at': {'local': 'Mon Feb  1 10:00:00 2021', 'relative': '1s ago', 'timestamp': 1612173600.5},
+                'state': 'WAITING_FOR_APP_OUTPUT',
+            },
+            'lifetime_requests_begun': 1,
+            'output_channel_state': {'bytes_buffered': 0, 'mode': 'IN_MEMORY_MODE'},
+        }
+        thread['active_client_count'] += 1
+    return json.dumps(dump, indent=3).encode()
+
+
+def measure(func, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(io.BytesIO(data))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 1000, 10000])
+    args = parser.parse_args()
+
+    for clients in args.clients:
+        data = build_requests_dump(clients)
+        print(f'{clients} clients, {len(data) / 2 ** 20:.1f} MB dump')
+        for name, func in (('json.loads', lambda stream: json.loads(stream.read())),
+                           ('stream', stream_requests_summary)):
+            elapsed, peak = measure(func, data)
+            print(f'  {name:10} {elapsed:.3f}s, peak {peak / 2 ** 20:.1f} MB allocated')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import namedtuple
+
+COLLECTION_INTERVAL = 60
+MAX_SNAPSHOT_AGE = 300
+
+Snapshot = namedtuple('Snapshot', ['data', 'completed_at', 'duration'])
+
+
+class BackgroundCollector:
+    """Call `fetch` every `interval` seconds in a daemon thread and keep the result of the last successful call.
+
+    The agent's check() then only reads `snapshot`, so a slow fetch never holds up the collector worker.
+    """
+
+    def __init__(self, fetch, interval=COLLECTION_INTERVAL, name='dd-background-collector'):
+        self.fetch = fetch
+        self.interval = interval
+        self.name = name
+        self.snapshot = None
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                data = self.fetch()
+            except Exception as exc:
+                self.error = exc
+            else:
+                end = time.monotonic()
+                self.snapshot = Snapshot(data, end, end - start)
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - start)))
+
+    def current(self, check, prefix, max_age=MAX_SNAPSHOT_AGE):
+        """Data of the last snapshot, or None when there is none yet or it is older than `max_age` seconds.
+
+        Reports <prefix>.snapshot.age and <prefix>.snapshot.collection_duration, and logs the error of a
+        failed fetch once.
+        """
+        error, self.error = self.error, None
+        if error is not None:
+            check.log.warning(f'Background collection failed: {error}')
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        age = time.monotonic() - snapshot.completed_at
+        check.gauge(f'{prefix}.snapshot.age', age)
+        check.gauge(f'{prefix}.snapshot.collection_duration', snapshot.duration)
+        if age > max_age:
+            check.log.warning(f'Last background snapshot is {age:.0f}s old, not reporting it')
+            return None
+        return snapshot.data
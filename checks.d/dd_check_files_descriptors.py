@@ -1,62 +1,425 @@
-import logging
-import shlex
-import subprocess
-from datetime import datetime
-from functools import wraps
+import heapq
+import os
+import pwd
+import time
+from collections import Counter, namedtuple
 
 from datadog_checks.base import AgentCheck
 
+from dd_background import COLLECTION_INTERVAL, MAX_SNAPSHOT_AGE, BackgroundCollector
+from dd_instrumentation import instrumented, phase, timed
+from dd_logging import LOG_LEVEL
+from dd_process_snapshot import SNAPSHOT_MAX_AGE, SharedCache, get_process_snapshot, read_proc_file
+from dd_subprocess import TIMEOUT, CommandRunner
+
 # content of the special variable __version__ will be shown in the Agent status page
 __version__ = "1.0.0"
 
+LOG_FILE = '/var/log/datadog/dd-check-files-descriptors.log'
+
+PROC_ROOT = '/proc'
+DELETED_SUFFIX = ' (deleted)'
+CAP_DAC_READ_SEARCH = 2
+CAP_SYS_PTRACE = 19
+
+COLLECTOR_AUTO = 'auto'
+COLLECTOR_PROC = 'proc'
+COLLECTOR_LSOF = 'lsof'
+
+TOP_PIDS_COUNT = 5
+FD_CACHE_MAX_AGE = 0
+DEEP_SCAN_DELTA = 0
+DEEP_SCAN_MAX_AGE = 300
+
+FD_USAGE_TOP_COUNT = 0
+SHARED_SCAN_INTERVAL = 10
+
+DeletedFd = namedtuple('DeletedFd', ['pid', 'uid', 'dev', 'ino', 'size', 'path'], defaults=(None,))
+FdUsage = namedtuple('FdUsage', ['pid', 'uid', 'fds', 'limit'])
+
 
 class GetDeletedStatsException(Exception):
     pass
 
 
-def get_logger(name=__name__):
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
+def has_proc_fd_access(status_path='/proc/self/status'):
+    """Whether the agent may read every /proc/<pid>/fd without sudo.
+
+    Listing the directory of another user's process needs CAP_DAC_READ_SEARCH, and reading or stat-ing
+    its fd links needs ptrace access, i.e. CAP_SYS_PTRACE; root has both.
+    """
+    required = (1 << CAP_DAC_READ_SEARCH) | (1 << CAP_SYS_PTRACE)
+    try:
+        with open(status_path, 'r') as fh:
+            for line in fh:
+                if line.startswith('CapEff:'):
+                    return int(line.split()[1], 16) & required == required
+    except (OSError, ValueError, IndexError):
+        pass
+    return False
+
+
+def scan_process_deleted_files(proc_root, pid, uid):
+    """Return a DeletedFd for every open FD of `pid`, owned by `uid`, whose target was unlinked.
+
+    The file behind each FD is stat-ed through the fd link, so its size is known even though it has no
+    name left. FDs closed during the walk are skipped. Raises PermissionError when the fd directory or
+    links of the process cannot be read, and OSError when the process exits.
+    """
+    deleted_fds = []
+    with os.scandir(os.path.join(proc_root, pid, 'fd')) as fds:
+        for fd in fds:
+            try:
+                target = os.readlink(fd.path)
+                if not target.endswith(DELETED_SUFFIX):
+                    continue
+                fd_stat = os.stat(fd.path)
+            except PermissionError:
+                raise
+            except OSError:
+                continue
+            deleted_fds.append(DeletedFd(int(pid), uid, fd_stat.st_dev, fd_stat.st_ino, fd_stat.st_size,
+                                         target[:-len(DELETED_SUFFIX)]))
+    return deleted_fds
+
+
+def scan_deleted_files(snapshot, proc_root=PROC_ROOT, denied=None):
+    """Return deleted FDs of all processes of the process snapshot, skipping vanished processes.
+
+    The snapshot provides the PIDs and their owners, so /proc itself is not walked again. PIDs whose FDs
+    could not be read are appended to `denied` when it is given.
+    """
+    deleted_fds = []
+    for row, pid in enumerate(snapshot.pids):
+        try:
+            deleted_fds.extend(scan_process_deleted_files(proc_root, str(pid), snapshot.uids[row]))
+        except PermissionError:
+            if denied is not None:
+                denied.append(pid)
+        except OSError:
+            continue
+    return deleted_fds
+
+
+class FdInventoryCache:
+    """Deleted FDs per process kept across runs, keyed by (pid, starttime).
+
+    A process is re-scanned only when its FD count in the process snapshot changed, when its entry is
+    older than `max_age` seconds, or when its PID was reused. The fd directory of a process has no
+    usable mtime in procfs, so the count is the only invalidation: a file unlinked while its holder keeps
+    the same FDs, or an FD closed and another opened in between, is reported at the latest `max_age`
+    seconds later. The count costs one stat per process on Linux >= 6.2 and a listing of the fd directory
+    on older kernels. Entries of processes missing from the snapshot are evicted on every scan.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.entries = {}
+        self.rescanned = 0
+        self.denied = []
+
+    def scan(self, snapshot, proc_root=PROC_ROOT, now=None):
+        now = time.monotonic() if now is None else now
+        entries = {}
+        deleted_fds = []
+        self.rescanned = 0
+        self.denied = []
+
+        fds = snapshot.load_fds()
+        for row, pid in enumerate(snapshot.pids):
+            if fds[row] < 0:
+                continue
+            key = (pid, snapshot.starttimes[row])
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != fds[row] or now - entry[1] >= self.max_age:
+                try:
+                    entry = (fds[row], now, scan_process_deleted_files(proc_root, str(pid), snapshot.uids[row]))
+                except PermissionError:
+                    self.denied.append(pid)
+                    continue
+                except OSError:
+                    continue
+                self.rescanned += 1
+            entries[key] = entry
+            deleted_fds.extend(entry[2])
+
+        self.entries = entries
+        return deleted_fds
+
+
+def get_nofile_soft_limit(proc_root, pid):
+    """Soft RLIMIT_NOFILE of a process from /proc/<pid>/limits, None when unlimited."""
+    for line in read_proc_file(os.path.join(proc_root, str(pid), 'limits')).splitlines():
+        if line.startswith(b'Max open files'):
+            soft_limit = line[len(b'Max open files'):].split()[0]
+            return None if soft_limit == b'unlimited' else int(soft_limit)
+    return None
+
+
+def scan_fd_usage(snapshot, proc_root=PROC_ROOT, count=5, uids=None):
+    """The `count` processes of the process snapshot using the largest share of their soft RLIMIT_NOFILE,
+    most used first.
+
+    Only processes owned by `uids` are considered when it is given, and only their limits file is read.
+    A heap of `count` entries is kept, so memory does not grow with the number of processes.
+    """
+    heap = []
+    fd_counts = snapshot.load_fds()
+    for row, pid in enumerate(snapshot.pids):
+        uid, fds = snapshot.uids[row], fd_counts[row]
+        if fds < 0 or uids is not None and uid not in uids:
+            continue
+        try:
+            limit = get_nofile_soft_limit(proc_root, pid)
+        except (OSError, ValueError, IndexError):
+            continue
+        if not limit:
+            continue
+        entry = (fds / limit, pid, FdUsage(pid, uid, fds, limit))
+        if len(heap) < count:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    return [usage for _, _, usage in sorted(heap, reverse=True)]
+
+
+class DeepScanSchedule:
+    """Decides when the deleted files scan is due again, from the cheap /proc/sys/fs/file-nr count.
+
+    A scan is due when the number of allocated file handles moved by at least `delta` since the last
+    scan, or when the last scan is `max_age` seconds old.
+    """
+
+    def __init__(self, delta, max_age):
+        self.delta = delta
+        self.max_age = max_age
+        self.open_files = None
+        self.scanned_at = None
+
+    def due(self, open_files, now):
+        return (self.scanned_at is None or abs(open_files - self.open_files) >= self.delta
+                or now - self.scanned_at >= self.max_age)
+
+    def record(self, open_files, now):
+        self.open_files = open_files
+        self.scanned_at = now
+
+
+def parse_lsof_deleted_files(output):
+    """Return a DeletedFd (without size) for every deleted file in `lsof -F pufDin` field output.
+
+    Entries are deduplicated on pid, fd, device and inode: an lsof that does not honour -K i lists
+    every thread of a process as a task with the same FDs, which would count each FD once per thread.
+    """
+    deleted_fds = []
+    seen = set()
+    pid = uid = fd = dev = ino = None
+    for line in output.splitlines():
+        field, value = line[:1], line[1:]
+        if field == 'p':
+            pid, fd, dev, ino = int(value), None, None, None
+        elif field == 'u':
+            uid = int(value)
+        elif field == 'f':
+            fd, dev, ino = value, None, None
+        elif field == 'D':
+            dev = int(value, 16)
+        elif field == 'i':
+            ino = int(value)
+        elif field == 'n' and value.endswith(DELETED_SUFFIX):
+            path = value[:-len(DELETED_SUFFIX)]
+            key = (pid, fd, dev, ino, path)
+            if fd is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            deleted_fds.append(DeletedFd(pid, uid, dev, ino, None, path))
+    return deleted_fds
+
+
+def filter_deleted_files(deleted_fds, path_filters):
+    """Deleted FDs whose path is one of `path_filters` or below one of them; all of them without filters."""
+    if not path_filters:
+        return deleted_fds
+    prefixes = tuple(path.rstrip('/') + '/' for path in path_filters)
+    paths = set(path_filters)
+    return [fd for fd in deleted_fds if fd.path is not None and (fd.path.startswith(prefixes) or fd.path in paths)]
+
+
+# host scan results per (collector, proc root), shared by every instance for shared_scan_interval seconds
+SHARED_SCANS = SharedCache()
+
+
+class DeletedFilesSummary:
+    """Deleted-file counts and bytes, globally, per uid and per pid.
 
-    logger = logging.getLogger(name)
+    Counts are per FD, like lsof. Bytes are per inode: a file held by several FDs or processes is
+    counted once in every scope it appears in.
+    """
 
-    fileHandler = logging.FileHandler(
-        '/var/log/datadog/dd-check-files-descriptors-{:%Y-%m-%d}.log'.format(datetime.now()))
-    fileHandler.setFormatter(formatter)
+    def __init__(self, deleted_fds):
+        self.count_by_uid = Counter()
+        self.bytes_total = 0
+        self.bytes_by_uid = Counter()
+        self.bytes_by_pid = Counter()
+        self.uid_by_pid = {}
 
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(fileHandler)
+        seen, seen_by_uid, seen_by_pid = set(), set(), set()
+        for fd in deleted_fds:
+            self.count_by_uid[fd.uid] += 1
+            self.uid_by_pid[fd.pid] = fd.uid
+            if fd.size is None:
+                continue
+            inode = (fd.dev, fd.ino)
+            if inode not in seen:
+                seen.add(inode)
+                self.bytes_total += fd.size
+            if (fd.uid, inode) not in seen_by_uid:
+                seen_by_uid.add((fd.uid, inode))
+                self.bytes_by_uid[fd.uid] += fd.size
+            if (fd.pid, inode) not in seen_by_pid:
+                seen_by_pid.add((fd.pid, inode))
+                self.bytes_by_pid[fd.pid] += fd.size
 
-    return logger, fileHandler
+    @property
+    def count_total(self):
+        return sum(self.count_by_uid.values())
 
+    def top_pids(self, count):
+        return heapq.nlargest(count, self.bytes_by_pid.items(), key=lambda item: item[1])
 
-def log_wrapper(method):
-    @wraps(method)
-    def _impl(self, *method_args, **method_kwargs):
-        self.log, fileHandler = get_logger()
-        method_output = method(self, *method_args, **method_kwargs)
-        self.log.removeHandler(fileHandler)
-        fileHandler.flush()
-        fileHandler.close()
-        return method_output
 
-    return _impl
+def get_process_name(pid, proc_root=PROC_ROOT):
+    try:
+        with open(os.path.join(proc_root, str(pid), 'comm'), 'r') as fh:
+            return fh.read().strip()
+    except OSError:
+        return 'unknown'
+
+
+def get_user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (KeyError, TypeError):
+        return str(uid)
+
+
+def get_uid(user):
+    try:
+        return pwd.getpwnam(user).pw_uid
+    except KeyError:
+        return None
+
+
+class MetricRecord:
+    __slots__ = ('name', 'value', 'tags')
+
+    def __init__(self, name, value, tags):
+        self.name = name
+        self.value = value
+        self.tags = tags
+
+
+class MetricBuffer:
+    """Metrics of one run, one record per series (name and tags); setting a series again replaces its value.
+
+    `tags` are added to every record.
+    """
+    __slots__ = ('records', 'tags')
+
+    def __init__(self, tags=None):
+        self.records = {}
+        self.tags = list(tags or [])
+
+    def set(self, name, value, tags=None):
+        tags = self.tags + list(tags or [])
+        self.records[(name, tuple(tags))] = MetricRecord(name, value, tags)
+
+    def get(self, name, tags=None):
+        record = self.records.get((name, tuple(self.tags + list(tags or []))))
+        return None if record is None else record.value
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
+
+    def flush(self, gauge):
+        """Submit every record once through `gauge` and return how many were submitted."""
+        for record in self.records.values():
+            if record.tags:
+                gauge(record.name, record.value, tags=record.tags)
+            else:
+                gauge(record.name, record.value)
+        return len(self.records)
 
 
 class FilesDescriptorsCheck(AgentCheck):
-    metrics_collected = {
-        'global': {},
-        'local': {}
-    }
+    metrics = None
+    fd_cache = None
+    runner = None
+    background = None
+    deep_scan = None
+    deep_scan_result = None
+    instrumentation = None
 
-    @staticmethod
-    def _exec_command(command, stdout=subprocess.PIPE, stdin=None, stderr=None):
-        return subprocess.Popen(shlex.split(command), stdin=stdin, stdout=stdout, stderr=stderr)
+    def _get_runner(self):
+        if self.runner is None:
+            self.runner = CommandRunner()
+        return self.runner
 
-    def _get_init_config(self):
-        user_list = self.init_config.get('mon_user_list', [])
+    @property
+    def log_level(self):
+        return (self.init_config or {}).get('log_level', LOG_LEVEL)
+
+    @property
+    def instrumentation_enabled(self):
+        return (self.init_config or {}).get('instrumentation', False)
+
+    def _get_init_config(self, instance=None):
+        """init_config with defaults, overridden by the instance's mon_user_list, tags and path_filters."""
+        instance = instance or {}
+        user_list = instance.get('mon_user_list', self.init_config.get('mon_user_list', []))
+        tags = instance.get('tags', self.init_config.get('tags', []))
+        path_filters = instance.get('path_filters', self.init_config.get('path_filters', []))
+        shared_scan_interval = self.init_config.get('shared_scan_interval', SHARED_SCAN_INTERVAL)
+        collector = self.init_config.get('deleted_files_collector', COLLECTOR_AUTO)
+        proc_root = self.init_config.get('proc_root', PROC_ROOT)
+        top_pids_count = self.init_config.get('top_pids_count', TOP_PIDS_COUNT)
+        fd_cache_max_age = self.init_config.get('fd_cache_max_age', FD_CACHE_MAX_AGE)
+        log_level = self.init_config.get('log_level', LOG_LEVEL)
+        command_timeout = self.init_config.get('command_timeout', TIMEOUT)
+        background_collection = self.init_config.get('background_collection', False)
+        collection_interval = self.init_config.get('collection_interval', COLLECTION_INTERVAL)
+        max_snapshot_age = self.init_config.get('max_snapshot_age', MAX_SNAPSHOT_AGE)
+        deep_scan_delta = self.init_config.get('deep_scan_delta', DEEP_SCAN_DELTA)
+        deep_scan_max_age = self.init_config.get('deep_scan_max_age', DEEP_SCAN_MAX_AGE)
+        fd_usage_top_count = self.init_config.get('fd_usage_top_count', FD_USAGE_TOP_COUNT)
+        fd_usage_users_only = self.init_config.get('fd_usage_users_only', False)
+        instrumentation = self.init_config.get('instrumentation', False)
+        process_snapshot_max_age = self.init_config.get('process_snapshot_max_age', SNAPSHOT_MAX_AGE)
 
         init_config = {
-            'mon_user_list': user_list
+            'mon_user_list': user_list,
+            'tags': tags,
+            'path_filters': path_filters,
+            'shared_scan_interval': shared_scan_interval,
+            'deleted_files_collector': collector,
+            'proc_root': proc_root,
+            'top_pids_count': top_pids_count,
+            'fd_cache_max_age': fd_cache_max_age,
+            'log_level': log_level,
+            'command_timeout': command_timeout,
+            'background_collection': background_collection,
+            'collection_interval': collection_interval,
+            'max_snapshot_age': max_snapshot_age,
+            'deep_scan_delta': deep_scan_delta,
+            'deep_scan_max_age': deep_scan_max_age,
+            'fd_usage_top_count': fd_usage_top_count,
+            'fd_usage_users_only': fd_usage_users_only,
+            'instrumentation': instrumentation,
+            'process_snapshot_max_age': process_snapshot_max_age
         }
 
         return init_config
@@ -74,47 +437,199 @@ class FilesDescriptorsCheck(AgentCheck):
             data_stats = fh.readline().split()
         return data_stats
 
-    def _set_metric(self, range, path, value):
-        self.metrics_collected[range].setdefault(path, value)
-        self.log.debug(f'_set_metric {range}: {path}:{value}')
+    def _set_metric(self, path, value, tags=None):
+        self.metrics.set(path, value, tags)
+
+    def _get_collector(self):
+        collector = self.init_config.get('deleted_files_collector', COLLECTOR_AUTO)
+        if collector == COLLECTOR_AUTO:
+            collector = COLLECTOR_PROC if has_proc_fd_access() else COLLECTOR_LSOF
+        return collector
+
+    @timed
+    def get_deleted_files(self, collector=None):
+        """Deleted FDs matching this instance's path_filters, from a host scan shared with the other instances."""
+        collector = collector or self._get_collector()
+        scan = self._get_deleted_files_proc if collector == COLLECTOR_PROC else self._get_deleted_files_lsof
+        interval = self.init_config.get('shared_scan_interval', SHARED_SCAN_INTERVAL)
+        if interval:
+            deleted_fds = SHARED_SCANS.get((collector, self.init_config.get('proc_root', PROC_ROOT)), interval, scan)
+        else:
+            deleted_fds = scan()
+        return filter_deleted_files(deleted_fds, self.init_config.get('path_filters'))
 
-    def get_size_of_deleted_files(self, user=None):
-        cmd_1 = f"sudo lsof -u {user}" if user else "sudo lsof"
-        cmd_2 = "grep deleted"
-        cmd_3 = "wc -l"
+    def _get_process_snapshot(self):
+        return get_process_snapshot(self.init_config.get('proc_root', PROC_ROOT),
+                                    max_age=self.init_config.get('process_snapshot_max_age', SNAPSHOT_MAX_AGE))
+
+    def _warn_denied(self, denied):
+        if denied:
+            self.log.warning(f'FDs of {len(denied)} processes not readable (needs CAP_DAC_READ_SEARCH and '
+                             f'CAP_SYS_PTRACE), their deleted files are not counted: {sorted(denied)[:20]}')
+
+    def _scan_deleted_files(self, proc_root):
+        fd_cache_max_age = self.init_config.get('fd_cache_max_age', FD_CACHE_MAX_AGE)
+        if not fd_cache_max_age:
+            self.fd_cache = None
+            denied = []
+            deleted_fds = scan_deleted_files(self._get_process_snapshot(), proc_root=proc_root, denied=denied)
+            self._warn_denied(denied)
+            return deleted_fds
+
+        if self.fd_cache is None:
+            self.fd_cache = FdInventoryCache(max_age=fd_cache_max_age)
+        self.fd_cache.max_age = fd_cache_max_age
+        deleted_fds = self.fd_cache.scan(self._get_process_snapshot(), proc_root=proc_root)
+        self.log.debug(f'fd cache: {self.fd_cache.rescanned}/{len(self.fd_cache.entries)} processes rescanned')
+        self._warn_denied(self.fd_cache.denied)
+        return deleted_fds
+
+    def _get_deleted_files_proc(self):
         try:
-            pipe_1 = self._exec_command(command=cmd_1)
-            pipe_2 = self._exec_command(command=cmd_2, stdin=pipe_1.stdout)
-            pipe_3 = self._exec_command(command=cmd_3, stdin=pipe_2.stdout)
+            deleted_fds = self._scan_deleted_files(proc_root=self.init_config.get('proc_root', PROC_ROOT))
+        except Exception as exc:
+            self.log.exception(str(exc))
+            raise GetDeletedStatsException
+        else:
+            return deleted_fds
 
-            stats_cnt = pipe_3.communicate()[0].decode()
+    def _get_deleted_files_lsof(self):
+        # -K i: one entry per process rather than one per thread
+        cmd = "sudo lsof -w -K i -F pufDin"
+        try:
+            result = self._get_runner().run(cmd, timeout=self.init_config.get('command_timeout', TIMEOUT))
         except Exception as exc:
             self.log.exception(str(exc))
             raise GetDeletedStatsException
+        if result.timed_out or result.truncated:
+            self.log.error(f'{cmd} output incomplete: timed out {result.timed_out}, truncated {result.truncated}')
+            raise GetDeletedStatsException
+        return parse_lsof_deleted_files(result.stdout.decode())
+
+    def _set_top_pids_metrics(self, summary):
+        proc_root = self.init_config.get('proc_root', PROC_ROOT)
+        for pid, size in summary.top_pids(self.init_config.get('top_pids_count', TOP_PIDS_COUNT)):
+            tags = [f'pid:{pid}', f'user:{get_user_name(summary.uid_by_pid[pid])}',
+                    f'command:{get_process_name(pid, proc_root)}']
+            self._set_metric(path='dd.check_files_descriptors.top_pids.deleted_files.bytes', value=size, tags=tags)
+
+    def _set_fd_usage_metrics(self, fd_usage):
+        proc_root = self.init_config.get('proc_root', PROC_ROOT)
+        for usage in fd_usage:
+            tags = [f'pid:{usage.pid}', f'user:{get_user_name(usage.uid)}',
+                    f'command:{get_process_name(usage.pid, proc_root)}']
+            self._set_metric(path='dd.check_files_descriptors.process.open_files', value=usage.fds, tags=tags)
+            self._set_metric(path='dd.check_files_descriptors.process.open_files.limit', value=usage.limit, tags=tags)
+            self._set_metric(path='dd.check_files_descriptors.process.open_files.utilization',
+                             value=usage.fds / usage.limit, tags=tags)
+
+    def _get_deleted_files_summary(self, collector, fd_data_stats, now=None):
+        """Summary of deleted files, re-scanned only when the deep scan schedule says so if deep_scan_delta is set."""
+        deep_scan_delta = self.init_config.get('deep_scan_delta', DEEP_SCAN_DELTA)
+        if not deep_scan_delta:
+            self.deep_scan = self.deep_scan_result = None
+            return DeletedFilesSummary(self.get_deleted_files(collector))
+
+        deep_scan_max_age = self.init_config.get('deep_scan_max_age', DEEP_SCAN_MAX_AGE)
+        if self.deep_scan is None:
+            self.deep_scan = DeepScanSchedule(delta=deep_scan_delta, max_age=deep_scan_max_age)
+        self.deep_scan.delta, self.deep_scan.max_age = deep_scan_delta, deep_scan_max_age
+
+        now = time.monotonic() if now is None else now
+        open_files = self._get_size_of_current_open_files(fd_data_stats)
+        if self.deep_scan_result is None or self.deep_scan_result[0] != collector or \
+                self.deep_scan.due(open_files, now):
+            self.deep_scan_result = (collector, DeletedFilesSummary(self.get_deleted_files(collector)))
+            self.deep_scan.record(open_files, now)
         else:
-            return int(stats_cnt)
+            self.log.debug(f'deleted files scan skipped, file-nr {open_files} vs {self.deep_scan.open_files}')
+        return self.deep_scan_result[1]
+
+    @timed
+    def get_fd_usage(self):
+        """Top processes by FD usage against their soft limit, [] unless fd_usage_top_count is set."""
+        count = self.init_config.get('fd_usage_top_count', FD_USAGE_TOP_COUNT)
+        if not count:
+            return []
+        uids = None
+        if self.init_config.get('fd_usage_users_only', False):
+            uids = {get_uid(user) for user in self.init_config.get('mon_user_list', [])}
+        return scan_fd_usage(self._get_process_snapshot(), proc_root=self.init_config.get('proc_root', PROC_ROOT),
+                             count=count, uids=uids)
 
-    def collect(self):
+    def fetch(self):
+        """The slow part of a run: file-nr, the collector used, deleted files and per-process FD usage."""
+        with phase(self, 'get_global_stats'):
+            fd_data_stats = self._get_global_stats()
+        collector = self._get_collector()
+        return (fd_data_stats, collector, self._get_deleted_files_summary(collector, fd_data_stats),
+                self.get_fd_usage())
+
+    def collect(self, data=None):
         self.init_config = self._get_init_config()
+        self.metrics = MetricBuffer(tags=self.init_config.get('tags'))
         users = self.init_config.get('mon_user_list')
-        fd_data_stats = self._get_global_stats()
+        fd_data_stats, collector, summary, fd_usage = self.fetch() if data is None else data
 
-        self._set_metric(range='global', path='dd.check_files_descriptors.global.current_size.count',
+        self._set_metric(path='dd.check_files_descriptors.global.current_size.count',
                          value=self._get_size_of_current_open_files(fd_data_stats))
-        self._set_metric(range='global', path='dd.check_files_descriptors.global.limit_size.count',
+        self._set_metric(path='dd.check_files_descriptors.global.limit_size.count',
                          value=self._get_limit_size(fd_data_stats))
-        self._set_metric(range='global', path='dd.check_files_descriptors.global.deleted_files.count',
-                         value=self.get_size_of_deleted_files())
-        [self._set_metric(range='local', path=f'dd.check_files_descriptors.local.{user}.deleted_files.count',
-                          value=self.get_size_of_deleted_files(user)) for user in users]
 
+        with_sizes = collector == COLLECTOR_PROC
+        self._set_metric(path='dd.check_files_descriptors.global.deleted_files.count',
+                         value=summary.count_total)
+        if self.deep_scan is not None and self.deep_scan.scanned_at is not None:
+            self._set_metric(path='dd.check_files_descriptors.global.deleted_files.scan_age',
+                             value=time.monotonic() - self.deep_scan.scanned_at)
+        if with_sizes:
+            self._set_metric(path='dd.check_files_descriptors.global.deleted_files.bytes',
+                             value=summary.bytes_total)
+        for user in users:
+            uid = get_uid(user)
+            self._set_metric(path=f'dd.check_files_descriptors.local.{user}.deleted_files.count',
+                             value=summary.count_by_uid.get(uid, 0))
+            if with_sizes:
+                self._set_metric(path=f'dd.check_files_descriptors.local.{user}.deleted_files.bytes',
+                                 value=summary.bytes_by_uid.get(uid, 0))
+        if with_sizes:
+            self._set_top_pids_metrics(summary)
+        self._set_fd_usage_metrics(fd_usage)
+
+    @timed
     def report(self):
-        [self.log.debug(f'report: {metric_key}{metric_value}') for region in ('global', 'local') for
-         metric_key, metric_value in self.metrics_collected[region].items()]
-        [self.gauge(metric_key, metric_value) for region in ('global', 'local') for metric_key, metric_value in
-         self.metrics_collected[region].items()]
+        start = time.monotonic()
+        count = self.metrics.flush(self.gauge)
+        self.log.debug(f'report: {count} metrics')
+        self.gauge('dd.check_files_descriptors.metrics.count', count, tags=self.metrics.tags)
+        self.gauge('dd.check_files_descriptors.metrics.emit_duration', time.monotonic() - start,
+                   tags=self.metrics.tags)
+
+    def _get_background_data(self):
+        """Start the background collection if needed and return its last snapshot, None when there is none."""
+        if self.background is None:
+            self.background = BackgroundCollector(
+                self.fetch, interval=self.init_config.get('collection_interval', COLLECTION_INTERVAL),
+                name='dd-check-files-descriptors')
+            self.background.start()
+        return self.background.current(self, 'dd.check_files_descriptors',
+                                       max_age=self.init_config.get('max_snapshot_age', MAX_SNAPSHOT_AGE))
 
-    @log_wrapper
+    def cancel(self):
+        if self.background is not None:
+            self.background.stop()
+
+    @instrumented(LOG_FILE, 'dd.check_files_descriptors')
     def check(self, instance):
-        self.collect()
-        self.report()
+        self.init_config = self._get_init_config(instance)
+        try:
+            if not self.init_config.get('background_collection', False):
+                self.collect()
+            else:
+                data = self._get_background_data()
+                if data is None:
+                    return
+                self.collect(data)
+            self.report()
+        finally:
+            self._get_runner().flush_metrics(self, 'dd.check_files_descriptors')
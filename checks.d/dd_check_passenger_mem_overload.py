@@ -1,118 +1,550 @@
-import logging
-import shlex
-import subprocess
-from datetime import datetime
-from functools import wraps
+import heapq
+import os
+import re
+import threading
+import time
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from datadog_checks.base import AgentCheck
 
+from dd_instrumentation import instrumented, phase, timed
+from dd_logging import LOG_LEVEL
+
+from dd_passenger_api import PassengerApiClient, PassengerApiException
+from dd_process_snapshot import PAGE_SIZE, SNAPSHOT_MAX_AGE, get_process_snapshot, read_proc_file
+from dd_subprocess import CommandRunner
+
 # content of the special variable __version__ will be shown in the Agent status page
 __version__ = "1.0.0"
 
+LOG_FILE = '/var/log/passenger/passenger-mem-overloaded.log'
 
-class GetProcessessOverloadedException(Exception):
-    pass
-
+DETACH_CONCURRENCY = 4
+DETACH_TIMEOUT = 30
+DETACH_IN_FLIGHT_TTL = 300
 
-class GetInstanceConfigException(Exception):
-    def __init__(self, message):
-        self.message = message
+DETACHED = 'detached'
+KILLED = 'killed'
+FAILED = 'failed'
 
+DetachResult = namedtuple('DetachResult', ['pid', 'outcome', 'status', 'duration'])
 
-def get_logger(name=__name__):
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
+PROC_ROOT = '/proc'
+# Passenger sets worker titles like "Passenger RubyApp: /var/www/app (production)"; preloaders are not matched.
+PROCESS_PATTERN = r'^Passenger \w+App: '
 
-    logger = logging.getLogger(name)
+MAX_BUDGET_DETACH = 4
+TREND_WINDOW = 0
+TREND_MIN_SAMPLES = 3
+TREND_HORIZON = 300
 
-    fileHandler = logging.FileHandler(
-        '/var/log/passenger/passenger-mem-overloaded-{:%Y-%m-%d}.log'.format(datetime.now()))
-    fileHandler.setFormatter(formatter)
+ProcessMemory = namedtuple('ProcessMemory', ['pid', 'rss', 'pss', 'private', 'starttime'], defaults=(None,))
 
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(fileHandler)
 
-    return logger, fileHandler
+class GetProcessessOverloadedException(Exception):
+    pass
 
 
-def log_wrapper(method):
-    @wraps(method)
-    def _impl(self, *method_args, **method_kwargs):
-        self.log, fileHandler = get_logger()
-        method_output = method(self, *method_args, **method_kwargs)
-        self.log.removeHandler(fileHandler)
-        fileHandler.flush()
-        fileHandler.close()
-        return method_output
+class KillProcessException(Exception):
+    pass
 
-    return _impl
 
+class DetachTimeoutException(Exception):
+    pass
 
-class PassengerMemOverloadCheck(AgentCheck):
 
-    @staticmethod
-    def _exec_command(command, stdout=subprocess.PIPE, stdin=None, stderr=subprocess.DEVNULL):
-        return subprocess.Popen(shlex.split(command), stdin=stdin, stdout=stdout, stderr=stderr)
+class GetInstanceConfigException(Exception):
+    def __init__(self, message):
+        self.message = message
 
-    def get_processes_overloaded(self):
-        try:
-            cmd_pipe_1 = "sudo passenger-memory-stats"
-            cmd_pipe_2 = "grep AppPreloader"
-            cmd_pipe_3 = 'awk \'{{if ($4 > {0}) print $1}}\''.format(self.threshold)
 
-            pipe_1 = self._exec_command(command=cmd_pipe_1)
-            pipe_2 = self._exec_command(command=cmd_pipe_2, stdin=pipe_1.stdout)
-            pipe_3 = self._exec_command(command=cmd_pipe_3, stdin=pipe_2.stdout)
+def read_process_memory(pid, starttime, proc_root=PROC_ROOT):
+    """RSS, PSS and private memory of a process in bytes, with its `starttime` from the process snapshot.
+
+    smaps_rollup needs ptrace access to the process; without it the world-readable statm is used, which
+    has no PSS and approximates private memory as resident minus shared pages.
+    """
+    pid_dir = os.path.join(proc_root, str(pid))
+    try:
+        fields = dict(line.split()[:2] for line in read_proc_file(os.path.join(pid_dir, 'smaps_rollup')).splitlines()
+                      if line.endswith(b' kB'))
+    except PermissionError:
+        fields = None
+    except FileNotFoundError:
+        if not os.path.isdir(pid_dir):
+            raise
+        fields = None
+
+    if fields:
+        return ProcessMemory(int(pid), int(fields[b'Rss:']) * 1024, int(fields[b'Pss:']) * 1024,
+                             (int(fields[b'Private_Clean:']) + int(fields[b'Private_Dirty:'])) * 1024, starttime)
+
+    resident, shared = (int(value) for value in read_proc_file(os.path.join(pid_dir, 'statm')).split()[1:3])
+    return ProcessMemory(int(pid), resident * PAGE_SIZE, None, (resident - shared) * PAGE_SIZE, starttime)
+
+
+def read_meminfo(proc_root=PROC_ROOT):
+    """/proc/meminfo fields in bytes."""
+    with open(os.path.join(proc_root, 'meminfo'), 'r') as fh:
+        return {fields[0].rstrip(':'): int(fields[1]) * 1024 for fields in (line.split() for line in fh)
+                if len(fields) == 3}
+
+
+def select_processes_to_free(processes, bytes_to_free, max_count=None):
+    """Fewest processes whose private memory adds up to at least `bytes_to_free`, largest first.
+
+    Only as many entries are popped from the heap as are selected. When `max_count` processes, or all
+    of them, are not enough, nothing is returned: detaching workers cannot bring usage under the budget
+    then, and detaching them anyway would only restart them in a loop.
+    """
+    heap = [(-process.private, process.pid, process) for process in processes]
+    heapq.heapify(heap)
+    selected = []
+    freed = 0
+    while freed < bytes_to_free:
+        if not heap or max_count is not None and len(selected) >= max_count:
+            return []
+        process = heapq.heappop(heap)[2]
+        selected.append(process)
+        freed += process.private
+    return selected
+
+
+class MemorySamples:
+    """Fixed-size ring buffer of (timestamp, bytes) samples of one process."""
+    __slots__ = ('times', 'values', 'index', 'count')
+
+    def __init__(self, size):
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.index = 0
+        self.count = 0
+
+    def add(self, timestamp, value):
+        self.times[self.index] = timestamp
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def slope(self):
+        """Least-squares growth rate in bytes per second, 0 with fewer than two distinct timestamps."""
+        if self.count < 2:
+            return 0.0
+        times, values = self.times[:self.count], self.values[:self.count]
+        mean_time = sum(times) / self.count
+        mean_value = sum(values) / self.count
+        variance = sum((t - mean_time) ** 2 for t in times)
+        if not variance:
+            return 0.0
+        return sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values)) / variance
+
+
+class MemoryTrendTracker:
+    """Private memory samples per process kept across check runs, keyed by (pid, starttime).
+
+    Processes missing from a run are evicted, so memory use is bounded by the number of live workers
+    times `window` samples.
+    """
+
+    def __init__(self, window, min_samples=TREND_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+
+    def update(self, processes, now=None):
+        """Record one sample per process and return {pid: slope} for processes with enough samples."""
+        now = time.monotonic() if now is None else now
+        samples, slopes = {}, {}
+        for process in processes:
+            key = (process.pid, process.starttime)
+            process_samples = self.samples.get(key) or MemorySamples(self.window)
+            process_samples.add(now, process.private)
+            samples[key] = process_samples
+            if process_samples.count >= self.min_samples:
+                slopes[process.pid] = process_samples.slope()
+        self.samples = samples
+        return slopes
+
+
+class DetachRegistry:
+    """Processes being detached by any check of the agent process, keyed by (pid, starttime).
+
+    A claim lasts `ttl` seconds, long enough for a detached worker to finish its requests and exit, so
+    a later run does not detach it again and escalate to kill -9. The start time makes a reused PID a
+    new process. A failed detach is released so the next run retries it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = {}
+
+    def claim(self, keys, ttl, now=None):
+        """Claim the keys that are not in flight; return (claimed keys, keys already in flight)."""
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            self.entries = {key: claimed_at for key, claimed_at in self.entries.items() if now - claimed_at < ttl}
+            claimed, in_flight = [], []
+            for key in keys:
+                if key in self.entries:
+                    in_flight.append(key)
+                else:
+                    self.entries[key] = now
+                    claimed.append(key)
+            return claimed, in_flight
+
+    def release(self, keys):
+        with self._lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+DETACH_REGISTRY = DetachRegistry()
+# held by the check run detaching processes; another run finding it taken detaches nothing
+DETACH_RUN_LOCK = threading.Lock()
+# guards api_client, which the detach threads of a run share and drop when a request fails
+API_CLIENT_LOCK = threading.Lock()
 
-            pids_list = pipe_3.communicate()[0].decode().split()
 
-            if pids_list: self.log.info('List processess to detach: {}'.format(pids_list))
+class PassengerMemOverloadCheck(AgentCheck):
+    use_api = True
+    instance_dir = None
+    api_client = None
+    dropped_api_clients = ()
+    detach_concurrency = DETACH_CONCURRENCY
+    detach_timeout = DETACH_TIMEOUT
+    detach_in_flight_ttl = DETACH_IN_FLIGHT_TTL
+    proc_root = PROC_ROOT
+    process_pattern = PROCESS_PATTERN
+    trend_window = TREND_WINDOW
+    trend_horizon = TREND_HORIZON
+    trend_tracker = None
+    memory_budget = None
+    memory_budget_dry_run = False
+    max_budget_detach = MAX_BUDGET_DETACH
+    log_level = LOG_LEVEL
+    process_snapshot_max_age = SNAPSHOT_MAX_AGE
+    runner = None
+    instrumentation_enabled = False
+    instrumentation = None
+
+    def _get_runner(self):
+        if self.runner is None:
+            self.runner = CommandRunner()
+        return self.runner
+
+    def _run_command(self, command, timeout=None):
+        """Run a command for at most `timeout` seconds, detach_timeout by default; a timed out command is
+        killed and reported on stderr.
+        """
+        result = self._get_runner().run(command, timeout=self.detach_timeout if timeout is None else timeout)
+        return result.stdout, result.stderr
+
+    def _time_left(self, pid_process, deadline):
+        """Seconds left before `deadline` to detach `pid_process`; raises DetachTimeoutException when none."""
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+            raise DetachTimeoutException(f'Could not detach process {pid_process} within {self.detach_timeout}s')
+        return time_left
+
+    @timed
+    def get_processes_memory(self):
+        """Memory of the processes whose command line, in the shared process snapshot, matches process_pattern."""
+        pattern = re.compile(self.process_pattern)
+        processes = []
+        try:
+            snapshot = get_process_snapshot(self.proc_root, max_age=self.process_snapshot_max_age)
+            for row in snapshot.matching(pattern):
+                try:
+                    processes.append(read_process_memory(snapshot.pids[row], snapshot.starttimes[row],
+                                                         proc_root=self.proc_root))
+                except OSError:
+                    continue
         except Exception as exc:
             self.log.exception(exc)
             raise GetProcessessOverloadedException
         else:
-            return pids_list
-
-    def _kill_process(self, pid_process):
+            return processes
+
+    @timed
+    def get_processes_overloaded(self, processes):
+        if self.threshold is None:
+            return []
+        threshold_bytes = float(self.threshold) * 1024 * 1024
+        pids_list = [str(process.pid) for process in processes if process.private > threshold_bytes]
+
+        if pids_list: self.log.info('List processess to detach: {}'.format(pids_list))
+
+        return pids_list
+
+    @timed
+    def get_processes_trending(self, processes):
+        """PIDs whose private memory, extrapolated trend_horizon seconds ahead, would cross the threshold."""
+        if not self.trend_window or self.threshold is None:
+            self.trend_tracker = None
+            return []
+        if self.trend_tracker is None or self.trend_tracker.window != self.trend_window:
+            self.trend_tracker = MemoryTrendTracker(window=self.trend_window)
+
+        threshold_bytes = float(self.threshold) * 1024 * 1024
+        slopes = self.trend_tracker.update(processes)
+        pids_list = []
+        for process in processes:
+            slope = slopes.get(process.pid)
+            if slope is None:
+                continue
+            self.gauge('dd.check_passenger_mem_overload.process.private.growth_rate', slope,
+                       tags=[f'pid:{process.pid}'])
+            if slope > 0 and process.private <= threshold_bytes < process.private + slope * self.trend_horizon:
+                pids_list.append(str(process.pid))
+
+        if pids_list:
+            self.log.info('List processess to detach ahead of threshold: {}'.format(pids_list))
+
+        return pids_list
+
+    @timed
+    def get_processes_over_budget(self, processes, pids_selected):
+        """PIDs to detach so that host memory in use (MemTotal - MemAvailable) drops under memory_budget MB.
+
+        Memory of processes already selected for detaching is counted as freed. When max_budget_detach
+        workers cannot free enough, e.g. because another service holds the memory, nothing is selected
+        and budget.unreachable is 1. The selection is always reported as metrics; in dry-run mode it is
+        not detached.
+        """
+        if self.memory_budget is None:
+            return []
+
+        meminfo = read_meminfo(self.proc_root)
+        budget_bytes = float(self.memory_budget) * 1024 * 1024
+        used = meminfo['MemTotal'] - meminfo['MemAvailable']
+        projected = used - sum(process.private for process in processes if str(process.pid) in pids_selected)
+        candidates = [process for process in processes if str(process.pid) not in pids_selected]
+        selected = select_processes_to_free(candidates, projected - budget_bytes, self.max_budget_detach)
+        freed = sum(process.private for process in selected)
+        unreachable = projected > budget_bytes and not selected
+        if unreachable:
+            self.log.warning(f'Detaching at most {self.max_budget_detach} workers cannot bring memory in use '
+                             f'under the budget ({projected / 1024 / 1024:.0f} MB > {self.memory_budget} MB), '
+                             f'detaching none')
+
+        self.gauge('dd.check_passenger_mem_overload.host.memory.used', used)
+        self.gauge('dd.check_passenger_mem_overload.budget.limit', budget_bytes)
+        self.gauge('dd.check_passenger_mem_overload.budget.selected.count', len(selected))
+        self.gauge('dd.check_passenger_mem_overload.budget.selected.bytes', freed)
+        self.gauge('dd.check_passenger_mem_overload.budget.projected_used', projected - freed)
+        self.gauge('dd.check_passenger_mem_overload.budget.unreachable', int(unreachable))
+        for process in selected:
+            self.gauge('dd.check_passenger_mem_overload.budget.selected.private', process.private,
+                       tags=[f'pid:{process.pid}'])
+
+        pids_list = [str(process.pid) for process in selected]
+        if pids_list:
+            self.log.info('List processess over memory budget{}: {}'.format(
+                ' (dry run)' if self.memory_budget_dry_run else '', pids_list))
+
+        return [] if self.memory_budget_dry_run else pids_list
+
+    @timed
+    def report_processes_memory(self, processes):
+        self.gauge('dd.check_passenger_mem_overload.processes.count', len(processes))
+        for process in processes:
+            self.histogram('dd.check_passenger_mem_overload.process.rss', process.rss)
+            self.histogram('dd.check_passenger_mem_overload.process.private', process.private)
+            if process.pss is not None:
+                self.histogram('dd.check_passenger_mem_overload.process.pss', process.pss)
+
+    def _kill_process(self, pid_process, deadline):
         kill_cmd = "sudo kill -9 {}".format(pid_process)
-        pipe = self._exec_command(kill_cmd, stderr=subprocess.PIPE)
-        pid_status, pid_err = pipe.communicate()
+        pid_status, pid_err = self._run_command(kill_cmd, timeout=self._time_left(pid_process, deadline))
 
-        if pid_err: self.log.error(pid_err)
+        if pid_err:
+            self.log.error(pid_err)
+            raise KillProcessException(pid_err)
 
         return pid_status if pid_status else f'Process {pid_process} killed'
 
-    def detach_process(self, pid_process, sig_kill=None):
+    def _get_api_client(self):
+        with API_CLIENT_LOCK:
+            if self.use_api and self.api_client is None:
+                try:
+                    self.api_client = PassengerApiClient(instance_dir=self.instance_dir)
+                except PassengerApiException as exc:
+                    self.log.debug(f'Passenger API not available, using passenger-config: {exc}')
+            return self.api_client
+
+    def _drop_api_client(self, client):
+        """Stop using `client` after a failed request; it is closed by _close_dropped_api_clients().
+
+        Other detach threads may still be sending requests through it, so it is not closed here.
+        """
+        with API_CLIENT_LOCK:
+            if self.api_client is client:
+                self.api_client = None
+                self.dropped_api_clients = self.dropped_api_clients + (client,)
+
+    def _close_dropped_api_clients(self):
+        """Close the API clients dropped since the last call, once no detach thread uses them any more."""
+        with API_CLIENT_LOCK:
+            dropped, self.dropped_api_clients = self.dropped_api_clients, ()
+        for client in dropped:
+            client.close()
+
+    def _detach_process_api(self, pid_process, deadline):
+        """Detach through the Passenger core API; None means the API could not be used."""
+        client = self._get_api_client()
+        if client is None:
+            return None
+        try:
+            return client.detach_process(pid_process, timeout=self._time_left(pid_process, deadline))
+        except PassengerApiException as exc:
+            self.log.warning(f'Passenger API request failed, using passenger-config: {exc}')
+            self._drop_api_client(client)
+            return None
+
+    def detach_process(self, pid_process, sig_kill=None, deadline=None):
+        """Detach `pid_process` through the API, then passenger-config, then kill -9, each step only when the
+        previous one failed. All steps share one deadline, detach_timeout seconds after the first one.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.detach_timeout
+        if sig_kill is None:
+            detached = self._detach_process_api(pid_process, deadline)
+            if detached:
+                return f'Process {pid_process} detached.'
+            if detached is False:
+                return self.detach_process(pid_process=pid_process, sig_kill=True, deadline=deadline)
+
         detach_cmd = "sudo passenger-config detach-process {}".format(pid_process)
 
-        pipe = self._exec_command(command=detach_cmd, stderr=subprocess.PIPE)
-        pid_status, pid_err = pipe.communicate()
+        pid_status, pid_err = self._run_command(detach_cmd, timeout=self._time_left(pid_process, deadline))
         self.log.debug('stdout: {}, stderr: {}'.format(pid_status, pid_err))
 
         if pid_err and sig_kill is None:
-            pid_status = self.detach_process(pid_process=pid_process, sig_kill=True)
+            pid_status = self.detach_process(pid_process=pid_process, sig_kill=True, deadline=deadline)
 
         elif pid_err and sig_kill:
             self.log.debug("SIGKILL to PID: {}".format(pid_process))
-            pid_status = self._kill_process(pid_process=pid_process)
+            pid_status = self._kill_process(pid_process=pid_process, deadline=deadline)
 
         return pid_status
 
-    @log_wrapper
-    def collect(self):
+    def _detach_with_outcome(self, pid_process):
+        start = time.monotonic()
+        try:
+            with phase(self, 'detach_process'):
+                pid_status = self.detach_process(pid_process)
+        except Exception as exc:
+            self.log.exception(exc)
+            outcome, pid_status = FAILED, str(exc)
+        else:
+            outcome = KILLED if pid_status == f'Process {pid_process} killed' else DETACHED
+        return DetachResult(pid_process, outcome, pid_status, time.monotonic() - start)
+
+    @timed
+    def detach_processes(self, pid_processes):
+        """Detach PIDs in parallel, at most detach_concurrency at a time, and return one DetachResult per PID."""
+        if not pid_processes:
+            return []
 
-        pid_processes_overloaded_list = self.get_processes_overloaded()
-        detached_processes_list = [self.detach_process(pid_process) for pid_process in pid_processes_overloaded_list]
+        self._get_api_client()
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.detach_concurrency, len(pid_processes))) as executor:
+                return list(executor.map(self._detach_with_outcome, pid_processes))
+        finally:
+            self._close_dropped_api_clients()
+
+    def detach_unclaimed_processes(self, pid_processes, processes):
+        """Detach the PIDs that no other run is detaching, unless another run is detaching right now.
+
+        Reports the PIDs left out because they are in flight as detach.redundant.count, and the PIDs left
+        out because another run holds the detach lock as detach.skipped.count.
+        """
+        if not DETACH_RUN_LOCK.acquire(blocking=False):
+            if pid_processes:
+                self.log.warning(f'Another detach run is in progress, skipping: {pid_processes}')
+            self.gauge('dd.check_passenger_mem_overload.detach.skipped.count', len(pid_processes))
+            self.gauge('dd.check_passenger_mem_overload.detach.redundant.count', 0)
+            self.gauge('dd.check_passenger_mem_overload.detach.in_flight.count', len(DETACH_REGISTRY))
+            return []
 
-        self.gauge('dd.check_passenger_mem_overload.detached_processess.count', len(detached_processes_list))
+        try:
+            starttimes = {str(process.pid): process.starttime for process in processes}
+            claimed, in_flight = DETACH_REGISTRY.claim([(pid, starttimes.get(pid)) for pid in pid_processes],
+                                                       ttl=self.detach_in_flight_ttl)
+            if in_flight:
+                self.log.info(f'Already being detached, skipping: {[pid for pid, _ in in_flight]}')
+            self.gauge('dd.check_passenger_mem_overload.detach.skipped.count', 0)
+            self.gauge('dd.check_passenger_mem_overload.detach.redundant.count', len(in_flight))
+
+            detach_results = self.detach_processes([pid for pid, _ in claimed])
+            DETACH_REGISTRY.release([(result.pid, starttimes.get(result.pid)) for result in detach_results
+                                     if result.outcome == FAILED])
+        finally:
+            DETACH_RUN_LOCK.release()
+        self.gauge('dd.check_passenger_mem_overload.detach.in_flight.count', len(DETACH_REGISTRY))
+        return detach_results
+
+    @instrumented(LOG_FILE, 'dd.check_passenger_mem_overload')
+    def collect(self):
+        try:
+            self._collect()
+        finally:
+            self._get_runner().flush_metrics(self, 'dd.check_passenger_mem_overload')
+
+    def _collect(self):
+        processes = self.get_processes_memory()
+        self.report_processes_memory(processes)
+        pid_processes_overloaded_list = self.get_processes_overloaded(processes) + \
+            self.get_processes_trending(processes)
+        pid_processes_overloaded_list += self.get_processes_over_budget(processes, set(pid_processes_overloaded_list))
+
+        start = time.monotonic()
+        detach_results = self.detach_unclaimed_processes(pid_processes_overloaded_list, processes)
+        run_duration = time.monotonic() - start
+
+        self.gauge('dd.check_passenger_mem_overload.detached_processess.count', len(detach_results))
+        for outcome in (DETACHED, KILLED, FAILED):
+            self.gauge(f'dd.check_passenger_mem_overload.detach.{outcome}.count',
+                       sum(1 for result in detach_results if result.outcome == outcome))
+        for result in detach_results:
+            self.histogram('dd.check_passenger_mem_overload.detach.duration', result.duration,
+                           tags=[f'outcome:{result.outcome}'])
+        if detach_results:
+            self.histogram('dd.check_passenger_mem_overload.detach.run_duration', run_duration)
 
     def get_instance_config(self, instance):
         threshold = instance.get('threshold', None)
+        memory_budget = instance.get('memory_budget', None)
 
-        if threshold is None:
-            raise GetInstanceConfigException(message='A threshold must be specified in cfg')
+        if threshold is None and memory_budget is None:
+            raise GetInstanceConfigException(message='A threshold or a memory_budget must be specified in cfg')
 
         config = {
-            'threshold': threshold
+            'threshold': threshold,
+            'passenger_api': instance.get('passenger_api', True),
+            'passenger_instance_dir': instance.get('passenger_instance_dir', None),
+            'detach_concurrency': instance.get('detach_concurrency', DETACH_CONCURRENCY),
+            'detach_timeout': instance.get('detach_timeout', DETACH_TIMEOUT),
+            'detach_in_flight_ttl': instance.get('detach_in_flight_ttl', DETACH_IN_FLIGHT_TTL),
+            'proc_root': instance.get('proc_root', PROC_ROOT),
+            'process_pattern': instance.get('process_pattern', PROCESS_PATTERN),
+            'trend_window': instance.get('trend_window', TREND_WINDOW),
+            'trend_horizon': instance.get('trend_horizon', TREND_HORIZON),
+            'memory_budget': memory_budget,
+            'memory_budget_dry_run': instance.get('memory_budget_dry_run', False),
+            'max_budget_detach': instance.get('max_budget_detach', MAX_BUDGET_DETACH),
+            'log_level': instance.get('log_level', LOG_LEVEL),
+            'instrumentation': instance.get('instrumentation', False),
+            'process_snapshot_max_age': instance.get('process_snapshot_max_age', SNAPSHOT_MAX_AGE)
         }
 
         return config
@@ -120,5 +552,20 @@ class PassengerMemOverloadCheck(AgentCheck):
     def check(self, instance):
         config = self.get_instance_config(instance)
         self.threshold = config.get('threshold')
+        self.use_api = config.get('passenger_api')
+        self.instance_dir = config.get('passenger_instance_dir')
+        self.detach_concurrency = config.get('detach_concurrency')
+        self.detach_timeout = config.get('detach_timeout')
+        self.detach_in_flight_ttl = config.get('detach_in_flight_ttl')
+        self.proc_root = config.get('proc_root')
+        self.process_pattern = config.get('process_pattern')
+        self.trend_window = config.get('trend_window')
+        self.trend_horizon = config.get('trend_horizon')
+        self.memory_budget = config.get('memory_budget')
+        self.memory_budget_dry_run = config.get('memory_budget_dry_run')
+        self.max_budget_detach = config.get('max_budget_detach')
+        self.log_level = config.get('log_level')
+        self.instrumentation_enabled = config.get('instrumentation')
+        self.process_snapshot_max_age = config.get('process_snapshot_max_age')
 
         self.collect()
@@ -1,101 +1,583 @@
+import codecs
 import json
-import logging
-import shlex
-import subprocess
-from datetime import datetime
-from functools import wraps
+import math
+import re
+import threading
+import time
+from array import array
+from xml.etree import ElementTree
 
 from datadog_checks.base import AgentCheck
 
+from dd_background import COLLECTION_INTERVAL, MAX_SNAPSHOT_AGE, BackgroundCollector
+from dd_instrumentation import instrumented, phase, timed
+from dd_logging import LOG_LEVEL
+
+from dd_passenger_api import PassengerApiClient, PassengerApiException
+from dd_snapshot_ring import MIN_INTERVAL, RING_SIZE, DumpCompressor, SnapshotRecorder
+from dd_subprocess import TIMEOUT, CommandRunner
+
 # content of the special variable __version__ will be shown in the Agent status page
 __version__ = "1.0.0"
 
+LOG_FILE = '/var/log/passenger/passenger-status-requests.log'
+SNAPSHOT_FILE = '/var/log/passenger/passenger-queue-snapshots.ring'
+SNAPSHOT_THRESHOLD = 800
+SAMPLE_INTERVAL = 1
+# without the Passenger API every sample runs sudo passenger-status, so samples are at least this far apart
+CLI_SAMPLE_INTERVAL = 30
+SAMPLE_WINDOW = 300
+PERCENTILES = (50, 95, 99)
+
 
 class GetRequestsException(Exception):
     pass
 
 
-class GetQueueSizeException(Exception):
+class GetPoolStatusException(Exception):
     pass
 
 
-def get_logger(name=__name__):
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
+CHUNK_SIZE = 64 * 1024
+
+
+PROCESS_FIELDS = ('pid', 'sessions', 'processed', 'busyness', 'concurrency')
+
+
+def _findint(element, tag):
+    value = element.findtext(tag)
+    return int(value) if value else 0
+
+
+def parse_queue_size(data):
+    """Only the queue size of `passenger-status --show=xml` output, as counted by parse_pool_xml."""
+    root = ElementTree.fromstring(data)
+    groups_queue_size = sum(_findint(group, 'get_wait_list_size') for group in root.iter('group'))
+    return _findint(root, 'get_wait_list_size') + groups_queue_size
+
+
+def parse_pool_xml(data):
+    """Turn `passenger-status --show=xml` output into the pool-wide, per-group and per-process numbers.
+
+    `queue_size` counts every waiting request: the top-level queue plus each app group's queue.
+    """
+    root = ElementTree.fromstring(data)
+    top_level_queue = _findint(root, 'get_wait_list_size')
+
+    groups = []
+    for group in root.iter('group'):
+        groups.append({
+            'name': group.findtext('name'),
+            'queue_size': _findint(group, 'get_wait_list_size'),
+            'capacity_used': _findint(group, 'capacity_used'),
+            'processes': [{field: _findint(process, field) for field in PROCESS_FIELDS}
+                          for process in group.iter('process')],
+        })
+
+    return {
+        'queue_size': top_level_queue + sum(group['queue_size'] for group in groups),
+        'top_level_queue_size': top_level_queue,
+        'process_count': _findint(root, 'process_count'),
+        'capacity_used': _findint(root, 'capacity_used'),
+        'max_pool_size': _findint(root, 'max'),
+        'groups': groups,
+    }
+
+
+class QueueDepthWindow:
+    """Fixed-size ring buffer of the last (timestamp, queue size) samples, shared by the sampler thread
+    and check runs.
+    """
+    __slots__ = ('times', 'depths', 'index', 'count', 'lock')
 
-    logger = logging.getLogger(name)
+    def __init__(self, size):
+        self.times = array('d', bytes(8 * size))
+        self.depths = array('d', bytes(8 * size))
+        self.index = 0
+        self.count = 0
+        self.lock = threading.Lock()
 
-    fileHandler = logging.FileHandler(
-        '/var/log/passenger/passenger-status-requests-{:%Y-%m-%d}.log'.format(datetime.now()))
-    fileHandler.setFormatter(formatter)
+    def add(self, timestamp, depth):
+        with self.lock:
+            self.times[self.index] = timestamp
+            self.depths[self.index] = depth
+            self.index = (self.index + 1) % len(self.times)
+            self.count = min(self.count + 1, len(self.times))
+
+    def since(self, timestamp):
+        """Samples taken after `timestamp`, oldest first, preceded by the last one taken before it if any."""
+        with self.lock:
+            start = (self.index - self.count) % len(self.times)
+            order = [(start + i) % len(self.times) for i in range(self.count)]
+            samples = [(self.times[i], self.depths[i]) for i in order]
+        first_new = next((i for i, sample in enumerate(samples) if sample[0] > timestamp), len(samples))
+        return samples[max(0, first_new - 1):]
+
+
+def summarize_queue_depth(samples, since):
+    """Max, percentiles and enqueue/drain rates (requests per second) of the samples taken after `since`.
+
+    Rates come from the changes between consecutive samples, including the one taken just before
+    `since`: growth counts as enqueued requests, shrinkage as drained ones. None without new samples.
+    """
+    new = [depth for timestamp, depth in samples if timestamp > since]
+    if not new:
+        return None
+    ordered = sorted(new)
+    summary = {'count': len(new), 'max': ordered[-1]}
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}'] = ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+    enqueued = drained = 0.0
+    for (_, previous), (_, depth) in zip(samples, samples[1:]):
+        if depth > previous:
+            enqueued += depth - previous
+        else:
+            drained += previous - depth
+    elapsed = samples[-1][0] - samples[0][0]
+    summary['enqueue_rate'] = enqueued / elapsed if elapsed > 0 else 0.0
+    summary['drain_rate'] = drained / elapsed if elapsed > 0 else 0.0
+    return summary
+
+
+class JsonStreamReader:
+    """Pull-parser over a JSON document read in chunks from a binary file object.
+
+    Scalars and small containers are decoded by the C decoder; containers that do not fit in the
+    current buffer are walked member by member, so memory stays bounded by the chunk size plus the
+    largest single value that is actually kept.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ' \t\n\r,:]}'
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._raw_decode = json.JSONDecoder().raw_decode
+
+    def _fill(self):
+        chunk = self.stream.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + self._decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, '' at the end of input."""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} in JSON stream, got {self.peek()!r}')
+        self.pos += 1
+
+    def _decode_buffered(self):
+        """Decode the next value if it is complete in the buffer.
+
+        A number is only complete once a delimiter follows it: '12' may continue as '12.5' in the next chunk.
+        """
+        try:
+            value, end = self._raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            return False, None
+        if not self.eof and (end == len(self.buffer) or self.buffer[end] not in self.DELIMITERS):
+            return False, None
+        self.pos = end
+        return True, value
 
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(fileHandler)
+    def read_value(self):
+        self.peek()
+        while True:
+            decoded, value = self._decode_buffered()
+            if decoded:
+                return value
+            if self.eof:
+                raise ValueError('Truncated JSON stream')
+            self._fill()
 
-    return logger, fileHandler
+    def skip_value(self):
+        char = self.peek()
+        if char not in '{[' or self._decode_buffered()[0]:
+            if char not in '{[':
+                self.read_value()
+            return
+        for _ in (self.iter_object() if char == '{' else self.iter_array()):
+            self.skip_value()
 
+    def _iter_members(self, opening, closing):
+        self.expect(opening)
+        if self.peek() == closing:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == closing:
+                return
+            if char != ',':
+                raise ValueError(f'Expected {closing!r} or \',\' in JSON stream, got {char!r}')
 
-def log_wrapper(method):
-    @wraps(method)
-    def _impl(self, *method_args, **method_kwargs):
-        self.log, fileHandler = get_logger()
-        method_output = method(self, *method_args, **method_kwargs)
-        self.log.removeHandler(fileHandler)
-        fileHandler.flush()
-        fileHandler.close()
-        return method_output
+    def iter_object(self):
+        """Yield each key of the object at the current position; the caller must consume its value."""
+        for _ in self._iter_members('{', '}'):
+            key = self.read_value()
+            self.expect(':')
+            yield key
 
-    return _impl
+    def iter_array(self):
+        """Yield once per element of the array at the current position; the caller must consume it."""
+        return self._iter_members('[', ']')
+
+
+def stream_requests_summary(stream, chunk_size=CHUNK_SIZE):
+    """Keep, for every core thread of a --show=requests dump, only the numbers reported as metrics.
+
+    The dump is parsed incrementally from `stream`; per-client and per-request details are skipped
+    without ever being held as a whole.
+    """
+    reader = JsonStreamReader(stream, chunk_size=chunk_size)
+    threads = []
+    for thread_name in reader.iter_object():
+        if reader.peek() != '{':
+            reader.skip_value()
+            continue
+
+        thread = {'thread': thread_name, 'active_client_count': 0, 'total_clients_accepted': 0,
+                  'client_accept_speed': 0}
+        for field in reader.iter_object():
+            if field in ('active_client_count', 'total_clients_accepted'):
+                thread[field] = reader.read_value()
+            elif field == 'client_accept_speed':
+                thread[field] = reader.read_value().get('1m', {}).get('value', 0)
+            else:
+                reader.skip_value()
+        threads.append(thread)
+    return threads
 
 
 class PassengerQueueCheck(AgentCheck):
-    CRIT_REQ_CNT = 800
+    requests_metrics = True
+    use_api = True
+    instance_dir = None
+    api_client = None
+    log_level = LOG_LEVEL
+    command_timeout = TIMEOUT
+    runner = None
+    background_collection = False
+    collection_interval = COLLECTION_INTERVAL
+    max_snapshot_age = MAX_SNAPSHOT_AGE
+    background = None
+    instrumentation_enabled = False
+    instrumentation = None
+    snapshot_threshold = SNAPSHOT_THRESHOLD
+    snapshot_file = SNAPSHOT_FILE
+    snapshot_file_size = RING_SIZE
+    snapshot_interval = MIN_INTERVAL
+    recorder = None
+    queue_sampling = False
+    sample_interval = SAMPLE_INTERVAL
+    sample_window = SAMPLE_WINDOW
+    sampler = None
+    sampler_client = None
+    sampler_cli_at = None
+    queue_window = None
+    sampled_until = None
 
-    @staticmethod
-    def _exec_command(command, stdin=None, stderr=None):
-        return subprocess.Popen(shlex.split(command), stdin=stdin, stdout=subprocess.PIPE, stderr=stderr)
+    def _get_runner(self):
+        if self.runner is None:
+            self.runner = CommandRunner()
+        return self.runner
 
-    def _convert_to_json(self, pipe):
-        return json.loads(pipe)
+    def _get_recorder(self):
+        if self.recorder is None:
+            self.recorder = SnapshotRecorder(self.snapshot_file, size=self.snapshot_file_size,
+                                             min_interval=self.snapshot_interval)
+        return self.recorder
 
-    def get_queue_size(self):
-        cmd_1 = "sudo passenger-status"
-        cmd_2 = """awk /"Requests in queue"/'{print $4}'"""
+    def _get_api_client(self):
+        if self.use_api and self.api_client is None:
+            try:
+                self.api_client = PassengerApiClient(instance_dir=self.instance_dir)
+            except PassengerApiException as exc:
+                self.log.debug(f'Passenger API not available, using passenger-status: {exc}')
+        return self.api_client
+
+    def _drop_api_client(self, exc):
+        self.log.warning(f'Passenger API request failed, using passenger-status: {exc}')
+        self.api_client.close()
+        self.api_client = None
+
+    @timed
+    def get_pool_status(self):
+        client = self._get_api_client()
+        if client is not None:
+            try:
+                data = client.get_pool_xml()
+            except PassengerApiException as exc:
+                self._drop_api_client(exc)
+            else:
+                try:
+                    return parse_pool_xml(data)
+                except Exception as exc:
+                    self.log.exception(exc)
+                    raise GetPoolStatusException
+
+        cmd = "sudo passenger-status --show=xml"
         try:
-            pipe_1 = self._exec_command(command=cmd_1)
-            pipe_2 = self._exec_command(command=cmd_2, stdin=pipe_1.stdout)
-            data = pipe_2.communicate()[0].decode().split()[0]
+            result = self._get_runner().run(cmd, timeout=self.command_timeout)
+            with phase(self, 'parse_pool_xml'):
+                pool_status = parse_pool_xml(result.stdout)
         except Exception as exc:
             self.log.exception(exc)
-            raise GetQueueSizeException
+            raise GetPoolStatusException
         else:
-            return int(data)
+            return pool_status
+
+    @timed
+    def get_requests_details(self, dump=None):
+        """Per-thread request summaries; the raw dump is also compressed into `dump`, a DumpCompressor, when given."""
+        client = self._get_api_client()
+        if client is not None:
+            try:
+                with client.stream_server_json() as stream:
+                    return stream_requests_summary(stream if dump is None else dump.wrap(stream))
+            except Exception as exc:
+                self._drop_api_client(exc)
 
-    def get_requests_details(self):
         cmd = "sudo passenger-status --show=requests --no-header"
         try:
-            pipe = self._exec_command(cmd)
-            data = pipe.communicate()[0]
-            data_in_json = self._convert_to_json(data)
+            with self._get_runner().stream(cmd, timeout=self.command_timeout) as stdout:
+                threads = stream_requests_summary(stdout if dump is None else dump.wrap(stdout))
         except Exception as exc:
             self.log.exception(exc)
             raise GetRequestsException
         else:
-            pipe.stdout.close()
+            return threads
+
+    @timed
+    def record_if_urgent(self, pool_status, threads, dump=None):
+        """Keep a compressed snapshot of the pool, threads and request dump in the ring file while the queue
+        is over snapshot_threshold, at most once every snapshot_interval seconds.
+        """
+        queue_size = pool_status['queue_size']
+        if queue_size <= self.snapshot_threshold:
+            return
+        snapshot = {
+            'queue_size': queue_size,
+            'process_count': pool_status['process_count'],
+            'capacity_used': pool_status['capacity_used'],
+            'groups': pool_status['groups'],
+            'threads': threads,
+        }
+        if dump is not None:
+            snapshot['dump_truncated'] = dump.truncated
+        try:
+            recorded = self._get_recorder().record(snapshot, dump=dump)
+        except Exception as exc:
+            self.log.warning(f'Could not record a snapshot to {self.snapshot_file}: {exc}')
+            return
+
+        self.gauge('dd.check_passenger_queue.urgent_snapshot.recorded', 0 if recorded is None else 1)
+        if recorded is not None:
+            seq, size = recorded
+            self.gauge('dd.check_passenger_queue.urgent_snapshot.bytes', size)
+            self.log.info(f'Queue size {queue_size} over {self.snapshot_threshold}, '
+                          f'snapshot {seq} written to {self.snapshot_file}')
+
+    @timed
+    def report_pool_status(self, pool_status):
+        self.gauge('dd.check_passenger_queue.requests.count', pool_status['queue_size'])
+        self.gauge('dd.check_passenger_queue.processes.count', pool_status['process_count'])
+        self.gauge('dd.check_passenger_queue.capacity_used.count', pool_status['capacity_used'])
+
+        for group in pool_status['groups']:
+            group_tags = [f'app_group:{group["name"]}']
+            self.gauge('dd.check_passenger_queue.app_group.requests.count', group['queue_size'], tags=group_tags)
+            self.gauge('dd.check_passenger_queue.app_group.processes.count', len(group['processes']), tags=group_tags)
+            for process in group['processes']:
+                process_tags = group_tags + [f'pid:{process["pid"]}']
+                self.gauge('dd.check_passenger_queue.process.sessions', process['sessions'], tags=process_tags)
+                self.gauge('dd.check_passenger_queue.process.processed', process['processed'], tags=process_tags)
+                self.gauge('dd.check_passenger_queue.process.busyness', process['busyness'], tags=process_tags)
+
+    @timed
+    def report_requests(self, threads):
+        for thread in threads:
+            thread_tags = [f'thread:{thread["thread"]}']
+            self.gauge('dd.check_passenger_queue.thread.active_clients.count', thread['active_client_count'],
+                       tags=thread_tags)
+            self.gauge('dd.check_passenger_queue.thread.clients_accepted.count', thread['total_clients_accepted'],
+                       tags=thread_tags)
+            self.gauge('dd.check_passenger_queue.thread.client_accept_speed', thread['client_accept_speed'],
+                       tags=thread_tags)
+
+    def fetch(self):
+        """The slow part of a run: the pool status and, when needed, the per-thread request summaries.
 
-            return data_in_json
+        While the queue is over snapshot_threshold and a snapshot is due, the request dump is also kept,
+        compressed as it streams, for record_if_urgent.
+        """
+        pool_status = self.get_pool_status()
+        threads = dump = None
+        urgent = pool_status['queue_size'] > self.snapshot_threshold
+        if urgent and self._get_recorder().due():
+            dump = DumpCompressor(max_size=self.snapshot_file_size // 4)
+        if self.requests_metrics or urgent:
+            threads = self.get_requests_details(dump=dump)
+        return pool_status, threads, dump
 
-    def log_if_urgent(self, queue_size, requests_details):
-        if queue_size > self.CRIT_REQ_CNT:
-            self.log.debug("Queue_size: {}".format(queue_size))
-            self.log.debug("Requests details : {}".format(requests_details))
+    def sample_queue_depth(self):
+        """Add the current queue size to queue_window; run every sample_interval seconds by the sampler thread.
 
-    @log_wrapper
+        The pool is read through the Passenger API when it is available. A client whose request failed
+        is dropped, as Passenger gets a new instance directory when it restarts. Without the API, the
+        instance is looked up again and passenger-status run at most once every CLI_SAMPLE_INTERVAL
+        seconds, other samples are skipped.
+        """
+        now = time.monotonic()
+        if self.sampler_client is None and self.use_api and \
+                (self.sampler_cli_at is None or now - self.sampler_cli_at >= CLI_SAMPLE_INTERVAL):
+            try:
+                self.sampler_client = PassengerApiClient(instance_dir=self.instance_dir)
+            except PassengerApiException as exc:
+                self.log.warning(f'Passenger API not available, sampling the queue with passenger-status every '
+                                 f'{CLI_SAMPLE_INTERVAL}s: {exc}')
+
+        if self.sampler_client is not None:
+            try:
+                data = self.sampler_client.get_pool_xml()
+            except PassengerApiException:
+                self.sampler_client.close()
+                self.sampler_client = None
+                raise
+        elif self.sampler_cli_at is None or now - self.sampler_cli_at >= CLI_SAMPLE_INTERVAL:
+            self.sampler_cli_at = now
+            data = self._get_runner().run("sudo passenger-status --show=xml", timeout=self.command_timeout).stdout
+        else:
+            return
+        self.queue_window.add(time.monotonic(), parse_queue_size(data))
+
+    def _start_sampler(self):
+        self.queue_window = QueueDepthWindow(self.sample_window)
+        self.sampled_until = time.monotonic()
+        self.sampler = BackgroundCollector(self.sample_queue_depth, interval=self.sample_interval,
+                                           name='dd-check-passenger-queue-sampler')
+        self.sampler.start()
+
+    def _stop_sampler(self):
+        self.sampler.stop()
+        if self.sampler_client is not None:
+            self.sampler_client.close()
+        self.sampler = self.sampler_client = self.sampler_cli_at = None
+        self.queue_window = self.sampled_until = None
+
+    @timed
+    def report_queue_depth(self):
+        """Report the queue sizes sampled since the last run as dd.check_passenger_queue.requests.sampled.*."""
+        if self.sampler is None:
+            self._start_sampler()
+        error, self.sampler.error = self.sampler.error, None
+        if error is not None:
+            self.log.warning(f'Queue sampling failed: {error}')
+
+        samples = self.queue_window.since(self.sampled_until)
+        summary = summarize_queue_depth(samples, self.sampled_until)
+        if summary is None:
+            return
+        self.sampled_until = samples[-1][0]
+        for name, value in summary.items():
+            self.gauge(f'dd.check_passenger_queue.requests.sampled.{name}', value)
+
+    def _get_background_data(self):
+        """Start the background collection if needed and return its last snapshot, None when there is none."""
+        if self.background is None:
+            self.background = BackgroundCollector(self.fetch, interval=self.collection_interval,
+                                                  name='dd-check-passenger-queue')
+            self.background.start()
+        return self.background.current(self, 'dd.check_passenger_queue', max_age=self.max_snapshot_age)
+
+    def cancel(self):
+        if self.background is not None:
+            self.background.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.sampler is not None:
+            self._stop_sampler()
+
+    @instrumented(LOG_FILE, 'dd.check_passenger_queue')
     def collect(self):
-        queue_size = self.get_queue_size()
-        requests_data = self.get_requests_details()
-        self.log_if_urgent(queue_size, requests_data)
+        try:
+            self._collect()
+        finally:
+            self._get_runner().flush_metrics(self, 'dd.check_passenger_queue')
+
+    def _collect(self):
+        if self.queue_sampling:
+            self.report_queue_depth()
+        elif self.sampler is not None:
+            self._stop_sampler()
+        if not self.background_collection:
+            data = self.fetch()
+        else:
+            data = self._get_background_data()
+            if data is None:
+                return
+        pool_status, threads, dump = data
+        self.report_pool_status(pool_status)
+        self.record_if_urgent(pool_status, threads, dump)
 
-        self.gauge('dd.check_passenger_queue.requests.count', queue_size)
+        if threads is not None:
+            self.report_requests(threads)
+
+    def get_instance_config(self, instance):
+        config = {
+            'requests_metrics': instance.get('requests_metrics', True),
+            'passenger_api': instance.get('passenger_api', True),
+            'passenger_instance_dir': instance.get('passenger_instance_dir', None),
+            'log_level': instance.get('log_level', LOG_LEVEL),
+            'command_timeout': instance.get('command_timeout', TIMEOUT),
+            'background_collection': instance.get('background_collection', False),
+            'collection_interval': instance.get('collection_interval', COLLECTION_INTERVAL),
+            'max_snapshot_age': instance.get('max_snapshot_age', MAX_SNAPSHOT_AGE),
+            'instrumentation': instance.get('instrumentation', False),
+            'snapshot_threshold': instance.get('snapshot_threshold', SNAPSHOT_THRESHOLD),
+            'snapshot_file': instance.get('snapshot_file', SNAPSHOT_FILE),
+            'snapshot_file_size': instance.get('snapshot_file_size', RING_SIZE),
+            'snapshot_interval': instance.get('snapshot_interval', MIN_INTERVAL),
+            'queue_sampling': instance.get('queue_sampling', False),
+            'sample_interval': instance.get('sample_interval', SAMPLE_INTERVAL),
+            'sample_window': instance.get('sample_window', SAMPLE_WINDOW)
+        }
+
+        return config
 
     def check(self, instance):
+        config = self.get_instance_config(instance)
+        self.requests_metrics = config.get('requests_metrics')
+        self.use_api = config.get('passenger_api')
+        self.instance_dir = config.get('passenger_instance_dir')
+        self.log_level = config.get('log_level')
+        self.command_timeout = config.get('command_timeout')
+        self.background_collection = config.get('background_collection')
+        self.collection_interval = config.get('collection_interval')
+        self.max_snapshot_age = config.get('max_snapshot_age')
+        self.instrumentation_enabled = config.get('instrumentation')
+        self.snapshot_threshold = config.get('snapshot_threshold')
+        self.snapshot_file = config.get('snapshot_file')
+        self.snapshot_file_size = config.get('snapshot_file_size')
+        self.snapshot_interval = config.get('snapshot_interval')
+        self.queue_sampling = config.get('queue_sampling')
+        self.sample_interval = config.get('sample_interval')
+        self.sample_window = config.get('sample_window')
+
         self.collect()
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+import dd_logging
+from dd_logging import LOG_LEVEL
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+RUN_PHASE = 'run'
+
+PhaseSample = namedtuple('PhaseSample', ['name', 'duration', 'subprocesses', 'bytes_read', 'rss_delta'])
+
+
+def get_rss():
+    """Resident set size of this process in bytes, 0 when /proc/self/statm cannot be read."""
+    try:
+        with open('/proc/self/statm', 'rb') as fh:
+            return int(fh.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Phase:
+    """Context manager recording one PhaseSample into an Instrumentation."""
+    __slots__ = ('instrumentation', 'name', 'start', 'counters', 'rss')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.counters = self.instrumentation.counters()
+        self.rss = get_rss()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.monotonic() - self.start
+        subprocesses, bytes_read = self.instrumentation.counters()
+        self.instrumentation.add(PhaseSample(self.name, duration, subprocesses - self.counters[0],
+                                             bytes_read - self.counters[1], get_rss() - self.rss))
+        return False
+
+
+class NoPhase:
+    """Stand-in for Phase when instrumentation is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+
+class Instrumentation:
+    """Wall time, subprocesses spawned, bytes read from their pipes and RSS delta of the phases of check runs.
+
+    Subprocesses and bytes come from the per-thread counters of `runner`, so a phase only accounts for
+    the commands run by its own thread. The RSS delta is process-wide.
+    """
+
+    def __init__(self, runner=None):
+        self.runner = runner
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def counters(self):
+        return self.runner.counters() if self.runner is not None else (0, 0)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, sample):
+        with self._lock:
+            self.samples.append(sample)
+
+    def flush_metrics(self, check, prefix):
+        """Report and forget the phases recorded since the last flush as <prefix>.phase.* tagged phase:<name>."""
+        with self._lock:
+            samples, self.samples = self.samples, []
+        for sample in samples:
+            tags = [f'phase:{sample.name}']
+            check.histogram(f'{prefix}.phase.duration', sample.duration, tags=tags)
+            check.histogram(f'{prefix}.phase.subprocesses', sample.subprocesses, tags=tags)
+            check.histogram(f'{prefix}.phase.bytes_read', sample.bytes_read, tags=tags)
+            check.histogram(f'{prefix}.phase.rss_delta', sample.rss_delta, tags=tags)
+
+
+def phase(check, name):
+    """Context manager timing a block of `check` as phase `name`; a shared no-op when instrumentation is off."""
+    instrumentation = check.instrumentation
+    return NO_PHASE if instrumentation is None else Phase(instrumentation, name)
+
+
+def timed(method):
+    """Record every call of a check method as the phase named after it."""
+    name = method.__name__
+
+    @wraps(method)
+    def _impl(self, *method_args, **method_kwargs):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return method(self, *method_args, **method_kwargs)
+        with Phase(instrumentation, name):
+            return method(self, *method_args, **method_kwargs)
+
+    return _impl
+
+
+def instrumented(filename, prefix):
+    """Decorate the method running a check: log through dd_logging.get_logger(filename) at the check's
+    `log_level` and, when its `instrumentation_enabled` is set, record the run as the `run` phase and
+    report every phase recorded since the last run under <prefix>.phase.*.
+    """
+    def decorator(method):
+        @wraps(method)
+        def _impl(self, *method_args, **method_kwargs):
+            self.log = dd_logging.get_logger(method.__module__, filename,
+                                             level=getattr(self, 'log_level', LOG_LEVEL))
+            if not getattr(self, 'instrumentation_enabled', False):
+                self.instrumentation = None
+                return method(self, *method_args, **method_kwargs)
+
+            if self.instrumentation is None:
+                self.instrumentation = Instrumentation(self._get_runner())
+            try:
+                with Phase(self.instrumentation, RUN_PHASE):
+                    return method(self, *method_args, **method_kwargs)
+            finally:
+                self.instrumentation.flush_metrics(self, prefix)
+
+        return _impl
+
+    return decorator
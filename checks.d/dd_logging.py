@@ -0,0 +1,58 @@
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+LOG_LEVEL = 'DEBUG'
+BACKUP_COUNT = 7
+FORMAT = '%(asctime)s - %(levelname)s: %(message)s'
+
+_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_queue)
+_listener = None
+_file_handlers = {}
+_lock = threading.Lock()
+
+
+def _add_file_handler(name, filename):
+    """Route records of logger `name` to `filename` from the shared listener thread."""
+    global _listener
+
+    handler = TimedRotatingFileHandler(filename, when='midnight', backupCount=BACKUP_COUNT, delay=True)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(logging.Filter(name))
+    _file_handlers[name] = handler
+
+    if _listener is None:
+        _listener = QueueListener(_queue, handler)
+        _listener.start()
+        atexit.register(stop)
+    else:
+        _listener.handlers = _listener.handlers + (handler,)
+
+
+def get_logger(name, filename, level=LOG_LEVEL):
+    """Logger whose records are queued by the caller and written to a daily rotated `filename` by one
+    long-lived listener thread shared by all checks, so a check run never opens or writes the file itself.
+    """
+    logger = logging.getLogger(name)
+    with _lock:
+        if name not in _file_handlers:
+            _add_file_handler(name, filename)
+            logger.addHandler(_queue_handler)
+    logger.setLevel(level)
+    return logger
+
+
+def stop():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        for handler in _file_handlers.values():
+            handler.close()
+        _file_handlers.clear()
@@ -0,0 +1,102 @@
+import glob
+import json
+import os
+from contextlib import contextmanager
+from urllib.parse import quote
+
+try:
+    import requests_unixsocket
+except ImportError:
+    requests_unixsocket = None
+
+INSTANCE_REGISTRY_DIRS = ('/var/run/passenger-instreg', '/tmp')
+CORE_API_SOCKET = os.path.join('agents.s', 'core_api')
+READ_ONLY_ADMIN = ('ro_admin', 'read_only_admin_password.txt')
+FULL_ADMIN = ('admin', 'full_admin_password.txt')
+TIMEOUT = 5
+
+
+class PassengerApiException(Exception):
+    pass
+
+
+def find_instance_dir(registry_dirs=None):
+    """Return the most recently started Passenger instance directory that exposes a core API socket."""
+    if registry_dirs is None:
+        env_dir = os.environ.get('PASSENGER_INSTANCE_REGISTRY_DIR')
+        registry_dirs = (env_dir,) if env_dir else INSTANCE_REGISTRY_DIRS
+
+    candidates = [instance_dir for registry_dir in registry_dirs
+                  for instance_dir in glob.glob(os.path.join(registry_dir, 'passenger.*'))
+                  if os.path.exists(os.path.join(instance_dir, CORE_API_SOCKET))]
+    if not candidates:
+        raise PassengerApiException(f'No Passenger instance found in {", ".join(registry_dirs)}')
+
+    return max(candidates, key=os.path.getmtime)
+
+
+class PassengerApiClient:
+    """HTTP-over-Unix-socket client for the Passenger core API.
+
+    The same session, and so the same connection pool, is reused for every request made through
+    one client. Credentials are read from the instance directory, which usually requires root.
+    """
+
+    def __init__(self, instance_dir=None, registry_dirs=None, timeout=TIMEOUT):
+        if requests_unixsocket is None:
+            raise PassengerApiException('requests_unixsocket is not installed')
+
+        self.instance_dir = instance_dir or find_instance_dir(registry_dirs)
+        self.base_url = 'http+unix://' + quote(os.path.join(self.instance_dir, CORE_API_SOCKET), safe='')
+        self.timeout = timeout
+        self.session = requests_unixsocket.Session()
+        self._credentials = {}
+
+    def _get_auth(self, account):
+        if account not in self._credentials:
+            username, password_file = account
+            try:
+                with open(os.path.join(self.instance_dir, password_file), 'r') as fh:
+                    self._credentials[account] = (username, fh.read().strip())
+            except OSError as exc:
+                raise PassengerApiException(f'Cannot read Passenger credentials: {exc}')
+        return self._credentials[account]
+
+    def _request(self, method, path, account=READ_ONLY_ADMIN, timeout=None, **kwargs):
+        try:
+            response = self.session.request(method, self.base_url + path, auth=self._get_auth(account),
+                                            timeout=self.timeout if timeout is None else timeout, **kwargs)
+            response.raise_for_status()
+        except PassengerApiException:
+            raise
+        except Exception as exc:
+            raise PassengerApiException(f'{method} {path} failed: {exc}')
+        return response
+
+    @staticmethod
+    def _load_json(response):
+        try:
+            return json.loads(response.content)
+        except ValueError as exc:
+            raise PassengerApiException(f'Invalid JSON from {response.url}: {exc}')
+
+    def get_pool_xml(self):
+        return self._request('GET', '/pool.xml').content
+
+    @contextmanager
+    def stream_server_json(self):
+        """Yield the /server.json body as a binary file object, read from the socket as it is consumed."""
+        response = self._request('GET', '/server.json', stream=True)
+        try:
+            response.raw.decode_content = True
+            yield response.raw
+        finally:
+            response.close()
+
+    def detach_process(self, pid, timeout=None):
+        response = self._request('POST', '/pool/detach_process.json', account=FULL_ADMIN, timeout=timeout,
+                                 json={'pid': str(pid)})
+        return bool(self._load_json(response).get('detached'))
+
+    def close(self):
+        self.session.close()
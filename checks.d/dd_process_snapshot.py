@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from array import array
+
+PROC_ROOT = '/proc'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+SNAPSHOT_MAX_AGE = 10
+READ_SIZE = 4096
+
+
+def read_proc_file(path, size=READ_SIZE):
+    """Content of a /proc file read with os.open/os.read, so opening it costs no fstat, ioctl or lseek.
+
+    procfs fills each read as far as the file goes, so a read shorter than `size` is the last one.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, size)
+            chunks.append(chunk)
+            if len(chunk) < size:
+                return b''.join(chunks)
+    finally:
+        os.close(fd)
+
+
+def parse_stat(data):
+    """(start time in clock ticks, RSS in bytes) from the content of /proc/<pid>/stat (fields 22 and 24)."""
+    fields = data[data.rindex(b')') + 2:].split()
+    return int(fields[19]), int(fields[21]) * PAGE_SIZE
+
+
+def get_fd_count(fd_dir):
+    """Number of open FDs of a process from its /proc/<pid>/fd directory.
+
+    Linux >= 6.2 reports the FD count as the directory size, so a stat is enough; older kernels report
+    0, so the directory is listed instead, which costs one getdents walk but no per-FD syscalls.
+    """
+    return os.stat(fd_dir).st_size or len(os.listdir(fd_dir))
+
+
+class ProcessSnapshot:
+    """Processes seen in one walk of /proc, one array per field and one row per process.
+
+    Command lines have their NULs read as spaces. The `fds` column is None until a caller needs it and
+    calls load_fds(), so checks that do not look at FDs do not pay for a stat of every fd directory. A
+    snapshot is never modified once built, except for that one fill under a lock, so threads can share it.
+    """
+    __slots__ = ('taken_at', 'proc_root', 'pids', 'uids', 'starttimes', 'rss', 'fds', 'cmdlines', '_fds_lock')
+
+    def __init__(self, taken_at=None, proc_root=PROC_ROOT):
+        self.taken_at = taken_at
+        self.proc_root = proc_root
+        self.pids = array('i')
+        self.uids = array('I')
+        self.starttimes = array('Q')
+        self.rss = array('Q')
+        self.fds = None
+        self.cmdlines = []
+        self._fds_lock = threading.Lock()
+
+    def append(self, pid, uid, starttime, rss, cmdline):
+        self.pids.append(pid)
+        self.uids.append(uid)
+        self.starttimes.append(starttime)
+        self.rss.append(rss)
+        self.cmdlines.append(cmdline)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def matching(self, pattern):
+        """Rows whose command line matches the compiled `pattern`."""
+        return [row for row, cmdline in enumerate(self.cmdlines) if pattern.match(cmdline)]
+
+    def load_fds(self):
+        """Fill the `fds` column on the first call, with get_fd_count() of each fd directory, and return it.
+
+        `fds` is -1 for a process whose fd directory cannot be read, or that exited since the walk.
+        """
+        with self._fds_lock:
+            if self.fds is None:
+                fds = array('q')
+                for pid in self.pids:
+                    try:
+                        fds.append(get_fd_count(os.path.join(self.proc_root, str(pid), 'fd')))
+                    except OSError:
+                        fds.append(-1)
+                self.fds = fds
+            return self.fds
+
+
+def scan_processes(proc_root=PROC_ROOT, now=None):
+    """ProcessSnapshot of every process under `proc_root`, skipping the ones that exit during the walk.
+
+    Each process costs one stat of its directory (uid), one read of stat (start time, RSS) and one read
+    of cmdline; its fd directory is only stat-ed by ProcessSnapshot.load_fds().
+    """
+    snapshot = ProcessSnapshot(time.monotonic() if now is None else now, proc_root)
+    with os.scandir(proc_root) as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            pid_dir = entry.path
+            try:
+                uid = os.stat(pid_dir).st_uid
+                starttime, rss = parse_stat(read_proc_file(os.path.join(pid_dir, 'stat')))
+            except (OSError, ValueError, IndexError):
+                continue
+            try:
+                cmdline = read_proc_file(os.path.join(pid_dir, 'cmdline')).replace(b'\0', b' ').decode(
+                    errors='replace')
+            except OSError:
+                cmdline = ''
+            snapshot.append(int(entry.name), uid, starttime, rss, cmdline)
+    return snapshot
+
+
+class SharedCache:
+    """Values shared by every check of the agent process, each computed again once `max_age` seconds old.
+
+    A caller finding no fresh value for its key computes it while holding the lock, so checks running
+    together wait for that computation instead of repeating it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, max_age, compute, now=None):
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] >= max_age:
+                entry = self._entries[key] = (now, compute())
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# last ProcessSnapshot per proc root
+SNAPSHOTS = SharedCache()
+
+
+def get_process_snapshot(proc_root=PROC_ROOT, max_age=SNAPSHOT_MAX_AGE, now=None):
+    """Process snapshot of `proc_root` at most `max_age` seconds old; a new walk every call when it is 0."""
+    return SNAPSHOTS.get(proc_root, max_age, lambda: scan_processes(proc_root, now), now)
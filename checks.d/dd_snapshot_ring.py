@@ -0,0 +1,276 @@
+"""Compressed snapshots kept in a fixed-size, memory-mapped ring file.
+
+Run as a script to summarize or replay the snapshots of a ring file, with the dumps they carry:
+    python checks.d/dd_snapshot_ring.py /var/log/passenger/passenger-queue-snapshots.ring [--replay]
+"""
+import argparse
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+RING_SIZE = 16 * 1024 * 1024
+MIN_INTERVAL = 60
+COMPRESSION_LEVEL = 1
+
+MAGIC = b'DDRING01'
+# magic, data capacity, head (next write offset), tail (oldest record offset), record count, next sequence
+HEADER = struct.Struct('<8sQQQQQ')
+HEADER_SIZE = 64
+# payload length, crc32 of the payload, sequence, unix timestamp
+RECORD = struct.Struct('<IIQd')
+LENGTH = struct.Struct('<I')
+WRAP = 0xFFFFFFFF
+
+Snapshot = namedtuple('Snapshot', ['seq', 'timestamp', 'data', 'dump'], defaults=(None,))
+
+
+class RingFileException(Exception):
+    pass
+
+
+class RingFile:
+    """Length-prefixed records appended to a file of fixed size, overwriting the oldest ones when full.
+
+    Offsets, count and sequence live in the file header, and every append holds an exclusive flock,
+    so several processes can share a ring file. A wrap marker is written where the last record before
+    the end of the file stops. Nothing is fsync-ed: records reach the disk through the page cache like
+    any mmap write.
+    """
+
+    def __init__(self, path, size=RING_SIZE, readonly=False):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT, 0o640)
+        try:
+            if readonly:
+                self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, HEADER_SIZE + size)
+                    self.mm = mmap.mmap(fd, 0)
+                    HEADER.pack_into(self.mm, 0, MAGIC, size, 0, 0, 0, 1)
+                else:
+                    self.mm = mmap.mmap(fd, 0)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        magic, self.capacity = HEADER.unpack_from(self.mm, 0)[:2]
+        if magic != MAGIC or HEADER_SIZE + self.capacity != len(self.mm):
+            self.close()
+            raise RingFileException(f'{path} is not a ring file')
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def _next(self, offset):
+        """Offset of the record after the one at `offset`, following wrap markers."""
+        length = LENGTH.unpack_from(self.mm, HEADER_SIZE + offset)[0]
+        offset += RECORD.size + length
+        if offset + LENGTH.size > self.capacity or LENGTH.unpack_from(self.mm, HEADER_SIZE + offset)[0] == WRAP:
+            offset = 0
+        return offset
+
+    def append(self, payload, timestamp=None):
+        """Append `payload` (bytes) and return its sequence number, None when it is larger than the ring."""
+        size = RECORD.size + len(payload)
+        if size > self.capacity:
+            return None
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            capacity, head, tail, count, seq = HEADER.unpack_from(self.mm, 0)[1:]
+            if head + size > capacity:
+                # the end of the file is too short: give it up, with the records still in it, and wrap
+                while count and tail >= head:
+                    tail, count = self._next(tail), count - 1
+                if head + LENGTH.size <= capacity:
+                    LENGTH.pack_into(self.mm, HEADER_SIZE + head, WRAP)
+                head = 0
+            while count and head <= tail < head + size:
+                tail, count = self._next(tail), count - 1
+            if not count:
+                tail = head
+
+            start = HEADER_SIZE + head
+            RECORD.pack_into(self.mm, start, len(payload), zlib.crc32(payload), seq,
+                             time.time() if timestamp is None else timestamp)
+            self.mm[start + RECORD.size:start + size] = payload
+            head += size
+            HEADER.pack_into(self.mm, 0, MAGIC, capacity, head, tail, count + 1, seq + 1)
+            return seq
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def __iter__(self):
+        """(sequence, timestamp, payload) of every record, oldest first; stops at the first corrupted one."""
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            tail, count = HEADER.unpack_from(self.mm, 0)[3:5]
+            records = []
+            offset = tail
+            for _ in range(count):
+                length, crc, seq, timestamp = RECORD.unpack_from(self.mm, HEADER_SIZE + offset)
+                start = HEADER_SIZE + offset + RECORD.size
+                payload = self.mm[start:start + length]
+                if zlib.crc32(payload) != crc:
+                    break
+                records.append((seq, timestamp, payload))
+                offset = self._next(offset)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return iter(records)
+
+
+class DumpCompressor:
+    """Binary file object that zlib-compresses what is read through it, as it streams.
+
+    About `max_size` compressed bytes are kept: zlib holds back output until it has a block, so bytes
+    fed since its last output count as if incompressible, and once the total reaches `max_size` the
+    compressed stream is ended and `truncated` set. Reads go on unchanged, so memory stays bounded
+    whatever the size of the dump.
+    """
+
+    def __init__(self, max_size=RING_SIZE // 4, level=COMPRESSION_LEVEL):
+        self.max_size = max_size
+        self.level = level
+        self.stream = None
+        self.wrap(None)
+
+    def wrap(self, stream):
+        """Compress `stream` from its start, dropping what an earlier stream left; returns self."""
+        self.stream = stream
+        self.chunks = []
+        self.size = 0
+        self.pending = 0
+        self.truncated = False
+        self._compressor = zlib.compressobj(self.level)
+        return self
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self._compressor is not None and data:
+            if self.size + self.pending + len(data) > self.max_size:
+                self.truncated = True
+                self._end()
+            else:
+                self.pending += len(data)
+                self._keep(self._compressor.compress(data))
+        return data
+
+    def _keep(self, chunk):
+        if chunk:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.pending = 0
+
+    def _end(self):
+        self._keep(self._compressor.flush())
+        self._compressor = None
+
+    def getvalue(self):
+        """The compressed dump, a complete zlib stream."""
+        if self._compressor is not None:
+            self._end()
+        return b''.join(self.chunks)
+
+
+class SnapshotRecorder:
+    """Write JSON-able snapshots, zlib-compressed, into a RingFile at most once every `min_interval` seconds.
+
+    A snapshot may carry a dump already compressed by a DumpCompressor; it is stored right after the
+    compressed JSON, as a second zlib stream of the same record.
+    """
+
+    def __init__(self, path, size=RING_SIZE, min_interval=MIN_INTERVAL):
+        self.path = path
+        self.size = size
+        self.min_interval = min_interval
+        self.ring = None
+        self.last_recorded = None
+
+    def due(self, now=None):
+        """Whether a snapshot recorded now would be written rather than rate-limited."""
+        now = time.monotonic() if now is None else now
+        return self.last_recorded is None or now - self.last_recorded >= self.min_interval
+
+    def record(self, data, now=None, dump=None):
+        """Return (sequence, compressed bytes) of the snapshot written, or None when rate-limited or too large."""
+        now = time.monotonic() if now is None else now
+        if not self.due(now):
+            return None
+        if self.ring is None:
+            self.ring = RingFile(self.path, self.size)
+        payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode(), COMPRESSION_LEVEL)
+        if dump is not None:
+            payload += dump.getvalue()
+        seq = self.ring.append(payload)
+        if seq is None:
+            return None
+        self.last_recorded = now
+        return seq, len(payload)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+def decode_snapshot(seq, timestamp, payload):
+    """Snapshot of a record payload: the JSON data and, when the record has one, the uncompressed dump."""
+    decompressor = zlib.decompressobj()
+    data = json.loads(decompressor.decompress(payload))
+    dump = zlib.decompress(decompressor.unused_data) if decompressor.unused_data else None
+    return Snapshot(seq, timestamp, data, dump)
+
+
+def read_snapshots(path):
+    """Snapshots of a ring file written by SnapshotRecorder, oldest first."""
+    ring = RingFile(path, readonly=True)
+    try:
+        return [decode_snapshot(seq, timestamp, payload) for seq, timestamp, payload in ring]
+    finally:
+        ring.close()
+
+
+def summarize(snapshot):
+    data = snapshot.data
+    fields = [f'#{snapshot.seq}', datetime.fromtimestamp(snapshot.timestamp).isoformat(timespec='seconds')]
+    for key, value in data.items():
+        if isinstance(value, (int, float, str)):
+            fields.append(f'{key}={value}')
+        elif isinstance(value, (list, dict)):
+            fields.append(f'{key}[{len(value)}]')
+    if snapshot.dump is not None:
+        fields.append(f'dump={len(snapshot.dump)}B')
+    return ' '.join(fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--replay', action='store_true', help='print every snapshot as JSON')
+    args = parser.parse_args()
+
+    snapshots = read_snapshots(args.path)
+    for snapshot in snapshots:
+        if args.replay:
+            dump = None if snapshot.dump is None else snapshot.dump.decode(errors='replace')
+            print(json.dumps({'seq': snapshot.seq, 'timestamp': snapshot.timestamp, 'data': snapshot.data,
+                              'dump': dump}))
+        else:
+            print(summarize(snapshot))
+    if not args.replay:
+        print(f'{len(snapshots)} snapshots', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
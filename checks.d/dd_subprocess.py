@@ -0,0 +1,234 @@
+import os
+import select
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+TIMEOUT = 30
+MAX_OUTPUT = 64 * 1024 * 1024
+KILL_GRACE = 1
+CHUNK_SIZE = 64 * 1024
+
+CommandResult = namedtuple('CommandResult', ['stdout', 'stderr', 'returncode', 'duration', 'timed_out', 'truncated'])
+Execution = namedtuple('Execution', ['name', 'duration', 'timed_out', 'truncated'])
+
+
+def command_name(command):
+    """Short name of a command for metric tags: the program run through sudo, plus its sub-command if any."""
+    args = shlex.split(command)
+    if args and args[0] == 'sudo':
+        args = args[1:]
+    if not args:
+        return ''
+    name = os.path.basename(args[0])
+    if len(args) > 1 and args[1].replace('-', '').isalpha() and not args[1].startswith('-'):
+        name = f'{name} {args[1]}'
+    return name
+
+
+class Pipeline:
+    """Processes started for a command, or for each stage of a list of commands piped into each other.
+
+    Only the last stage's stdout stays open in this process; every stage is killed and reaped by close().
+    """
+
+    def __init__(self, commands, stdin=None, stderr=None):
+        self.processes = []
+        self.timed_out = False
+        try:
+            for command in commands:
+                process = subprocess.Popen(shlex.split(command), stdin=stdin, stdout=subprocess.PIPE, stderr=stderr)
+                if self.processes:
+                    stdin.close()
+                self.processes.append(process)
+                stdin = process.stdout
+        except BaseException:
+            self.close()
+            raise
+        self.stdout = self.processes[-1].stdout
+
+    @property
+    def returncode(self):
+        """Exit status of the last stage, None when it could not be reaped."""
+        return self.processes[-1].returncode
+
+    def signal(self, sig):
+        """Send `sig` to every stage still running.
+
+        Stages running as another user (e.g. the root process behind sudo) cannot be signalled; sudo itself
+        relays SIGTERM to its command, and any stage still writing gets SIGPIPE once the pipe is closed.
+        """
+        for process in self.processes:
+            if process.poll() is None:
+                try:
+                    process.send_signal(sig)
+                except OSError:
+                    pass
+
+    def expire(self):
+        self.timed_out = True
+        self.signal(signal.SIGTERM)
+
+    def _wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                pass
+
+    def close(self):
+        """Close the read end of the pipe and reap every stage, waiting at most 2 * KILL_GRACE seconds.
+
+        Stages still running after KILL_GRACE seconds get SIGKILL; a stage that survives even that, or a
+        grandchild holding the pipe, is left behind rather than blocking the caller.
+        """
+        for process in self.processes:
+            process.stdout.close()
+        self._wait(KILL_GRACE)
+        if any(process.poll() is None for process in self.processes):
+            self.signal(signal.SIGKILL)
+            self._wait(KILL_GRACE)
+
+
+class PipeReader:
+    """Binary reader of a pipeline's stdout that gives up at a deadline and counts the bytes it returns.
+
+    Every read waits for data with poll() until `deadline` (a time.monotonic() value). Past it the
+    pipeline is expired and reads return EOF, so neither a hung stage nor a grandchild keeping the pipe
+    open after its parent exited can block the reader.
+    """
+
+    def __init__(self, pipeline, deadline):
+        self.pipeline = pipeline
+        self.deadline = deadline
+        self.fd = pipeline.stdout.fileno()
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+        self.eof = False
+        self.bytes_read = 0
+
+    def read1(self, size=CHUNK_SIZE):
+        """At most `size` bytes, as soon as some are available; b'' at EOF or past the deadline."""
+        if self.eof:
+            return b''
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0 or not self.poller.poll(remaining * 1000):
+            self.pipeline.expire()
+            self.eof = True
+            return b''
+        data = os.read(self.fd, size if size > 0 else CHUNK_SIZE)
+        self.eof = not data
+        self.bytes_read += len(data)
+        return data
+
+    def read(self, size=-1):
+        """`size` bytes, or everything until EOF when `size` is negative; fewer at EOF or past the deadline."""
+        chunks, total = [], 0
+        while size < 0 or total < size:
+            data = self.read1(CHUNK_SIZE if size < 0 else min(CHUNK_SIZE, size - total))
+            if not data:
+                break
+            chunks.append(data)
+            total += len(data)
+        return b''.join(chunks)
+
+
+class CommandRunner:
+    """Run shell-free commands and pipelines with a timeout and an output cap.
+
+    Every execution is recorded until flush_metrics() reports it, so runs from several threads are
+    reported by the check that owns the runner. Processes spawned and bytes read from their pipes are
+    also counted per thread, see counters().
+    """
+
+    def __init__(self, timeout=TIMEOUT, max_output=MAX_OUTPUT):
+        self.timeout = timeout
+        self.max_output = max_output
+        self.executions = []
+        self._counters = threading.local()
+
+    def _record(self, commands, start, timed_out, truncated, bytes_read):
+        name = ' | '.join(command_name(command) for command in commands)
+        self.executions.append(Execution(name, time.monotonic() - start, timed_out, truncated))
+        counters = self._counters
+        counters.subprocesses = getattr(counters, 'subprocesses', 0) + len(commands)
+        counters.bytes_read = getattr(counters, 'bytes_read', 0) + bytes_read
+
+    def counters(self):
+        """(subprocesses spawned, bytes read from their stdout and stderr) by the calling thread so far."""
+        return getattr(self._counters, 'subprocesses', 0), getattr(self._counters, 'bytes_read', 0)
+
+    @contextmanager
+    def stream(self, command, timeout=None, stdin=None, stderr=None):
+        """Yield the stdout of `command` (a string, or a list of strings run as a pipeline) as a PipeReader.
+
+        Reads hit EOF once `timeout` seconds have passed, and the pipeline gets SIGTERM. All stages are
+        reaped, or given up on, when the block exits.
+        """
+        commands = [command] if isinstance(command, str) else command
+        start = time.monotonic()
+        pipeline = Pipeline(commands, stdin=stdin, stderr=stderr)
+        stdout = PipeReader(pipeline, start + (self.timeout if timeout is None else timeout))
+        try:
+            yield stdout
+        finally:
+            pipeline.close()
+            self._record(commands, start, pipeline.timed_out, False, stdout.bytes_read)
+
+    def run(self, command, timeout=None, max_output=None, stdin=None):
+        """Run `command` to completion and return a CommandResult.
+
+        The call returns within `timeout` plus 2 * KILL_GRACE seconds whatever the command does: output
+        is read until the deadline, then the pipeline gets SIGTERM and is reaped with bounded waits.
+        Output beyond `max_output` bytes is dropped and the pipeline terminated the same way; stderr is
+        collected from every stage through a temporary file, so it can never block the command.
+        """
+        commands = [command] if isinstance(command, str) else command
+        max_output = self.max_output if max_output is None else max_output
+        start = time.monotonic()
+        chunks, size, truncated = [], 0, False
+        with tempfile.TemporaryFile() as stderr:
+            pipeline = Pipeline(commands, stdin=stdin, stderr=stderr)
+            stdout = PipeReader(pipeline, start + (self.timeout if timeout is None else timeout))
+            try:
+                while True:
+                    chunk = stdout.read1(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if size + len(chunk) > max_output:
+                        chunks.append(chunk[:max_output - size])
+                        truncated = True
+                        pipeline.signal(signal.SIGTERM)
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+            finally:
+                pipeline.close()
+            returncode = pipeline.returncode
+            timed_out = pipeline.timed_out
+            stderr.seek(0)
+            err = stderr.read(max_output)
+
+        stdout = b''.join(chunks)
+        self._record(commands, start, timed_out, truncated, len(stdout) + len(err))
+        if timed_out:
+            err += f'Timed out after {self.timeout if timeout is None else timeout}s'.encode()
+        return CommandResult(stdout, err, returncode, time.monotonic() - start, timed_out, truncated)
+
+    def flush_metrics(self, check, prefix):
+        """Report and forget the executions recorded since the last flush, tagged by command name."""
+        executions, self.executions = self.executions, []
+        totals = {}
+        for execution in executions:
+            check.histogram(f'{prefix}.command.duration', execution.duration, tags=[f'command:{execution.name}'])
+            count, timeouts = totals.get(execution.name, (0, 0))
+            totals[execution.name] = (count + 1, timeouts + execution.timed_out)
+        for name, (count, timeouts) in totals.items():
+            check.gauge(f'{prefix}.command.count', count, tags=[f'command:{name}'])
+            check.gauge(f'{prefix}.command.timeouts.count', timeouts, tags=[f'command:{name}'])
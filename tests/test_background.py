@@ -0,0 +1,71 @@
+import itertools
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from dd_background import BackgroundCollector, Snapshot
+
+
+class TestBackgroundCollector(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.check = MagicMock()
+
+    def test_collector_keeps_last_successful_snapshot(self):
+        # given
+        results = itertools.chain([{'run': 1}, Exception('lsof timed out')], itertools.repeat({'run': 3}))
+        fetched = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            if len(calls) >= 3:
+                fetched.set()
+            result = next(results)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        collector = BackgroundCollector(fetch, interval=0.01)
+
+        # when
+        collector.start()
+        fetched.wait(5)
+        collector.stop(timeout=5)
+
+        # then
+        self.assertEqual(collector.snapshot.data, {'run': 3})
+        self.assertEqual(str(collector.error), 'lsof timed out')
+
+    def test_current_reports_age_and_duration(self):
+        # given
+        collector = BackgroundCollector(MagicMock())
+        collector.snapshot = Snapshot({'queue': 1}, 100.0, 2.5)
+        collector.error = ValueError('truncated')
+
+        # when
+        with patch('dd_background.time.monotonic', return_value=130.0):
+            result = collector.current(self.check, 'dd.check', max_age=60)
+
+        # then
+        self.assertEqual(result, {'queue': 1})
+        self.check.gauge.assert_any_call('dd.check.snapshot.age', 30.0)
+        self.check.gauge.assert_any_call('dd.check.snapshot.collection_duration', 2.5)
+        self.check.log.warning.assert_called_once()
+        self.assertIsNone(collector.error)
+
+    def test_current_returns_none_caused_stale_or_missing_snapshot(self):
+        # given
+        collector = BackgroundCollector(MagicMock())
+
+        # when
+        missing = collector.current(self.check, 'dd.check', max_age=60)
+        collector.snapshot = Snapshot({'queue': 1}, 100.0, 2.5)
+        with patch('dd_background.time.monotonic', return_value=161.0):
+            stale = collector.current(self.check, 'dd.check', max_age=60)
+
+        # then
+        self.assertIsNone(missing)
+        self.assertIsNone(stale)
+        self.check.gauge.assert_any_call('dd.check.snapshot.age', 61.0)
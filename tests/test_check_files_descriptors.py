@@ -1,8 +1,61 @@
 import builtins
+import os
+import pwd
+import shutil
+import tempfile
+from collections import Counter
 from unittest import TestCase
-from unittest.mock import patch, call, mock_open
-
-from dd_check_files_descriptors import FilesDescriptorsCheck, GetDeletedStatsException
+from unittest.mock import MagicMock, patch, call, mock_open
+
+from dd_check_files_descriptors import FilesDescriptorsCheck, GetDeletedStatsException, scan_deleted_files, \
+    has_proc_fd_access, parse_lsof_deleted_files, DeletedFd, DeletedFilesSummary, FdInventoryCache, \
+    scan_process_deleted_files, DeepScanSchedule, FdUsage, scan_fd_usage, \
+    MetricBuffer, SHARED_SCANS, filter_deleted_files
+from dd_process_snapshot import SNAPSHOTS, ProcessSnapshot, scan_processes
+from dd_subprocess import CommandResult
+
+LSOF_SAMPLE = (b'p100\nu0\nn/\nn/var/log/app.log (deleted)\n'
+               b'p200\nu1001\nn/tmp/upload (deleted)\nn/tmp/other (deleted)\nnpipe\n')
+# a process with 3 threads, listed once per task by an lsof ignoring -K i: fd 4 is the same deleted file every time
+LSOF_THREADED_SAMPLE = (
+    'p300\nu1001\nfcwd\nD0x803\ni2\nn/\nf4\nD0x803\ni1234\nn/var/log/app.log (deleted)\n'
+    'f5\nD0x803\ni1234\nn/var/log/app.log (deleted)\n'
+    + ''.join(f'p300\nK{task}\nu1001\nf4\nD0x803\ni1234\nn/var/log/app.log (deleted)\n' for task in (301, 302, 303))
+)
+
+
+def write_proc_stat(root, pid, starttime):
+    with open(os.path.join(root, str(pid), 'stat'), 'w') as fh:
+        fh.write(f'{pid} (ruby app) S 1 {pid} {pid} 0 -1 4194560' + ' 0' * 12 + f' {starttime} 0 0\n')
+
+
+def write_limits(root, pid, soft_limit):
+    with open(os.path.join(root, str(pid), 'limits'), 'w') as fh:
+        fh.write('Limit                     Soft Limit           Hard Limit           Units     \n'
+                 'Max processes             63448                63448                processes \n'
+                 f'Max open files            {soft_limit:<21}1048576              files     \n')
+
+
+def make_proc_tree(root, processes):
+    """Build a fake /proc where every process has a stat file and every fd is a symlink.
+
+    A string target is linked as is; a (name, size) target is linked to a real file called '<name> (deleted)'
+    of that size, shared by every fd naming it, so it can be stat-ed like an unlinked file behind /proc/<pid>/fd.
+    """
+    files_dir = os.path.join(root, 'files')
+    os.makedirs(files_dir, exist_ok=True)
+    for pid, targets in processes.items():
+        fd_dir = os.path.join(root, str(pid), 'fd')
+        os.makedirs(fd_dir)
+        for fd, target in enumerate(targets):
+            if isinstance(target, tuple):
+                name, size = target
+                target = os.path.join(files_dir, f'{name} (deleted)')
+                if not os.path.exists(target):
+                    with open(target, 'wb') as fh:
+                        fh.truncate(size)
+            os.symlink(target, os.path.join(fd_dir, str(fd)))
+        write_proc_stat(root, pid, starttime=1000)
 
 
 class TestFileDescMonCheck(TestCase):
@@ -11,116 +64,421 @@ class TestFileDescMonCheck(TestCase):
     def setUp(self):
         super().setUp()
 
-        self.patch_logging = patch('dd_check_files_descriptors.logging').start()
+        self.patch_logging = patch('dd_logging.get_logger').start()
+        SHARED_SCANS.clear()
+        SNAPSHOTS.clear()
         self.file_descriptors_check = FilesDescriptorsCheck()
-        self.file_descriptors_check.metrics_collected = {
-            'global': {},
-            'local': {}
-        }
 
     def tearDown(self):
         super().tearDown()
         patch.stopall()
 
-    def test_get_size_of_deleted_files_successfully(self):
+    def test_get_deleted_files_successfully(self):
         # given
-        expected_result = 3213
+        self.file_descriptors_check.init_config = {'deleted_files_collector': 'lsof'}
+        expected_result = [DeletedFd(100, 0, None, None, None, '/var/log/app.log'),
+                           DeletedFd(200, 1001, None, None, None, '/tmp/upload'),
+                           DeletedFd(200, 1001, None, None, None, '/tmp/other')]
 
         # when
-        with patch.object(self.file_descriptors_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.return_value = (b'3213\n', None)
-            result = self.file_descriptors_check.get_size_of_deleted_files()
+        with patch.object(self.file_descriptors_check, 'runner') as mock_runner:
+            mock_runner.run.return_value = CommandResult(LSOF_SAMPLE, b'', 0, 0.1, False, False)
+            result = self.file_descriptors_check.get_deleted_files()
 
         # then
         self.assertEqual(expected_result, result)
 
-    def test_get_size_of_deleted_files_unsuccessfully_caused_exception(self):
+    def test_get_deleted_files_unsuccessfully_caused_exception(self):
         # given
+        self.file_descriptors_check.init_config = {'deleted_files_collector': 'lsof'}
         test_exception_err = 'test exception'
 
         # when
         with self.assertRaises(GetDeletedStatsException):
-            with patch.object(self.file_descriptors_check, '_exec_command') as mock_exec_cmd:
-                mock_exec_cmd().communicate.side_effect = Exception(test_exception_err)
-                self.file_descriptors_check.get_size_of_deleted_files()
+            with patch.object(self.file_descriptors_check, 'runner') as mock_runner:
+                mock_runner.run.side_effect = Exception(test_exception_err)
+                self.file_descriptors_check.get_deleted_files()
+
+        mock_runner.run.assert_called_once()
+
+    def test_get_deleted_files_unsuccessfully_caused_timeout(self):
+        # given
+        self.file_descriptors_check.init_config = {'deleted_files_collector': 'lsof', 'command_timeout': 5}
+
+        # when
+        with self.assertRaises(GetDeletedStatsException):
+            with patch.object(self.file_descriptors_check, 'runner') as mock_runner:
+                mock_runner.run.return_value = CommandResult(LSOF_SAMPLE[:10], b'', -9, 5.0, True, False)
+                self.file_descriptors_check.get_deleted_files()
+
+        # then
+        mock_runner.run.assert_called_once_with('sudo lsof -w -K i -F pufDin', timeout=5)
+
+    def test_get_deleted_files_from_proc_successfully(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {
+                100: [('app.log', 4096), '/dev/null', 'socket:[1234]'],
+                200: [('upload', 10), ('other', 20)],
+            })
+            self.file_descriptors_check.init_config = {'deleted_files_collector': 'proc', 'proc_root': proc_root}
+
+            # when
+            with patch.object(self.file_descriptors_check, 'runner') as mock_runner:
+                result = self.file_descriptors_check.get_deleted_files()
+
+        # then
+        self.assertEqual(sorted((fd.pid, fd.uid, fd.size) for fd in result),
+                         [(100, os.getuid(), 4096), (200, os.getuid(), 10), (200, os.getuid(), 20)])
+        mock_runner.run.assert_not_called()
+
+    def test_get_deleted_files_applies_instance_path_filters(self):
+        # given
+        self.file_descriptors_check.init_config = self.file_descriptors_check._get_init_config(
+            {'deleted_files_collector': 'lsof', 'path_filters': ['/var/log']})
+
+        # when
+        with patch.object(self.file_descriptors_check, 'runner') as mock_runner:
+            mock_runner.run.return_value = CommandResult(LSOF_SAMPLE, b'', 0, 0.1, False, False)
+            result = self.file_descriptors_check.get_deleted_files(collector='lsof')
+
+        # then
+        self.assertEqual(result, [DeletedFd(100, 0, None, None, None, '/var/log/app.log')])
+
+    def test_filter_deleted_files_matches_directories_and_paths(self):
+        # given
+        deleted_fds = [DeletedFd(1, 0, None, None, None, path)
+                       for path in ['/var/log/a.log', '/var/logs/b.log', '/tmp/upload', None]]
+
+        # when
+        result = filter_deleted_files(deleted_fds, ['/var/log/', '/tmp/upload'])
+
+        # then
+        self.assertEqual([fd.path for fd in result], ['/var/log/a.log', '/tmp/upload'])
+        self.assertIs(filter_deleted_files(deleted_fds, []), deleted_fds)
 
-        mock_exec_cmd().communicate.assert_called_once()
-        mock_exec_cmd().stdout.close.not_called()
+    def test_get_deleted_files_shares_scan_between_instances(self):
+        # given
+        other_check = FilesDescriptorsCheck()
+        self.file_descriptors_check.init_config = self.file_descriptors_check._get_init_config({'tags': ['app:a']})
+        other_check.init_config = other_check._get_init_config({'path_filters': ['/tmp']})
+
+        # when
+        with patch.object(FilesDescriptorsCheck, 'runner') as mock_runner:
+            mock_runner.run.return_value = CommandResult(LSOF_SAMPLE, b'', 0, 0.1, False, False)
+            first = self.file_descriptors_check.get_deleted_files(collector='lsof')
+            second = other_check.get_deleted_files(collector='lsof')
+
+        # then
+        mock_runner.run.assert_called_once()
+        self.assertEqual(len(first), 3)
+        self.assertEqual([fd.path for fd in second], ['/tmp/upload', '/tmp/other'])
+
+    def test_get_deleted_files_rescans_caused_shared_scan_disabled(self):
+        # given
+        self.file_descriptors_check.init_config = {'shared_scan_interval': 0}
+
+        # when
+        with patch.object(self.file_descriptors_check, 'runner') as mock_runner:
+            mock_runner.run.return_value = CommandResult(LSOF_SAMPLE, b'', 0, 0.1, False, False)
+            self.file_descriptors_check.get_deleted_files(collector='lsof')
+            self.file_descriptors_check.get_deleted_files(collector='lsof')
+
+        # then
+        self.assertEqual(mock_runner.run.call_count, 2)
+
+    def test_scan_deleted_files_matches_lsof_parser(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: ['/', ('app.log', 1)], 'self': [('b', 1)]})
+
+            # when
+            proc_result = DeletedFilesSummary(scan_deleted_files(scan_processes(proc_root), proc_root=proc_root))
+        lsof_result = DeletedFilesSummary(parse_lsof_deleted_files(f'p100\nu{os.getuid()}\nn/\nn/app.log (deleted)\n'))
+
+        # then
+        self.assertEqual(proc_result.count_by_uid, lsof_result.count_by_uid)
+
+    def test_parse_lsof_deleted_files_counts_threaded_process_fds_once(self):
+        # when
+        result = parse_lsof_deleted_files(LSOF_THREADED_SAMPLE)
+
+        # then
+        self.assertEqual(result, [DeletedFd(300, 1001, 0x803, 1234, None, '/var/log/app.log'),
+                                  DeletedFd(300, 1001, 0x803, 1234, None, '/var/log/app.log')])
+        self.assertEqual(DeletedFilesSummary(result).count_total, 2)
+
+    def test_deleted_files_summary_dedupes_shared_inodes(self):
+        # given
+        deleted_fds = [
+            DeletedFd(pid=10, uid=1001, dev=1, ino=7, size=4000),
+            DeletedFd(pid=10, uid=1001, dev=1, ino=7, size=4000),
+            DeletedFd(pid=11, uid=1001, dev=1, ino=7, size=4000),
+            DeletedFd(pid=12, uid=1002, dev=1, ino=7, size=4000),
+            DeletedFd(pid=12, uid=1002, dev=1, ino=8, size=10),
+        ]
+
+        # when
+        summary = DeletedFilesSummary(deleted_fds)
+
+        # then
+        self.assertEqual(summary.count_total, 5)
+        self.assertEqual(summary.bytes_total, 4010)
+        self.assertEqual(summary.bytes_by_uid, Counter({1001: 4000, 1002: 4010}))
+        self.assertEqual(summary.top_pids(2), [(12, 4010), (10, 4000)])
+
+    def test_has_proc_fd_access_needs_dac_read_search_and_sys_ptrace(self):
+        # when
+        results = []
+        for cap_eff in ('0000000000080004', '0000000000000004', '0000000000080000', '000001ffffffffff'):
+            cap_status = f"CapInh:\t0000000000000000\nCapEff:\t{cap_eff}\n"
+            with patch.object(builtins, 'open', mock_open(read_data=cap_status)):
+                results.append(has_proc_fd_access())
+
+        # then
+        self.assertEqual(results, [True, False, False, True])
+
+    def test_get_deleted_files_from_proc_logs_processes_caused_permission_denied(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: [('app.log', 4096)], 200: [('upload', 10)]})
+            self.file_descriptors_check.init_config = {'deleted_files_collector': 'proc', 'proc_root': proc_root,
+                                                       'shared_scan_interval': 0}
+            self.file_descriptors_check.log = MagicMock()
+            readlink = os.readlink
+
+            def denied_readlink(path):
+                if f'{os.sep}200{os.sep}' in path:
+                    raise PermissionError(13, 'Permission denied', path)
+                return readlink(path)
+
+            # when
+            with patch('os.readlink', side_effect=denied_readlink):
+                result = self.file_descriptors_check.get_deleted_files()
+
+        # then
+        self.assertEqual([fd.pid for fd in result], [100])
+        self.file_descriptors_check.log.warning.assert_called_once()
+        self.assertIn('FDs of 1 processes not readable', self.file_descriptors_check.log.warning.call_args[0][0])
 
     def test_collect_successfully_with_users(self):
         # given
         self.file_descriptors_check.init_config = {'mon_user_list': ['testing-user-1', 'testing-user-2']}
 
         expected_result = {
-            'global': {'dd.check_files_descriptors.global.current_size.count': 1000,
-                       'dd.check_files_descriptors.global.deleted_files.count': 2345,
-                       'dd.check_files_descriptors.global.limit_size.count': 999999},
-            'local': {'dd.check_files_descriptors.local.testing-user-1.deleted_files.count': 555,
-                      'dd.check_files_descriptors.local.testing-user-2.deleted_files.count': 235}
+            'dd.check_files_descriptors.global.current_size.count': 1000,
+            'dd.check_files_descriptors.global.deleted_files.count': 2345,
+            'dd.check_files_descriptors.global.limit_size.count': 999999,
+            'dd.check_files_descriptors.local.testing-user-1.deleted_files.count': 555,
+            'dd.check_files_descriptors.local.testing-user-2.deleted_files.count': 235
         }
 
         # when
-        with patch.object(self.file_descriptors_check, '_get_global_stats') as mock_glob_stats:
-            with patch.object(self.file_descriptors_check, 'get_size_of_deleted_files') as mock_del_files:
-                mock_glob_stats.return_value = ['1000', '0', '999999']
-                mock_del_files.side_effect = [2345, 555, 235]
-                self.file_descriptors_check.collect()
+        with patch.object(self.file_descriptors_check, '_get_global_stats') as mock_glob_stats, \
+                patch.object(self.file_descriptors_check, '_get_collector', return_value='lsof'), \
+                patch.object(self.file_descriptors_check, 'get_deleted_files') as mock_del_files, \
+                patch('dd_check_files_descriptors.get_uid', side_effect=[1001, 1002]):
+            mock_glob_stats.return_value = ['1000', '0', '999999']
+            mock_del_files.return_value = [DeletedFd(1, 0, None, None, None)] * 1555 + \
+                [DeletedFd(2, 1001, None, None, None)] * 555 + [DeletedFd(3, 1002, None, None, None)] * 235
+            self.file_descriptors_check.collect()
 
-        self.assertEqual(self.file_descriptors_check.metrics_collected, expected_result)
+        # then
+        mock_del_files.assert_called_once()
+        self.assertEqual({record.name: record.value for record in self.file_descriptors_check.metrics},
+                         expected_result)
 
     def test_collect_successfully_without_users(self):
         # given
         self.file_descriptors_check.init_config = {'mon_user_list': []}
 
         expected_result = {
-            'global': {'dd.check_files_descriptors.global.current_size.count': 5020,
-                       'dd.check_files_descriptors.global.deleted_files.count': 10,
-                       'dd.check_files_descriptors.global.limit_size.count': 88888},
-            'local': {}}
+            'dd.check_files_descriptors.global.current_size.count': 5020,
+            'dd.check_files_descriptors.global.deleted_files.count': 10,
+            'dd.check_files_descriptors.global.limit_size.count': 88888
+        }
 
         # when
         with patch.object(self.file_descriptors_check, '_get_global_stats') as mock_glob_stats:
-            with patch.object(self.file_descriptors_check, 'get_size_of_deleted_files') as mock_del_files:
+            with patch.object(self.file_descriptors_check, 'get_deleted_files') as mock_del_files, \
+                    patch.object(self.file_descriptors_check, '_get_collector', return_value='lsof'):
                 mock_glob_stats.return_value = ['5020', '0', '88888']
-                mock_del_files.return_value = 10
+                mock_del_files.return_value = [DeletedFd(1, 0, None, None, None)] * 10
+                self.file_descriptors_check.collect()
+
+        # then
+        self.assertEqual({record.name: record.value for record in self.file_descriptors_check.metrics},
+                         expected_result)
+
+    def test_collect_successfully_with_deleted_bytes_from_proc(self):
+        # given
+        user = pwd.getpwuid(os.getuid()).pw_name
+
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: [('app.log', 4096)], 200: [('app.log', 4096), ('tmp', 16)]})
+            self.file_descriptors_check.init_config = {'mon_user_list': [user], 'deleted_files_collector': 'proc',
+                                                       'proc_root': proc_root, 'top_pids_count': 1}
+
+            # when
+            with patch.object(self.file_descriptors_check, '_get_global_stats', return_value=['10', '0', '100']), \
+                    patch.object(self.file_descriptors_check, 'gauge') as mock_gauge:
                 self.file_descriptors_check.collect()
+                self.file_descriptors_check.report()
+
+        # then
+        mock_gauge.assert_any_call('dd.check_files_descriptors.global.deleted_files.bytes', 4112)
+        mock_gauge.assert_any_call(f'dd.check_files_descriptors.local.{user}.deleted_files.bytes', 4112)
+        mock_gauge.assert_any_call('dd.check_files_descriptors.top_pids.deleted_files.bytes', 4112,
+                                   tags=['pid:200', f'user:{user}', 'command:unknown'])
+
+    def test_fd_inventory_cache_rescans_only_changed_processes(self):
+        # given
+        cache = FdInventoryCache(max_age=300)
+
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: [('app.log', 10)], 200: ['/dev/null'], 300: [('tmp', 5)]})
+
+            # when
+            with patch('dd_process_snapshot.get_fd_count', side_effect=lambda fd_dir: len(os.listdir(fd_dir))):
+                first_result = cache.scan(scan_processes(proc_root), proc_root=proc_root, now=0)
+                os.symlink(os.path.join(proc_root, 'files', 'tmp (deleted)'),
+                           os.path.join(proc_root, '200', 'fd', '1'))
+                shutil.rmtree(os.path.join(proc_root, '300'))
+                with patch('dd_check_files_descriptors.scan_process_deleted_files',
+                           wraps=scan_process_deleted_files) as mock_scan_process:
+                    second_result = cache.scan(scan_processes(proc_root), proc_root=proc_root, now=10)
+
+        # then
+        self.assertEqual(sorted(fd.pid for fd in first_result), [100, 300])
+        self.assertEqual(sorted(fd.pid for fd in second_result), [100, 200])
+        mock_scan_process.assert_called_once_with(proc_root, '200', os.getuid())
+        self.assertEqual(sorted(cache.entries), [(100, 1000), (200, 1000)])
+
+    def test_fd_inventory_cache_misses_same_count_fd_swap_until_max_age(self):
+        # given
+        cache = FdInventoryCache(max_age=60)
+
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: ['/dev/null', ('app.log', 10)]})
+
+            # when
+            with patch('dd_process_snapshot.get_fd_count', side_effect=lambda fd_dir: len(os.listdir(fd_dir))):
+                first_result = cache.scan(scan_processes(proc_root), proc_root=proc_root, now=0)
+                os.unlink(os.path.join(proc_root, '100', 'fd', '0'))
+                os.symlink(os.path.join(proc_root, 'files', 'app.log (deleted)'),
+                           os.path.join(proc_root, '100', 'fd', '0'))
+                same_count_result = cache.scan(scan_processes(proc_root), proc_root=proc_root, now=30)
+                expired_result = cache.scan(scan_processes(proc_root), proc_root=proc_root, now=60)
+
+        # then
+        self.assertEqual(len(first_result), 1)
+        self.assertEqual(same_count_result, first_result)
+        self.assertEqual(len(expired_result), 2)
+
+    def test_fd_inventory_cache_rescans_reused_pid_and_expired_entries(self):
+        # given
+        cache = FdInventoryCache(max_age=60)
+
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: [('app.log', 10)], 200: [('tmp', 5)]})
+            cache.scan(scan_processes(proc_root), proc_root=proc_root, now=0)
+
+            # when
+            write_proc_stat(proc_root, 100, starttime=5000)
+            with patch('dd_check_files_descriptors.scan_process_deleted_files',
+                       wraps=scan_process_deleted_files) as mock_scan_process:
+                cache.scan(scan_processes(proc_root), proc_root=proc_root, now=30)
+                cache.scan(scan_processes(proc_root), proc_root=proc_root, now=61)
 
         # then
-        self.assertEqual(self.file_descriptors_check.metrics_collected, expected_result)
+        uid = os.getuid()
+        self.assertEqual(mock_scan_process.call_args_list, [call(proc_root, '100', uid), call(proc_root, '200', uid)])
 
     def test_report_call_successfully(self):
         # given
-        self.file_descriptors_check.metrics_collected = {
-            'global': {'dd.check_files_descriptors.global.current_size.count': 5020,
-                       'dd.check_files_descriptors.global.deleted_files.count': 10,
-                       'dd.check_files_descriptors.global.limit_size.count': 88888},
-            'local': {}
-        }
+        metrics = self.file_descriptors_check.metrics = MetricBuffer()
+        metrics.set('dd.check_files_descriptors.global.current_size.count', 5020)
+        metrics.set('dd.check_files_descriptors.global.deleted_files.count', 10)
+        metrics.set('dd.check_files_descriptors.top_pids.deleted_files.bytes', 10, tags=['pid:1'])
 
         # when
         with patch.object(self.file_descriptors_check, 'gauge') as mock_gauge:
             self.file_descriptors_check.report()
 
         # then
-        mock_gauge.has_calls = [
+        mock_gauge.assert_has_calls([
             call('dd.check_files_descriptors.global.current_size.count', 5020),
             call('dd.check_files_descriptors.global.deleted_files.count', 10),
-            call('dd.check_files_descriptors.global.limit_size.count', 88888)
-        ]
+            call('dd.check_files_descriptors.top_pids.deleted_files.bytes', 10, tags=['pid:1']),
+            call('dd.check_files_descriptors.metrics.count', 3, tags=[]),
+        ])
+        self.assertEqual(mock_gauge.call_count, 5)
 
     def test_report_without_metrics_caused_not_called(self):
         # given
-        self.file_descriptors_check.metrics_collected = {
-            'global': {},
-            'local': {}
-        }
+        self.file_descriptors_check.metrics = MetricBuffer()
 
         # when
         with patch.object(self.file_descriptors_check, 'gauge') as mock_gauge:
             self.file_descriptors_check.report()
 
         # then
-        mock_gauge.not_called()
+        mock_gauge.assert_any_call('dd.check_files_descriptors.metrics.count', 0, tags=[])
+        self.assertEqual(mock_gauge.call_count, 2)
+
+    def test_metric_buffer_keeps_last_value_per_series(self):
+        # given
+        metrics = MetricBuffer()
+
+        # when
+        metrics.set('dd.metric', 1)
+        metrics.set('dd.metric', 2)
+        metrics.set('dd.metric', 3, tags=['pid:1'])
+        metrics.set('dd.metric', 4, tags=['pid:1'])
+
+        # then
+        self.assertEqual(len(metrics), 2)
+        self.assertEqual(metrics.get('dd.metric'), 2)
+        self.assertEqual(metrics.get('dd.metric', ['pid:1']), 4)
+
+    def test_collect_drops_series_gone_since_last_run(self):
+        # given
+        self.file_descriptors_check.init_config = {'mon_user_list': [], 'fd_usage_top_count': 3}
+
+        file_nr = [['10', '0', '100'], ['20', '0', '100']]
+
+        # when
+        with patch.object(self.file_descriptors_check, '_get_global_stats', side_effect=file_nr), \
+                patch.object(self.file_descriptors_check, '_get_collector', return_value='lsof'), \
+                patch.object(self.file_descriptors_check, 'get_deleted_files', return_value=[]), \
+                patch('dd_check_files_descriptors.scan_fd_usage', side_effect=[[FdUsage(1234, 0, 900, 1024)], []]), \
+                patch('dd_check_files_descriptors.get_process_name', return_value='ruby'):
+            self.file_descriptors_check.collect()
+            first = len(self.file_descriptors_check.metrics)
+            self.file_descriptors_check.collect()
+
+        # then
+        metrics = self.file_descriptors_check.metrics
+        self.assertEqual(first, 6)
+        self.assertEqual(len(metrics), 3)
+        self.assertEqual(metrics.get('dd.check_files_descriptors.global.current_size.count'), 20)
+
+    def test_collect_tags_metrics_with_instance_tags(self):
+        # given
+        self.file_descriptors_check.init_config = self.file_descriptors_check._get_init_config(
+            {'tags': ['app:web'], 'mon_user_list': ['root']})
+
+        # when
+        with patch.object(self.file_descriptors_check, '_get_global_stats', return_value=['10', '0', '100']), \
+                patch.object(self.file_descriptors_check, '_get_collector', return_value='lsof'), \
+                patch.object(self.file_descriptors_check, 'get_deleted_files', return_value=[]):
+            self.file_descriptors_check.collect()
+
+        # then
+        metrics = self.file_descriptors_check.metrics
+        self.assertEqual(self.file_descriptors_check.init_config['mon_user_list'], ['root'])
+        self.assertEqual(metrics.get('dd.check_files_descriptors.global.current_size.count'), 10)
+        self.assertTrue(all(record.tags[:1] == ['app:web'] for record in metrics))
 
     def test_get_global_stats_successfully(self):
         # given
@@ -135,16 +493,109 @@ class TestFileDescMonCheck(TestCase):
 
     def test_check_with_logging_successfully(self):
         # given
-        self.file_descriptors_check.metrics_collected = {
-            'global': {'dd.check_files_descriptors.global.current_size.count': 5020,
-                       'dd.check_files_descriptors.global.deleted_files.count': 10,
-                       'dd.check_files_descriptors.global.limit_size.count': 88888},
-            'local': {}
-        }
+        self.file_descriptors_check.metrics = MetricBuffer()
+        self.file_descriptors_check.metrics.set('dd.check_files_descriptors.global.current_size.count', 5020)
 
         # when
         with patch.object(self.file_descriptors_check, 'collect'):
             self.file_descriptors_check.check({'test': 'test'})
 
         # then
-        self.assertEqual(self.file_descriptors_check.log.debug.call_count, 3)
+        self.file_descriptors_check.log.debug.assert_called_once_with('report: 1 metrics')
+
+    def test_check_reports_background_snapshot(self):
+        # given
+        self.file_descriptors_check.init_config = {'mon_user_list': [], 'background_collection': True}
+        summary = DeletedFilesSummary([DeletedFd(1, 0, None, None, None)] * 4)
+        background = self.file_descriptors_check.background = MagicMock()
+        background.current.side_effect = [(['1000', '0', '999999'], 'lsof', summary, []), None]
+
+        # when
+        with patch.object(self.file_descriptors_check, 'fetch') as mock_fetch, \
+                patch.object(self.file_descriptors_check, 'report') as mock_report:
+            self.file_descriptors_check.check({})
+            self.file_descriptors_check.check({})
+
+        # then
+        mock_fetch.assert_not_called()
+        mock_report.assert_called_once()
+        background.current.assert_called_with(self.file_descriptors_check, 'dd.check_files_descriptors', max_age=300)
+        self.assertEqual(
+            self.file_descriptors_check.metrics.get('dd.check_files_descriptors.global.deleted_files.count'), 4)
+
+    def test_deep_scan_schedule_due_on_delta_or_max_age(self):
+        # given
+        schedule = DeepScanSchedule(delta=500, max_age=300)
+
+        # when
+        first = schedule.due(10000, now=0)
+        schedule.record(10000, now=0)
+
+        # then
+        self.assertTrue(first)
+        self.assertFalse(schedule.due(10499, now=100))
+        self.assertTrue(schedule.due(9500, now=100))
+        self.assertTrue(schedule.due(10000, now=300))
+
+    def test_fetch_rescans_deleted_files_only_when_file_nr_moves(self):
+        # given
+        self.file_descriptors_check.init_config = {'deleted_files_collector': 'lsof', 'deep_scan_delta': 1000}
+        file_nr = [['5000', '0', '88888'], ['5400', '0', '88888'], ['6100', '0', '88888'], ['6200', '0', '88888']]
+
+        # when
+        with patch.object(self.file_descriptors_check, '_get_global_stats', side_effect=file_nr), \
+                patch.object(self.file_descriptors_check, 'get_deleted_files',
+                             side_effect=[[DeletedFd(1, 0, None, None, None)] * 3,
+                                          [DeletedFd(1, 0, None, None, None)] * 9]) as mock_del_files:
+            results = [self.file_descriptors_check.fetch() for _ in file_nr]
+
+        # then
+        self.assertEqual(mock_del_files.call_count, 2)
+        self.assertEqual([summary.count_total for _, _, summary, _ in results], [3, 3, 9, 9])
+        self.assertIs(results[0][2], results[1][2])
+        self.assertEqual(self.file_descriptors_check.deep_scan.open_files, 6100)
+
+    def test_scan_fd_usage_keeps_top_processes_by_utilisation(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_proc_tree(proc_root, {100: ['/dev/null'] * 90, 200: ['/dev/null'] * 10, 300: ['/dev/null'] * 500,
+                                       400: ['/dev/null'] * 3, 500: ['/dev/null'] * 5})
+            for pid, soft_limit in ((100, 100), (200, 1024), (300, 4096), (400, 4), (500, 'unlimited')):
+                write_limits(proc_root, pid, soft_limit)
+            uid = os.getuid()
+
+            # when
+            with patch('dd_process_snapshot.get_fd_count',
+                       side_effect=lambda fd_dir: len(os.listdir(fd_dir))):
+                snapshot = scan_processes(proc_root)
+                top = scan_fd_usage(snapshot, proc_root=proc_root, count=2)
+                everything = scan_fd_usage(snapshot, proc_root=proc_root, count=10)
+                other_users = scan_fd_usage(snapshot, proc_root=proc_root, count=10, uids={uid + 1})
+
+        # then
+        self.assertEqual(top, [FdUsage(100, uid, 90, 100), FdUsage(400, uid, 3, 4)])
+        self.assertEqual([usage.pid for usage in everything], [100, 400, 300, 200])
+        self.assertEqual(other_users, [])
+
+    def test_collect_reports_fd_usage(self):
+        # given
+        self.file_descriptors_check.init_config = {'mon_user_list': [], 'fd_usage_top_count': 3}
+        fd_usage = [FdUsage(1234, 0, 900, 1024)]
+        snapshot = ProcessSnapshot()
+
+        # when
+        with patch.object(self.file_descriptors_check, '_get_global_stats', return_value=['5020', '0', '88888']), \
+                patch.object(self.file_descriptors_check, '_get_collector', return_value='lsof'), \
+                patch.object(self.file_descriptors_check, 'get_deleted_files', return_value=[]), \
+                patch('dd_check_files_descriptors.get_process_snapshot', return_value=snapshot) as mock_snapshot, \
+                patch('dd_check_files_descriptors.scan_fd_usage', return_value=fd_usage) as mock_scan, \
+                patch('dd_check_files_descriptors.get_process_name', return_value='ruby'):
+            self.file_descriptors_check.collect()
+
+        # then
+        mock_snapshot.assert_called_once_with('/proc', max_age=10)
+        mock_scan.assert_called_once_with(snapshot, proc_root='/proc', count=3, uids=None)
+        tags = ['pid:1234', 'user:root', 'command:ruby']
+        metrics = self.file_descriptors_check.metrics
+        self.assertEqual(metrics.get('dd.check_files_descriptors.process.open_files', tags), 900)
+        self.assertEqual(metrics.get('dd.check_files_descriptors.process.open_files.utilization', tags), 900 / 1024)
@@ -1,8 +1,45 @@
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock, call
 
 from dd_check_passenger_mem_overload import PassengerMemOverloadCheck, GetProcessessOverloadedException, \
-    GetInstanceConfigException
+    GetInstanceConfigException, KillProcessException, DetachTimeoutException, DetachResult, ProcessMemory, \
+    MemoryTrendTracker, PAGE_SIZE, select_processes_to_free, DetachRegistry, DETACH_REGISTRY, DETACH_RUN_LOCK
+from dd_passenger_api import PassengerApiException
+from dd_process_snapshot import SNAPSHOTS, get_process_snapshot
+from dd_subprocess import CommandResult
+
+MB = 1024 * 1024
+
+
+def command_result(stdout=b'', stderr=b'', timed_out=False):
+    return CommandResult(stdout, stderr, -9 if timed_out else 0, 0.1, timed_out, False)
+
+
+def make_process(proc_root, pid, cmdline, smaps_rollup=None, statm=None, starttime=1000):
+    pid_dir = os.path.join(proc_root, str(pid))
+    os.makedirs(pid_dir)
+    with open(os.path.join(pid_dir, 'stat'), 'w') as fh:
+        fh.write(f'{pid} (ruby) S 1 {pid} {pid} 0 -1 4194560' + ' 0' * 12 + f' {starttime} 0 250\n')
+    with open(os.path.join(pid_dir, 'cmdline'), 'wb') as fh:
+        fh.write(cmdline)
+    if smaps_rollup is not None:
+        with open(os.path.join(pid_dir, 'smaps_rollup'), 'w') as fh:
+            fh.write('00400000-7ffd0000 ---p 00000000 00:00 0    [rollup]\n')
+            fh.writelines(f'{field + ":":<16}{value:>8} kB\n' for field, value in smaps_rollup.items())
+    if statm is not None:
+        with open(os.path.join(pid_dir, 'statm'), 'w') as fh:
+            fh.write(statm + '\n')
+
+
+def write_meminfo(proc_root, total_mb, available_mb):
+    with open(os.path.join(proc_root, 'meminfo'), 'w') as fh:
+        fh.write(f'MemTotal:       {total_mb * 1024} kB\nMemFree:          102400 kB\n'
+                 f'MemAvailable:   {available_mb * 1024} kB\nHugePages_Total:       0\n')
 
 
 class TestPassengerMemOverloadCheck(TestCase):
@@ -11,8 +48,12 @@ class TestPassengerMemOverloadCheck(TestCase):
         super().setUp()
         self.passenger_mem_check = PassengerMemOverloadCheck()
         self.passenger_mem_check.threshold = 900
+        self.passenger_mem_check.use_api = False
+        self.runner = self.passenger_mem_check.runner = MagicMock()
+        SNAPSHOTS.clear()
+        DETACH_REGISTRY.clear()
 
-        self.patch_logging = patch('dd_check_passenger_mem_overload.logging').start()
+        self.patch_logging = patch('dd_logging.get_logger').start()
 
     def tearDown(self):
         super().tearDown()
@@ -20,79 +61,430 @@ class TestPassengerMemOverloadCheck(TestCase):
 
     def test_get_processes_overloaded_successfully(self):
         # given
-        test_overloaded_pid_list = ['1111111']
+        processes = [ProcessMemory(1111111, 990 * MB, 950 * MB, 901 * MB),
+                     ProcessMemory(2222222, 990 * MB, None, 899 * MB)]
+
+        # when
+        result = self.passenger_mem_check.get_processes_overloaded(processes)
+
+        # then
+        self.assertEqual(result, ['1111111'])
+
+    def test_get_processes_memory_successfully(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_process(proc_root, 100, b'Passenger RubyApp: /var/www/shop (production)\0\0',
+                         smaps_rollup={'Rss': 1000, 'Pss': 800, 'Private_Clean': 100, 'Private_Dirty': 500})
+            make_process(proc_root, 101, b'Passenger RubyApp: /var/www/shop (production)', statm='5000 300 100 1 0 2 0',
+                         starttime=2000)
+            make_process(proc_root, 102, b'Passenger AppPreloader: /var/www/shop\0',
+                         smaps_rollup={'Rss': 1000, 'Pss': 800, 'Private_Clean': 100, 'Private_Dirty': 500})
+            make_process(proc_root, 103, b'/usr/sbin/nginx\0-g\0daemon off;\0', statm='5000 300 100 1 0 2 0')
+            self.passenger_mem_check.proc_root = proc_root
+
+            # when
+            result = self.passenger_mem_check.get_processes_memory()
+
+        # then
+        self.assertEqual(sorted(result), [ProcessMemory(100, 1000 * 1024, 800 * 1024, 600 * 1024, 1000),
+                                          ProcessMemory(101, 300 * PAGE_SIZE, None, 200 * PAGE_SIZE, 2000)])
+        self.assertIsNone(get_process_snapshot(proc_root).fds)
+        self.runner.run.assert_not_called()
+
+    def test_memory_trend_tracker_evicts_exited_and_restarted_processes(self):
+        # given
+        tracker = MemoryTrendTracker(window=3, min_samples=2)
+
+        # when
+        tracker.update([ProcessMemory(1, 0, None, 100 * MB, 10), ProcessMemory(2, 0, None, 100 * MB, 20)], now=0)
+        tracker.update([ProcessMemory(1, 0, None, 110 * MB, 10), ProcessMemory(2, 0, None, 100 * MB, 20)], now=10)
+        for now in (20, 30, 40):
+            slopes = tracker.update([ProcessMemory(1, 0, None, (100 + now) * MB, 10),
+                                     ProcessMemory(3, 0, None, 100 * MB, 30)], now=now)
+        restarted = tracker.update([ProcessMemory(1, 0, None, 100 * MB, 99)], now=50)
+
+        # then
+        self.assertAlmostEqual(slopes[1], MB)
+        self.assertEqual(slopes[3], 0)
+        self.assertEqual(restarted, {})
+        self.assertEqual(list(tracker.samples), [(1, 99)])
+        self.assertEqual(len(tracker.samples[(1, 99)].times), 3)
+
+    def test_get_processes_trending_successfully(self):
+        # given
+        self.passenger_mem_check.trend_window = 10
+        self.passenger_mem_check.trend_horizon = 300
+        growing = [ProcessMemory(1, 0, None, 800 * MB, 10), ProcessMemory(2, 0, None, 800 * MB, 20),
+                   ProcessMemory(3, 0, None, 950 * MB, 30)]
 
         # when
-        with patch.object(self.passenger_mem_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.return_value = (b'1111111\n', None)
-            result = self.passenger_mem_check.get_processes_overloaded()
+        with patch('dd_check_passenger_mem_overload.time.monotonic', side_effect=[0, 60, 120]), \
+                patch.object(self.passenger_mem_check, 'gauge') as mock_gauge:
+            results = [self.passenger_mem_check.get_processes_trending(
+                [process._replace(private=process.private + step * MB * (process.pid == 1) * 30)
+                 for process in growing]) for step in range(3)]
+
+        # then
+        self.assertEqual(results, [[], [], ['1']])
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.process.private.growth_rate', MB / 2,
+                                   tags=['pid:1'])
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.process.private.growth_rate', 0,
+                                   tags=['pid:2'])
+
+    def test_select_processes_to_free_picks_fewest_largest(self):
+        # given
+        processes = [ProcessMemory(pid, 0, None, private * MB)
+                     for pid, private in enumerate([850, 300, 700, 850, 500, 820], start=1)]
+
+        # when
+        nothing = select_processes_to_free(processes, -5 * MB)
+        two = select_processes_to_free(processes, 1600 * MB)
+        unreachable = select_processes_to_free(processes, 10000 * MB)
+        over_max_count = select_processes_to_free(processes, 2000 * MB, max_count=2)
+        within_max_count = select_processes_to_free(processes, 2000 * MB, max_count=3)
+
+        # then
+        self.assertEqual(nothing, [])
+        self.assertEqual([process.pid for process in two], [1, 4])
+        self.assertEqual(unreachable, [])
+        self.assertEqual(over_max_count, [])
+        self.assertEqual([process.pid for process in within_max_count], [1, 4, 6])
+
+    def test_get_processes_over_budget_selects_nothing_caused_budget_unreachable(self):
+        # given
+        processes = [ProcessMemory(pid, 0, None, 200 * MB) for pid in range(1, 11)]
+        self.passenger_mem_check.memory_budget = 14000
+        self.passenger_mem_check.log = MagicMock()
+
+        with tempfile.TemporaryDirectory() as proc_root:
+            write_meminfo(proc_root, total_mb=16000, available_mb=500)
+            self.passenger_mem_check.proc_root = proc_root
+
+            # when
+            with patch.object(self.passenger_mem_check, 'gauge') as mock_gauge:
+                result = self.passenger_mem_check.get_processes_over_budget(processes, set())
+
+        # then
+        self.assertEqual(result, [])
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.budget.selected.count', 0)
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.budget.unreachable', 1)
+        self.passenger_mem_check.log.warning.assert_called_once()
+
+    def test_get_processes_over_budget_successfully(self):
+        # given
+        processes = [ProcessMemory(pid, 0, None, 850 * MB) for pid in range(1, 21)]
+        processes[4] = processes[4]._replace(private=870 * MB)
+        processes[7] = processes[7]._replace(private=860 * MB)
+        self.passenger_mem_check.memory_budget = 14000
+
+        with tempfile.TemporaryDirectory() as proc_root:
+            write_meminfo(proc_root, total_mb=16000, available_mb=500)
+            self.passenger_mem_check.proc_root = proc_root
+
+            # when
+            with patch.object(self.passenger_mem_check, 'gauge') as mock_gauge:
+                result = self.passenger_mem_check.get_processes_over_budget(processes, {'5'})
+                self.passenger_mem_check.memory_budget_dry_run = True
+                dry_run = self.passenger_mem_check.get_processes_over_budget(processes, set())
 
         # then
-        self.assertEqual(len(mock_exec_cmd.call_args_list), 4)
-        self.assertEqual(test_overloaded_pid_list, result)
-        mock_exec_cmd().communicate.assert_called_once()
+        self.assertEqual(result, ['8'])
+        self.assertEqual(dry_run, [])
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.host.memory.used', 15500 * MB)
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.budget.selected.count', 1)
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.budget.projected_used', 13770 * MB)
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.budget.selected.count', 2)
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.budget.selected.private', 870 * MB,
+                                   tags=['pid:5'])
 
     def test_get_processess_overloaded_failed_caused_by_exception(self):
         # given
-        test_exception_err = 'test exception'
+        self.passenger_mem_check.proc_root = '/nonexistent/proc'
 
         # when / then
         with self.assertRaises(GetProcessessOverloadedException):
-            with patch.object(self.passenger_mem_check, '_exec_command') as mock_exec_cmd:
-                mock_exec_cmd().communicate.side_effect = Exception(test_exception_err)
-                self.passenger_mem_check.get_processes_overloaded()
-
-        mock_exec_cmd().communicate.assert_called_once()
+            self.passenger_mem_check.get_processes_memory()
 
     def test_detach_process_successfully(self):
         # given
         expected_result = b'Process 20474 detached.\n'
 
+        self.runner.run.return_value = command_result(b'Process 20474 detached.\n')
+
         # when
-        with patch.object(self.passenger_mem_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.return_value = (b'Process 20474 detached.\n', None)
+        with patch('dd_check_passenger_mem_overload.time.monotonic', return_value=1000.0):
             result = self.passenger_mem_check.detach_process(pid_process='20474', sig_kill=None)
 
         # then
         self.assertEqual(result, expected_result)
-        mock_exec_cmd().communicate.assert_called_once()
+        self.runner.run.assert_called_once_with('sudo passenger-config detach-process 20474', timeout=30)
 
     def test_detach_process_successfully_after_retrying(self):
         # given
         expected_result = b'Process 16821 detached.\n'
 
+        self.runner.run.side_effect = [
+            command_result(stderr=b'Could not detach process 16821.\n'),
+            command_result(b'Process 16821 detached.\n')
+        ]
+
         # when
-        with patch.object(self.passenger_mem_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.side_effect = [
-                (b'', b'Could not detach process 16821.\n'),
-                (b'Process 16821 detached.\n', None)
-            ]
-            result = self.passenger_mem_check.detach_process(pid_process='16821', sig_kill=None)
+        result = self.passenger_mem_check.detach_process(pid_process='16821', sig_kill=None)
 
         # then
         self.assertEqual(result, expected_result)
-        self.assertEqual(mock_exec_cmd().communicate.call_count, 2)
+        self.assertEqual(self.runner.run.call_count, 2)
 
     def test_detach_process_successfully_after_signal_kill(self):
         # given
         expected_result = 'Process 16821 killed'
+        self.runner.run.side_effect = [
+            command_result(stderr=b'Could not detach process 16821.\n'),
+            command_result(stderr=b'Could not detach process 16821.\n'),
+            command_result()
+        ]
+
         # when
-        with patch.object(self.passenger_mem_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.side_effect = [
-                (b'', b'Could not detach process 16821.\n'),
-                (b'', b'Could not detach process 16821.\n'),
-                (b'', b'')
-            ]
-            result = self.passenger_mem_check.detach_process(pid_process='16821', sig_kill=None)
+        result = self.passenger_mem_check.detach_process(pid_process='16821', sig_kill=None)
 
         # then
         self.assertEqual(result, expected_result)
-        self.assertEqual(mock_exec_cmd().communicate.call_count, 3)
+        self.assertEqual(self.runner.run.call_count, 3)
+
+    def test_detach_process_successfully_through_api(self):
+        # given
+        self.passenger_mem_check.use_api = True
+        self.passenger_mem_check.api_client = MagicMock()
+        self.passenger_mem_check.api_client.detach_process.return_value = True
+
+        # when
+        with patch('dd_check_passenger_mem_overload.time.monotonic', return_value=1000.0):
+            result = self.passenger_mem_check.detach_process(pid_process='20474')
+
+        # then
+        self.assertEqual(result, 'Process 20474 detached.')
+        self.passenger_mem_check.api_client.detach_process.assert_called_once_with('20474', timeout=30)
+        self.runner.run.assert_not_called()
+
+    def test_detach_process_falls_back_to_cli_caused_api_exception(self):
+        # given
+        self.passenger_mem_check.use_api = True
+        api_client = self.passenger_mem_check.api_client = MagicMock()
+        api_client.detach_process.side_effect = PassengerApiException('connection refused')
+
+        self.runner.run.return_value = command_result(b'Process 20474 detached.\n')
+
+        # when
+        with patch('dd_check_passenger_mem_overload.PassengerApiClient',
+                   side_effect=PassengerApiException('no instance')):
+            results = self.passenger_mem_check.detach_processes(['20474'])
+
+        # then
+        self.assertEqual(results[0].status, b'Process 20474 detached.\n')
+        self.assertIsNone(self.passenger_mem_check.api_client)
+        self.assertEqual(self.passenger_mem_check.dropped_api_clients, ())
+        api_client.close.assert_called_once()
+
+    def test_drop_api_client_defers_close_and_ignores_stale_client(self):
+        # given
+        self.passenger_mem_check.use_api = True
+        stale_client = MagicMock()
+        new_client = self.passenger_mem_check.api_client = MagicMock()
+
+        # when
+        self.passenger_mem_check._drop_api_client(stale_client)
+        self.passenger_mem_check._drop_api_client(new_client)
+
+        # then
+        self.assertIsNone(self.passenger_mem_check.api_client)
+        self.assertEqual(self.passenger_mem_check.dropped_api_clients, (new_client,))
+        new_client.close.assert_not_called()
+        self.passenger_mem_check._close_dropped_api_clients()
+        new_client.close.assert_called_once()
+        stale_client.close.assert_not_called()
+
+    def test_detach_process_escalates_caused_timeout(self):
+        # given
+        self.passenger_mem_check.detach_timeout = 5
+
+        self.runner.run.side_effect = [
+            command_result(stderr=b'Timed out after 5s', timed_out=True),
+            command_result(b'Process 16821 detached.\n')
+        ]
+
+        # when
+        with patch('dd_check_passenger_mem_overload.time.monotonic', side_effect=[100.0, 100.0, 104.0]):
+            result = self.passenger_mem_check.detach_process(pid_process='16821')
+
+        # then
+        self.assertEqual(result, b'Process 16821 detached.\n')
+        detach_cmd = 'sudo passenger-config detach-process 16821'
+        self.assertEqual(self.runner.run.call_args_list, [call(detach_cmd, timeout=5), call(detach_cmd, timeout=1)])
+
+    def test_detach_process_unsuccessfully_caused_deadline_exceeded(self):
+        # given
+        self.passenger_mem_check.detach_timeout = 5
+
+        self.runner.run.side_effect = [
+            command_result(stderr=b'Timed out after 5s', timed_out=True),
+            command_result(stderr=b'Timed out after 1s', timed_out=True),
+        ]
+
+        # when / then
+        with patch('dd_check_passenger_mem_overload.time.monotonic', side_effect=[100.0, 100.0, 104.0, 105.0]), \
+                self.assertRaises(DetachTimeoutException):
+            self.passenger_mem_check.detach_process(pid_process='16821')
+        self.assertEqual(self.runner.run.call_count, 2)
+
+    def test_detach_process_unsuccessfully_caused_kill_error(self):
+        # given
+        self.runner.run.side_effect = [
+            command_result(stderr=b'Could not detach process 16821.\n'),
+            command_result(stderr=b'Could not detach process 16821.\n'),
+            command_result(stderr=b'kill: (16821): Operation not permitted\n')
+        ]
+
+        # when / then
+        with self.assertRaises(KillProcessException):
+            self.passenger_mem_check.detach_process(pid_process='16821')
+
+    def test_detach_processes_runs_in_parallel_with_bounded_concurrency(self):
+        # given
+        self.passenger_mem_check.detach_concurrency = 3
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def slow_detach(pid_process):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            if pid_process == '3':
+                raise KillProcessException('Operation not permitted')
+            return f'Process {pid_process} killed' if pid_process == '2' else f'Process {pid_process} detached.'
+
+        # when
+        with patch.object(self.passenger_mem_check, 'detach_process', side_effect=slow_detach):
+            start = time.monotonic()
+            results = self.passenger_mem_check.detach_processes([str(pid) for pid in range(1, 10)])
+            elapsed = time.monotonic() - start
+
+        # then
+        self.assertEqual(peak[0], 3)
+        self.assertLess(elapsed, 0.4)
+        self.assertEqual([(result.pid, result.outcome) for result in results[:4]],
+                         [('1', 'detached'), ('2', 'killed'), ('3', 'failed'), ('4', 'detached')])
+
+    def test_collect_reports_detach_outcomes(self):
+        # given
+        results = [DetachResult('1', 'detached', b'', 0.1), DetachResult('2', 'killed', b'', 0.2),
+                   DetachResult('3', 'killed', b'', 0.3)]
+
+        # when
+        with patch.object(self.passenger_mem_check, 'get_processes_memory', return_value=[]), \
+                patch.object(self.passenger_mem_check, 'get_processes_overloaded', return_value=['1', '2', '3']), \
+                patch.object(self.passenger_mem_check, 'detach_processes', return_value=results), \
+                patch.object(self.passenger_mem_check, 'gauge') as mock_gauge, \
+                patch.object(self.passenger_mem_check, 'histogram') as mock_histogram:
+            self.passenger_mem_check.collect()
+
+        # then
+        mock_gauge.assert_has_calls([
+            call('dd.check_passenger_mem_overload.detached_processess.count', 3),
+            call('dd.check_passenger_mem_overload.detach.detached.count', 1),
+            call('dd.check_passenger_mem_overload.detach.killed.count', 2),
+            call('dd.check_passenger_mem_overload.detach.failed.count', 0),
+        ])
+        mock_histogram.assert_any_call('dd.check_passenger_mem_overload.detach.duration', 0.2, tags=['outcome:killed'])
+        self.assertEqual(mock_histogram.call_count, 4)
+
+    def test_detach_registry_expires_claims_after_ttl(self):
+        # given
+        registry = DetachRegistry()
+
+        # when
+        first = registry.claim([('1', 10), ('2', 20)], ttl=60, now=0)
+        repeated = registry.claim([('1', 10), ('1', 99)], ttl=60, now=30)
+        registry.release([('2', 20)])
+        expired = registry.claim([('1', 10), ('2', 20)], ttl=60, now=61)
+
+        # then
+        self.assertEqual(first, ([('1', 10), ('2', 20)], []))
+        self.assertEqual(repeated, ([('1', 99)], [('1', 10)]))
+        self.assertEqual(expired, ([('1', 10), ('2', 20)], []))
+
+    def test_collect_skips_processes_already_being_detached(self):
+        # given
+        processes = [ProcessMemory(1, 0, None, 950 * MB, 10), ProcessMemory(2, 0, None, 950 * MB, 20)]
+        restarted = [ProcessMemory(1, 0, None, 950 * MB, 99), ProcessMemory(2, 0, None, 950 * MB, 20)]
+
+        def detach(pid_process):
+            if pid_process == '2':
+                raise KillProcessException('Operation not permitted')
+            return f'Process {pid_process} detached.'
+
+        # when
+        with patch.object(self.passenger_mem_check, 'get_processes_memory',
+                          side_effect=[processes, processes, restarted]), \
+                patch.object(self.passenger_mem_check, 'detach_process', side_effect=detach) as mock_detach, \
+                patch.object(self.passenger_mem_check, 'gauge') as mock_gauge:
+            self.passenger_mem_check.collect()
+            self.passenger_mem_check.collect()
+            self.passenger_mem_check.collect()
+
+        # then
+        self.assertEqual(mock_detach.call_args_list, [call('1'), call('2'), call('2'), call('1'), call('2')])
+        redundant = [args[1] for args, _ in mock_gauge.call_args_list
+                     if args[0] == 'dd.check_passenger_mem_overload.detach.redundant.count']
+        self.assertEqual(redundant, [0, 1, 0])
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.detach.in_flight.count', 1)
+
+    def test_collect_skips_detach_caused_run_in_progress(self):
+        # given
+        DETACH_RUN_LOCK.acquire()
+
+        # when
+        try:
+            with patch.object(self.passenger_mem_check, 'get_processes_memory', return_value=[]), \
+                    patch.object(self.passenger_mem_check, 'get_processes_overloaded', return_value=['1', '2']), \
+                    patch.object(self.passenger_mem_check, 'detach_process') as mock_detach, \
+                    patch.object(self.passenger_mem_check, 'gauge') as mock_gauge:
+                self.passenger_mem_check.collect()
+        finally:
+            DETACH_RUN_LOCK.release()
+
+        # then
+        mock_detach.assert_not_called()
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.detach.skipped.count', 2)
+        mock_gauge.assert_any_call('dd.check_passenger_mem_overload.detached_processess.count', 0)
+        self.assertEqual(len(DETACH_REGISTRY), 0)
+
+    def test_collect_reports_phases_caused_instrumentation_enabled(self):
+        # given
+        self.passenger_mem_check.instrumentation_enabled = True
+        self.runner.counters.return_value = (0, 0)
+
+        # when
+        with patch.object(self.passenger_mem_check, 'get_processes_memory', return_value=[]), \
+                patch.object(self.passenger_mem_check, 'get_processes_overloaded', return_value=['1', '2']), \
+                patch.object(self.passenger_mem_check, 'detach_process', return_value='Process 1 detached.'), \
+                patch.object(self.passenger_mem_check, 'histogram') as mock_histogram:
+            self.passenger_mem_check.collect()
+
+        # then
+        phases = Counter(kwargs['tags'][0] for args, kwargs in mock_histogram.call_args_list
+                         if args[0] == 'dd.check_passenger_mem_overload.phase.duration')
+        self.assertEqual(phases, {'phase:run': 1, 'phase:get_processes_trending': 1,
+                                  'phase:get_processes_over_budget': 1, 'phase:report_processes_memory': 1,
+                                  'phase:detach_processes': 1, 'phase:detach_process': 2})
 
     def test_collect_successfully(self):
         # given / when
-        with patch.object(self.passenger_mem_check, 'get_processes_overloaded',
-                          return_value=['11111', '22222']) as mock_get_processess_overloaded:
+        with patch.object(self.passenger_mem_check, 'get_processes_memory', return_value=[]), \
+                patch.object(self.passenger_mem_check, 'get_processes_overloaded',
+                             return_value=['11111', '22222']) as mock_get_processess_overloaded:
             with patch.object(self.passenger_mem_check, 'detach_process') as mock_detach_process:
                 mock_detach_process.side_effect = ['Process 11111 detached.\n', 'Process 22222 detached.\n']
                 self.passenger_mem_check.collect()
@@ -111,7 +503,24 @@ class TestPassengerMemOverloadCheck(TestCase):
         result = self.passenger_mem_check.get_instance_config(instance)
 
         # then
-        self.assertEqual(result, instance)
+        self.assertEqual(result, {'threshold': '900', 'passenger_api': True, 'passenger_instance_dir': None,
+                                  'detach_concurrency': 4, 'detach_timeout': 30, 'detach_in_flight_ttl': 300,
+                                  'proc_root': '/proc',
+                                  'process_pattern': r'^Passenger \w+App: ', 'trend_window': 0, 'trend_horizon': 300,
+                                  'memory_budget': None, 'memory_budget_dry_run': False, 'max_budget_detach': 4,
+                                  'log_level': 'DEBUG', 'instrumentation': False, 'process_snapshot_max_age': 10})
+
+    def test_get_instance_config_successfully_with_memory_budget_only(self):
+        # given
+        instance = {'memory_budget': 14000, 'memory_budget_dry_run': True}
+
+        # when
+        result = self.passenger_mem_check.get_instance_config(instance)
+
+        # then
+        self.assertIsNone(result['threshold'])
+        self.assertEqual(result['memory_budget'], 14000)
+        self.assertTrue(result['memory_budget_dry_run'])
 
     def test_get_instance_config_unsuccessfully_caused_exception(self):
         # given
@@ -122,4 +531,4 @@ class TestPassengerMemOverloadCheck(TestCase):
             self.passenger_mem_check.get_instance_config(instance)
 
         # then
-        self.assertEqual(exc.exception.message, 'A threshold must be specified in cfg')
+        self.assertEqual(exc.exception.message, 'A threshold or a memory_budget must be specified in cfg')
@@ -1,8 +1,17 @@
+import io
 import json
+import os
+import tempfile
+import time
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
-from dd_check_passenger_queue import PassengerQueueCheck, GetQueueSizeException, GetRequestsException
+from dd_check_passenger_queue import PassengerQueueCheck, GetPoolStatusException, GetRequestsException, \
+    stream_requests_summary, parse_queue_size, QueueDepthWindow, summarize_queue_depth
+from dd_passenger_api import PassengerApiException
+from dd_snapshot_ring import read_snapshots
+from dd_subprocess import CommandResult
+from tests.test_samples.pool_status_samples import TEST_POOL_XML
 from tests.test_samples.queue_requests_samples import TEST_REQUESTS
 
 
@@ -11,84 +20,434 @@ class TestPassengerQueueCheck(TestCase):
     def setUp(self):
         super().setUp()
 
-        self.patch_logging = patch('dd_check_passenger_queue.logging').start()
+        self.patch_logging = patch('dd_logging.get_logger').start()
         self.passenger_queue_check = PassengerQueueCheck()
+        self.passenger_queue_check.use_api = False
+        self.runner = self.passenger_queue_check.runner = MagicMock()
+        self.snapshot_dir = tempfile.TemporaryDirectory()
+        self.passenger_queue_check.snapshot_file = os.path.join(self.snapshot_dir.name, 'snapshots.ring')
+        self.passenger_queue_check.snapshot_file_size = 64 * 1024
 
     def tearDown(self):
         super().tearDown()
         patch.stopall()
+        self.passenger_queue_check.cancel()
+        self.snapshot_dir.cleanup()
 
-    def test_get_queue_size_successfully(self):
+    def test_get_pool_status_successfully(self):
         # given
-        expected_result = 25
+        expected_queue_size = 20
+
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0], b'', 0, 0.1, False, False)
 
         # when
-        with patch.object(self.passenger_queue_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.return_value = (b'25\n', None)
-            result = self.passenger_queue_check.get_queue_size()
+        result = self.passenger_queue_check.get_pool_status()
 
         # then
-        self.assertEqual(result, expected_result)
-        mock_exec_cmd().communicate.assert_called_once()
+        self.assertEqual(result['queue_size'], expected_queue_size)
+        self.assertEqual(result['top_level_queue_size'], 2)
+        self.assertEqual(result['process_count'], 3)
+        self.assertEqual([(group['name'], group['queue_size']) for group in result['groups']],
+                         [('/var/www/shop (production)', 15), ('/var/www/api (production)', 3)])
+        self.assertEqual(result['groups'][1]['processes'],
+                         [{'pid': 2485100, 'sessions': 0, 'processed': 912, 'busyness': 0, 'concurrency': 1}])
+        self.runner.run.assert_called_once_with('sudo passenger-status --show=xml', timeout=30)
 
-    def test_get_queue_size_unsuccessfully_caused_exception(self):
+    def test_get_pool_status_unsuccessfully_caused_exception(self):
         # given
         test_exception_err = 'test exception'
 
+        self.runner.run.side_effect = Exception(test_exception_err)
+
+        # when
+        with self.assertRaises(GetPoolStatusException):
+            self.passenger_queue_check.get_pool_status()
+
+        # then
+        self.runner.run.assert_called_once()
+
+    def test_get_pool_status_unsuccessfully_caused_invalid_xml(self):
+        # given
+        self.runner.run.return_value = CommandResult(b'ERROR: Phusion Passenger is not running\n', b'', 1, 0.1,
+                                                     False, False)
+
+        # when / then
+        with self.assertRaises(GetPoolStatusException):
+            self.passenger_queue_check.get_pool_status()
+
+    def test_get_pool_status_unsuccessfully_caused_timeout(self):
+        # given
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0][:100], b'Timed out after 30s', -9, 30.0,
+                                                     True, False)
+
+        # when / then
+        with self.assertRaises(GetPoolStatusException):
+            self.passenger_queue_check.get_pool_status()
+
+    def test_get_pool_status_successfully_through_api(self):
+        # given
+        self.passenger_queue_check.use_api = True
+        self.passenger_queue_check.api_client = MagicMock()
+        self.passenger_queue_check.api_client.get_pool_xml.return_value = TEST_POOL_XML[0]
+
+        # when
+        result = self.passenger_queue_check.get_pool_status()
+
+        # then
+        self.assertEqual(result['queue_size'], 20)
+        self.runner.run.assert_not_called()
+
+    def test_get_pool_status_falls_back_to_cli_caused_api_exception(self):
+        # given
+        self.passenger_queue_check.use_api = True
+        self.passenger_queue_check.api_client = MagicMock()
+        self.passenger_queue_check.api_client.get_pool_xml.side_effect = PassengerApiException('timeout')
+
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0], b'', 0, 0.1, False, False)
+
+        # when
+        result = self.passenger_queue_check.get_pool_status()
+
+        # then
+        self.assertEqual(result['queue_size'], 20)
+        self.assertIsNone(self.passenger_queue_check.api_client)
+        self.runner.run.assert_called_once()
+
+    def test_queue_depth_window_keeps_last_samples(self):
+        # given
+        window = QueueDepthWindow(4)
+
+        # when
+        for second in range(1, 7):
+            window.add(second, second * 10)
+
+        # then
+        self.assertEqual(window.since(0), [(3, 30), (4, 40), (5, 50), (6, 60)])
+        self.assertEqual(window.since(4), [(4, 40), (5, 50), (6, 60)])
+        self.assertEqual(window.since(6), [(6, 60)])
+
+    def test_summarize_queue_depth(self):
+        # given
+        samples = [(0, 10)] + [(second, depth) for second, depth in
+                               enumerate([20, 900, 40, 0, 10, 10, 30, 20, 10, 0], start=1)]
+
+        # when
+        summary = summarize_queue_depth(samples, since=0)
+
+        # then
+        self.assertEqual(summary, {'count': 10, 'max': 900, 'p50': 10, 'p95': 900, 'p99': 900,
+                                   'enqueue_rate': 92.0, 'drain_rate': 93.0})
+        self.assertIsNone(summarize_queue_depth(samples[-1:], since=10))
+
+    def test_sample_queue_depth_from_passenger_status(self):
+        # given
+        self.passenger_queue_check.queue_window = QueueDepthWindow(10)
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0], b'', 0, 0.1, False, False)
+
+        # when
+        self.passenger_queue_check.sample_queue_depth()
+        self.passenger_queue_check.sample_queue_depth()
+
+        # then
+        self.assertEqual([depth for timestamp, depth in self.passenger_queue_check.queue_window.since(0)], [20])
+        self.assertEqual(parse_queue_size(TEST_POOL_XML[0]), 20)
+        self.runner.run.assert_called_once_with('sudo passenger-status --show=xml', timeout=30)
+
+    def test_sample_queue_depth_rediscovers_api_client_caused_api_exception(self):
+        # given
+        self.passenger_queue_check.use_api = True
+        self.passenger_queue_check.queue_window = QueueDepthWindow(10)
+        stale_client = self.passenger_queue_check.sampler_client = MagicMock()
+        stale_client.get_pool_xml.side_effect = PassengerApiException('connection refused')
+        new_client = MagicMock()
+        new_client.get_pool_xml.return_value = TEST_POOL_XML[0]
+
+        # when
+        with patch('dd_check_passenger_queue.PassengerApiClient', return_value=new_client) as mock_client:
+            with self.assertRaises(PassengerApiException):
+                self.passenger_queue_check.sample_queue_depth()
+            self.passenger_queue_check.sample_queue_depth()
+
+        # then
+        stale_client.close.assert_called_once()
+        mock_client.assert_called_once_with(instance_dir=None)
+        self.assertIs(self.passenger_queue_check.sampler_client, new_client)
+        self.assertEqual([depth for timestamp, depth in self.passenger_queue_check.queue_window.since(0)], [20])
+        self.runner.run.assert_not_called()
+
+    def test_collect_stops_sampler_caused_queue_sampling_turned_off(self):
+        # given
+        sampler = self.passenger_queue_check.sampler = MagicMock(error=None)
+        sampler_client = self.passenger_queue_check.sampler_client = MagicMock()
+        self.passenger_queue_check.queue_window = QueueDepthWindow(10)
+        self.passenger_queue_check.queue_sampling = False
+
+        # when
+        with patch.object(self.passenger_queue_check, 'fetch', return_value=(
+                {'queue_size': 15, 'process_count': 6, 'capacity_used': 6, 'groups': []}, None, None)):
+            self.passenger_queue_check.collect()
+
+        # then
+        sampler.stop.assert_called_once()
+        sampler_client.close.assert_called_once()
+        self.assertIsNone(self.passenger_queue_check.sampler)
+        self.assertIsNone(self.passenger_queue_check.sampler_client)
+
+    def test_collect_reports_sampled_queue_depth_once(self):
+        # given
+        self.passenger_queue_check.queue_sampling = True
+        self.passenger_queue_check.sampler = MagicMock(error=None)
+        window = self.passenger_queue_check.queue_window = QueueDepthWindow(10)
+        self.passenger_queue_check.sampled_until = 100
+        for timestamp, depth in [(100, 5), (101, 50), (102, 15)]:
+            window.add(timestamp, depth)
+
+        # when
+        with patch.object(self.passenger_queue_check, 'fetch', return_value=(
+                {'queue_size': 15, 'process_count': 6, 'capacity_used': 6, 'groups': []}, None, None)), \
+                patch.object(self.passenger_queue_check, 'gauge') as mock_gauge:
+            self.passenger_queue_check.collect()
+            self.passenger_queue_check.collect()
+
+        # then
+        sampled = {args[0]: args[1] for args, kwargs in mock_gauge.call_args_list
+                   if args[0].startswith('dd.check_passenger_queue.requests.sampled.')}
+        self.assertEqual(sampled, {
+            'dd.check_passenger_queue.requests.sampled.count': 2,
+            'dd.check_passenger_queue.requests.sampled.max': 50,
+            'dd.check_passenger_queue.requests.sampled.p50': 15,
+            'dd.check_passenger_queue.requests.sampled.p95': 50,
+            'dd.check_passenger_queue.requests.sampled.p99': 50,
+            'dd.check_passenger_queue.requests.sampled.enqueue_rate': 22.5,
+            'dd.check_passenger_queue.requests.sampled.drain_rate': 17.5,
+        })
+        self.assertEqual(sum(1 for args, kwargs in mock_gauge.call_args_list
+                             if args[0] == 'dd.check_passenger_queue.requests.sampled.max'), 1)
+
+    def test_get_instance_config_successfully(self):
+        # given
+        instance = {'passenger_instance_dir': '/var/run/passenger-instreg/passenger.abc'}
+
         # when
-        with self.assertRaises(GetQueueSizeException):
-            with patch.object(self.passenger_queue_check, '_exec_command') as mock_exec_cmd:
-                mock_exec_cmd().communicate.side_effect = Exception(test_exception_err)
-                self.passenger_queue_check.get_queue_size()
+        result = self.passenger_queue_check.get_instance_config(instance)
 
         # then
-        mock_exec_cmd().communicate.assert_called_once()
+        self.assertEqual(result, {'requests_metrics': True, 'passenger_api': True,
+                                  'passenger_instance_dir': '/var/run/passenger-instreg/passenger.abc',
+                                  'log_level': 'DEBUG', 'command_timeout': 30, 'background_collection': False,
+                                  'collection_interval': 60, 'max_snapshot_age': 300, 'instrumentation': False,
+                                  'snapshot_threshold': 800,
+                                  'snapshot_file': '/var/log/passenger/passenger-queue-snapshots.ring',
+                                  'snapshot_file_size': 16 * 1024 * 1024, 'snapshot_interval': 60,
+                                  'queue_sampling': False, 'sample_interval': 1, 'sample_window': 300})
 
     def test_get_requests_details_successfully(self):
         # given
-        queue_req_sample = TEST_REQUESTS
-        expected_result = json.loads(TEST_REQUESTS[0])
+        expected_result = [
+            {'thread': 'thread1', 'active_client_count': 0, 'total_clients_accepted': 6325,
+             'client_accept_speed': 1.0},
+            {'thread': 'thread2', 'active_client_count': 0, 'total_clients_accepted': 6324,
+             'client_accept_speed': 0.07},
+        ]
+
+        self.runner.stream.return_value.__enter__.return_value = io.BytesIO(TEST_REQUESTS[0])
 
         # when
-        with patch.object(self.passenger_queue_check, '_exec_command') as mock_exec_cmd:
-            mock_exec_cmd().communicate.return_value = queue_req_sample
-            result = self.passenger_queue_check.get_requests_details()
+        result = self.passenger_queue_check.get_requests_details()
 
         # then
         self.assertEqual(expected_result, result)
-        mock_exec_cmd().communicate.assert_called_once()
+        self.runner.stream.assert_called_once_with('sudo passenger-status --show=requests --no-header', timeout=30)
+        self.runner.stream.return_value.__exit__.assert_called_once()
 
     def test_get_requests_details_unsuccessfully_caused_exception(self):
         # given
         test_exception_err = 'test exception'
 
+        stdout = self.runner.stream.return_value.__enter__.return_value
+        stdout.read.side_effect = Exception(test_exception_err)
+
         # when
         with self.assertRaises(GetRequestsException):
-            with patch.object(self.passenger_queue_check, '_exec_command') as mock_exec_cmd:
-                mock_exec_cmd().communicate.side_effect = Exception(test_exception_err)
-                self.passenger_queue_check.get_requests_details()
+            self.passenger_queue_check.get_requests_details()
+
+        # then
+        stdout.read.assert_called_once()
+
+    def test_get_requests_details_unsuccessfully_caused_truncated_output(self):
+        # given
+        self.runner.stream.return_value.__enter__.return_value = io.BytesIO(TEST_REQUESTS[0][:-100])
+
+        # when / then
+        with self.assertRaises(GetRequestsException):
+            self.passenger_queue_check.get_requests_details()
+
+    def test_stream_requests_summary_with_small_chunks_matches_full_parse(self):
+        # given
+        dump = {
+            'thread1': {
+                'active_client_count': 2,
+                'active_clients': {
+                    f'1-{client}': {'requests': [{'path': '/x' * 50, 'started_at': 1612345678.25 + client,
+                                                  'flags': [True, False, None]}]}
+                    for client in range(2)},
+                'client_accept_speed': {'1m': {'value': 12345.5}},
+                'total_clients_accepted': 987654321,
+            },
+            'thread2': {'active_client_count': 0, 'active_clients': {}, 'total_clients_accepted': 7,
+                        'client_accept_speed': {'1m': {'value': 0.5}}},
+            'threads': 2,
+        }
+        data = json.dumps(dump, indent=3).encode()
+
+        # when
+        results = [stream_requests_summary(io.BytesIO(data), chunk_size=chunk_size) for chunk_size in (1, 7, 4096)]
 
         # then
-        mock_exec_cmd().communicate.assert_called_once()
+        for result in results:
+            self.assertEqual(result, [
+                {'thread': 'thread1', 'active_client_count': 2, 'total_clients_accepted': 987654321,
+                 'client_accept_speed': 12345.5},
+                {'thread': 'thread2', 'active_client_count': 0, 'total_clients_accepted': 7,
+                 'client_accept_speed': 0.5},
+            ])
 
     def test_collect_data_successfully_with_queue_above_crit_threshold(self):
-        # given / when
-        with patch.object(self.passenger_queue_check, 'get_queue_size', return_value=900) as mock_queue_size:
-            with patch.object(self.passenger_queue_check, 'get_requests_details') as mock_requests_details:
-                self.passenger_queue_check.collect()
+        # given
+        self.passenger_queue_check.requests_metrics = False
+        threads = [{'thread': 'thread1', 'active_client_count': 64, 'total_clients_accepted': 6325,
+                    'client_accept_speed': 1.0}]
+
+        # when
+        with patch.object(self.passenger_queue_check, 'get_pool_status',
+                          return_value={'queue_size': 900, 'process_count': 6, 'capacity_used': 6,
+                                        'groups': []}) as mock_pool, \
+                patch.object(self.passenger_queue_check, 'get_requests_details',
+                             return_value=threads) as mock_requests_details, \
+                patch.object(self.passenger_queue_check, 'gauge') as mock_gauge:
+            self.passenger_queue_check.collect()
+            self.passenger_queue_check.collect()
+
+        # then
+        snapshots = read_snapshots(self.passenger_queue_check.snapshot_file)
+        self.assertEqual([snapshot.data for snapshot in snapshots],
+                         [{'queue_size': 900, 'process_count': 6, 'capacity_used': 6, 'groups': [],
+                           'threads': threads, 'dump_truncated': False}])
+        self.assertEqual(mock_pool.call_count, 2)
+        self.assertEqual(mock_requests_details.call_count, 2)
+        mock_gauge.assert_any_call('dd.check_passenger_queue.requests.count', 900)
+        recorded = [args[1] for args, kwargs in mock_gauge.call_args_list
+                    if args[0] == 'dd.check_passenger_queue.urgent_snapshot.recorded']
+        self.assertEqual(recorded, [1, 0])
+
+    def test_collect_records_request_dump_caused_queue_above_crit_threshold(self):
+        # given
+        self.passenger_queue_check.requests_metrics = False
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0], b'', 0, 0.1, False, False)
+        self.runner.stream.return_value.__enter__.return_value = io.BytesIO(TEST_REQUESTS[0])
+        self.passenger_queue_check.snapshot_threshold = 10
+
+        # when
+        with patch.object(self.passenger_queue_check, 'gauge'):
+            self.passenger_queue_check.collect()
 
         # then
-        self.assertEqual(self.passenger_queue_check.log.debug.call_count, 2)
-        mock_queue_size.assert_called_once()
-        mock_requests_details.assert_called_once()
+        snapshots = read_snapshots(self.passenger_queue_check.snapshot_file)
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(snapshots[0].dump, TEST_REQUESTS[0])
+        self.assertFalse(snapshots[0].data['dump_truncated'])
+        self.assertEqual([thread['thread'] for thread in snapshots[0].data['threads']], ['thread1', 'thread2'])
+
+    def test_collect_skips_request_dump_caused_snapshot_not_due(self):
+        # given
+        self.passenger_queue_check.requests_metrics = False
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0], b'', 0, 0.1, False, False)
+        self.passenger_queue_check.snapshot_threshold = 10
+        self.passenger_queue_check._get_recorder().last_recorded = time.monotonic()
+
+        # when
+        with patch.object(self.passenger_queue_check, 'get_requests_details', return_value=[]) as mock_details, \
+                patch.object(self.passenger_queue_check, 'gauge'):
+            self.passenger_queue_check.collect()
+
+        # then
+        mock_details.assert_called_once_with(dump=None)
+
+    def test_collect_reports_metrics_caused_snapshot_file_not_writable(self):
+        # given
+        self.passenger_queue_check.snapshot_file = os.path.join(self.snapshot_dir.name, 'missing', 'snapshots.ring')
+
+        # when
+        with patch.object(self.passenger_queue_check, 'get_pool_status',
+                          return_value={'queue_size': 900, 'process_count': 6, 'capacity_used': 6,
+                                        'groups': []}), \
+                patch.object(self.passenger_queue_check, 'get_requests_details', return_value=[]), \
+                patch.object(self.passenger_queue_check, 'gauge') as mock_gauge:
+            self.passenger_queue_check.collect()
+
+        # then
+        self.passenger_queue_check.log.warning.assert_called_once()
+        mock_gauge.assert_any_call('dd.check_passenger_queue.requests.count', 900)
 
     def test_collect_data_successfully_without_log_caused_normal_queue_size(self):
-        # given / when
-        with patch.object(self.passenger_queue_check, 'get_queue_size', return_value=100) as mock_queue_size:
-            with patch.object(self.passenger_queue_check, 'get_requests_details') as mock_requests_details:
-                self.passenger_queue_check.collect()
+        # given
+        self.passenger_queue_check.requests_metrics = False
+
+        # when
+        with patch.object(self.passenger_queue_check, 'get_pool_status',
+                          return_value={'queue_size': 100, 'process_count': 6, 'capacity_used': 4,
+                                        'groups': []}) as mock_pool, \
+                patch.object(self.passenger_queue_check, 'get_requests_details') as mock_requests_details, \
+                patch.object(self.passenger_queue_check, 'gauge') as mock_gauge:
+            self.passenger_queue_check.collect()
 
         # then
         self.assertEqual(self.passenger_queue_check.log.debug.call_count, 0)
-        mock_queue_size.assert_called_once()
-        mock_requests_details.assert_called_once()
+        mock_pool.assert_called_once()
+        mock_requests_details.assert_not_called()
+        mock_gauge.assert_any_call('dd.check_passenger_queue.processes.count', 6)
+
+    def test_collect_reports_background_snapshot_only_while_fresh(self):
+        # given
+        self.passenger_queue_check.background_collection = True
+        self.passenger_queue_check.max_snapshot_age = 120
+        background = self.passenger_queue_check.background = MagicMock()
+        pool_status = {'queue_size': 7, 'process_count': 2, 'capacity_used': 2, 'groups': []}
+        background.current.side_effect = [(pool_status, None, None), None]
+
+        # when
+        with patch.object(self.passenger_queue_check, 'get_pool_status') as mock_pool, \
+                patch.object(self.passenger_queue_check, 'gauge') as mock_gauge:
+            self.passenger_queue_check.collect()
+            self.passenger_queue_check.collect()
+
+        # then
+        mock_pool.assert_not_called()
+        background.current.assert_called_with(self.passenger_queue_check, 'dd.check_passenger_queue', max_age=120)
+        mock_gauge.assert_any_call('dd.check_passenger_queue.requests.count', 7)
+        self.assertEqual(mock_gauge.call_count, 3)
+
+    def test_collect_data_successfully_with_tagged_metrics(self):
+        # given
+        shop_tags = ['app_group:/var/www/shop (production)']
+
+        self.runner.run.return_value = CommandResult(TEST_POOL_XML[0], b'', 0, 0.1, False, False)
+        self.runner.stream.return_value.__enter__.return_value = io.BytesIO(TEST_REQUESTS[0])
+
+        # when
+        with patch.object(self.passenger_queue_check, 'gauge') as mock_gauge:
+            self.passenger_queue_check.collect()
+
+        # then
+        mock_gauge.assert_any_call('dd.check_passenger_queue.requests.count', 20)
+        mock_gauge.assert_any_call('dd.check_passenger_queue.app_group.requests.count', 15, tags=shop_tags)
+        mock_gauge.assert_any_call('dd.check_passenger_queue.app_group.processes.count', 2, tags=shop_tags)
+        mock_gauge.assert_any_call('dd.check_passenger_queue.process.processed', 6325,
+                                   tags=shop_tags + ['pid:2484960'])
+        mock_gauge.assert_any_call('dd.check_passenger_queue.process.busyness', 2147483647,
+                                   tags=shop_tags + ['pid:2484960'])
+        mock_gauge.assert_any_call('dd.check_passenger_queue.thread.client_accept_speed', 0.07,
+                                   tags=['thread:thread2'])
+        mock_gauge.assert_any_call('dd.check_passenger_queue.thread.clients_accepted.count', 6325,
+                                   tags=['thread:thread1'])
+        self.runner.flush_metrics.assert_called_once_with(self.passenger_queue_check, 'dd.check_passenger_queue')
@@ -0,0 +1,106 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, call, patch
+
+import dd_logging
+from dd_instrumentation import NO_PHASE, Instrumentation, PhaseSample, instrumented, phase, timed
+from dd_subprocess import CommandRunner
+
+
+class Check:
+    log_level = 'INFO'
+    instrumentation_enabled = False
+    instrumentation = None
+    runner = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.histogram = MagicMock()
+        self.runner = CommandRunner(timeout=5)
+
+    def _get_runner(self):
+        return self.runner
+
+    @timed
+    def get_status(self):
+        return self.runner.run('echo ready').stdout
+
+    def collect(self):
+        self.log.debug('hidden')
+        self.log.info('shown')
+        with phase(self, 'parse'):
+            status = self.get_status()
+        return status
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        dd_logging.stop()
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.log_dir.name, 'check.log')
+        self.check = Check(self.filename)
+        self.run = instrumented(self.filename, 'dd.check')(Check.collect)
+
+    def tearDown(self):
+        super().tearDown()
+        dd_logging.stop()
+        self.log_dir.cleanup()
+
+    def test_instrumented_logs_at_log_level_of_check(self):
+        # when
+        result = self.run(self.check)
+        dd_logging.stop()
+
+        # then
+        self.assertEqual(result, b'ready\n')
+        with open(self.filename, 'r') as fh:
+            self.assertEqual([line.split(' - ')[1] for line in fh.read().splitlines()], ['INFO: shown'])
+
+    def test_instrumented_records_nothing_caused_disabled(self):
+        # when
+        self.run(self.check)
+
+        # then
+        self.assertIsNone(self.check.instrumentation)
+        self.assertIs(phase(self.check, 'parse'), NO_PHASE)
+        self.check.histogram.assert_not_called()
+
+    def test_instrumented_reports_phases_when_enabled(self):
+        # given
+        self.check.instrumentation_enabled = True
+
+        # when
+        with patch('dd_instrumentation.get_rss', side_effect=[100, 200, 300, 300, 1000, 1500]):
+            self.run(self.check)
+
+        # then
+        reported = {(args[0], kwargs['tags'][0]): args[1] for args, kwargs in self.check.histogram.call_args_list}
+        for name in ('run', 'parse', 'get_status'):
+            self.assertGreater(reported[('dd.check.phase.duration', f'phase:{name}')], 0)
+            self.assertEqual(reported[('dd.check.phase.subprocesses', f'phase:{name}')], 1)
+            self.assertEqual(reported[('dd.check.phase.bytes_read', f'phase:{name}')], len(b'ready\n'))
+        self.assertEqual(reported[('dd.check.phase.rss_delta', 'phase:get_status')], 0)
+        self.assertEqual(reported[('dd.check.phase.rss_delta', 'phase:parse')], 800)
+        self.assertEqual(reported[('dd.check.phase.rss_delta', 'phase:run')], 1400)
+        self.assertEqual(self.check.instrumentation.samples, [])
+
+    def test_flush_metrics_reports_samples_once(self):
+        # given
+        check = MagicMock()
+        instrumentation = Instrumentation()
+        instrumentation.add(PhaseSample('detach_process', 0.5, 2, 30, 4096))
+
+        # when
+        instrumentation.flush_metrics(check, 'dd.check')
+        instrumentation.flush_metrics(check, 'dd.check')
+
+        # then
+        tags = ['phase:detach_process']
+        check.histogram.assert_has_calls([call('dd.check.phase.duration', 0.5, tags=tags),
+                                          call('dd.check.phase.subprocesses', 2, tags=tags),
+                                          call('dd.check.phase.bytes_read', 30, tags=tags),
+                                          call('dd.check.phase.rss_delta', 4096, tags=tags)])
+        self.assertEqual(check.histogram.call_count, 4)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import dd_logging
+from dd_logging import get_logger
+
+
+class TestLogging(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        dd_logging.stop()
+        self.log_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        dd_logging.stop()
+        self.log_dir.cleanup()
+
+    def read_log(self, name):
+        with open(os.path.join(self.log_dir.name, name), 'r') as fh:
+            return fh.read().splitlines()
+
+    def test_get_logger_writes_each_logger_to_its_own_file_through_one_listener(self):
+        # given
+        first = get_logger('test_logging.first', os.path.join(self.log_dir.name, 'first.log'))
+        second = get_logger('test_logging.second', os.path.join(self.log_dir.name, 'second.log'), level='INFO')
+
+        # when
+        for _ in range(3):
+            first = get_logger('test_logging.first', os.path.join(self.log_dir.name, 'first.log'))
+            first.debug('first debug')
+        second.debug('second debug')
+        second.warning('second warning')
+        listener = dd_logging._listener
+        dd_logging.stop()
+
+        # then
+        self.assertEqual(len(listener.handlers), 2)
+        self.assertEqual(first.handlers.count(dd_logging._queue_handler), 1)
+        self.assertEqual([line.split(' - ')[1] for line in self.read_log('first.log')], ['DEBUG: first debug'] * 3)
+        self.assertEqual([line.split(' - ')[1] for line in self.read_log('second.log')],
+                         ['WARNING: second warning'])
@@ -0,0 +1,140 @@
+import base64
+import json
+import os
+import socketserver
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+from unittest import TestCase
+from unittest.mock import patch
+
+from dd_passenger_api import PassengerApiClient, PassengerApiException, find_instance_dir
+from tests.test_samples.pool_status_samples import TEST_POOL_XML
+from tests.test_samples.queue_requests_samples import TEST_REQUESTS
+
+RO_PASSWORD = 'ro-secret'
+ADMIN_PASSWORD = 'admin-secret'
+
+
+class FakeCoreApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'core_api'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _authorized(self, username, password):
+        expected = 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()
+        return self.headers.get('Authorization') == expected
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not (self._authorized('ro_admin', RO_PASSWORD) or self._authorized('admin', ADMIN_PASSWORD)):
+            return self._reply(401)
+        bodies = {'/pool.xml': TEST_POOL_XML[0], '/server.json': TEST_REQUESTS[0]}
+        if self.path not in bodies:
+            return self._reply(404)
+        self._reply(200, bodies[self.path])
+
+    def do_POST(self):
+        if not self._authorized('admin', ADMIN_PASSWORD):
+            return self._reply(401)
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self._reply(200, json.dumps({'detached': body['pid'] == '2484960'}).encode())
+
+
+class FakeCoreApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TestPassengerApiClient(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.registry_dir = tempfile.TemporaryDirectory()
+        self.instance_dir = os.path.join(self.registry_dir.name, 'passenger.1a2b3c')
+        os.makedirs(os.path.join(self.instance_dir, 'agents.s'))
+        for file_name, password in (('read_only_admin_password.txt', RO_PASSWORD),
+                                    ('full_admin_password.txt', ADMIN_PASSWORD)):
+            with open(os.path.join(self.instance_dir, file_name), 'w') as fh:
+                fh.write(password + '\n')
+
+        self.server = FakeCoreApiServer(os.path.join(self.instance_dir, 'agents.s', 'core_api'), FakeCoreApiHandler)
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+
+        self.client = PassengerApiClient(registry_dirs=(self.registry_dir.name,))
+
+    def tearDown(self):
+        super().tearDown()
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.registry_dir.cleanup()
+
+    def test_find_instance_dir_successfully(self):
+        # when
+        result = find_instance_dir(registry_dirs=(self.registry_dir.name,))
+
+        # then
+        self.assertEqual(result, self.instance_dir)
+
+    def test_find_instance_dir_unsuccessfully_caused_no_instance(self):
+        # when / then
+        with tempfile.TemporaryDirectory() as empty_dir:
+            with self.assertRaises(PassengerApiException):
+                find_instance_dir(registry_dirs=(empty_dir,))
+
+    def test_get_pool_xml_successfully(self):
+        # when
+        pool_xml = self.client.get_pool_xml()
+
+        # then
+        self.assertEqual(pool_xml, TEST_POOL_XML[0])
+
+    def test_stream_server_json_successfully(self):
+        # when
+        with self.client.stream_server_json() as stream:
+            result = stream.read()
+
+        # then
+        self.assertEqual(result, TEST_REQUESTS[0])
+
+    def test_detach_process_successfully(self):
+        # when / then
+        self.assertTrue(self.client.detach_process(2484960))
+        self.assertFalse(self.client.detach_process(1))
+
+    def test_detach_process_with_timeout(self):
+        # when
+        with patch.object(self.client.session, 'request', wraps=self.client.session.request) as mock_request:
+            self.client.detach_process(2484960, timeout=2.5)
+            self.client.detach_process(2484960)
+
+        # then
+        self.assertEqual([kwargs['timeout'] for args, kwargs in mock_request.call_args_list], [2.5, 5])
+
+    def test_request_unsuccessfully_caused_wrong_credentials(self):
+        # given
+        with open(os.path.join(self.instance_dir, 'read_only_admin_password.txt'), 'w') as fh:
+            fh.write('wrong')
+        client = PassengerApiClient(instance_dir=self.instance_dir)
+
+        # when / then
+        with self.assertRaises(PassengerApiException):
+            client.get_pool_xml()
+        client.close()
+
+    def test_request_unsuccessfully_caused_missing_credentials(self):
+        # given
+        os.remove(os.path.join(self.instance_dir, 'full_admin_password.txt'))
+
+        # when / then
+        with self.assertRaises(PassengerApiException):
+            self.client.detach_process(2484960)
@@ -0,0 +1,123 @@
+import os
+import re
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from dd_process_snapshot import PAGE_SIZE, SNAPSHOTS, SharedCache, get_process_snapshot, parse_stat, read_proc_file, \
+    scan_processes
+
+
+def make_process(proc_root, pid, cmdline=None, starttime=1000, rss_pages=10, fds=0):
+    pid_dir = os.path.join(proc_root, str(pid))
+    os.makedirs(os.path.join(pid_dir, 'fd'))
+    with open(os.path.join(pid_dir, 'stat'), 'w') as fh:
+        fh.write(f'{pid} (ruby) app) S 1 {pid} {pid} 0 -1 4194560' + ' 0' * 12 + f' {starttime} 0 {rss_pages}\n')
+    if cmdline is not None:
+        with open(os.path.join(pid_dir, 'cmdline'), 'wb') as fh:
+            fh.write(cmdline)
+    for fd in range(fds):
+        os.symlink('/dev/null', os.path.join(pid_dir, 'fd', str(fd)))
+
+
+class TestProcessSnapshot(TestCase):
+
+    def test_read_proc_file_reads_past_the_first_chunk(self):
+        # given
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'cmdline')
+            with open(path, 'wb') as fh:
+                fh.write(b'x' * 10)
+
+            # when
+            data = read_proc_file(path, size=4)
+
+        # then
+        self.assertEqual(data, b'x' * 10)
+
+    def test_parse_stat_with_parenthesis_in_command_name(self):
+        # when
+        starttime, rss = parse_stat(b'42 (a) b) S 1' + b' 0' * 17 + b' 5000 0 7 0 0\n')
+
+        # then
+        self.assertEqual((starttime, rss), (5000, 7 * PAGE_SIZE))
+
+    def test_scan_processes_fills_columns(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_process(proc_root, 100, b'Passenger RubyApp: /srv/app (production)\0', starttime=1000, fds=3)
+            make_process(proc_root, 200, starttime=2000, rss_pages=20)
+            os.makedirs(os.path.join(proc_root, '300'))
+            os.makedirs(os.path.join(proc_root, 'sys'))
+
+            # when
+            with patch('dd_process_snapshot.get_fd_count',
+                       side_effect=lambda fd_dir: len(os.listdir(fd_dir))) as mock_fd_count:
+                snapshot = scan_processes(proc_root, now=42)
+                fds_before_load = snapshot.fds
+                snapshot.load_fds()
+                snapshot.load_fds()
+
+        # then
+        rows = sorted(range(len(snapshot)), key=lambda row: snapshot.pids[row])
+        self.assertIsNone(fds_before_load)
+        self.assertEqual(mock_fd_count.call_count, 2)
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.taken_at, 42)
+        self.assertEqual([snapshot.pids[row] for row in rows], [100, 200])
+        self.assertEqual([snapshot.uids[row] for row in rows], [os.getuid()] * 2)
+        self.assertEqual([snapshot.starttimes[row] for row in rows], [1000, 2000])
+        self.assertEqual([snapshot.rss[row] for row in rows], [10 * PAGE_SIZE, 20 * PAGE_SIZE])
+        self.assertEqual([snapshot.fds[row] for row in rows], [3, 0])
+        self.assertEqual([snapshot.cmdlines[row] for row in rows], ['Passenger RubyApp: /srv/app (production) ', ''])
+        self.assertEqual([snapshot.pids[row] for row in snapshot.matching(re.compile(r'^Passenger \w+App: '))], [100])
+
+    def test_scan_processes_marks_unreadable_fd_directory(self):
+        # given
+        with tempfile.TemporaryDirectory() as proc_root:
+            make_process(proc_root, 100)
+
+            # when
+            with patch('dd_process_snapshot.get_fd_count', side_effect=PermissionError):
+                snapshot = scan_processes(proc_root)
+                snapshot.load_fds()
+
+        # then
+        self.assertEqual(snapshot.fds[0], -1)
+
+    def test_shared_cache_computes_again_after_max_age(self):
+        # given
+        cache = SharedCache()
+        compute = MagicMock(side_effect=lambda: object())
+
+        # when
+        first = cache.get('key', max_age=10, compute=compute, now=0)
+        shared = cache.get('key', max_age=10, compute=compute, now=9)
+        other_key = cache.get('other', max_age=10, compute=compute, now=9)
+        expired = cache.get('key', max_age=10, compute=compute, now=10)
+        uncached = cache.get('key', max_age=0, compute=compute, now=10)
+
+        # then
+        self.assertIs(first, shared)
+        self.assertIsNot(other_key, first)
+        self.assertIsNot(expired, first)
+        self.assertIsNot(uncached, expired)
+        self.assertEqual(compute.call_count, 4)
+
+    def test_get_process_snapshot_shares_walk_per_proc_root(self):
+        # given
+        SNAPSHOTS.clear()
+
+        # when
+        with tempfile.TemporaryDirectory() as proc_root, \
+                patch('dd_process_snapshot.scan_processes', wraps=scan_processes) as mock_scan:
+            first = get_process_snapshot(proc_root, max_age=10, now=0)
+            shared = get_process_snapshot(proc_root, max_age=10, now=9)
+            expired = get_process_snapshot(proc_root, max_age=10, now=10)
+        SNAPSHOTS.clear()
+
+        # then
+        self.assertIs(first, shared)
+        self.assertIsNot(expired, first)
+        self.assertEqual((first.taken_at, expired.taken_at), (0, 10))
+        self.assertEqual(mock_scan.call_count, 2)
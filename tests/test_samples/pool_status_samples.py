@@ -0,0 +1,91 @@
+TEST_POOL_XML = (
+    b'<?xml version="1.0" encoding="iso8859-1" ?>\n'
+    b'<info version="3">\n'
+    b'   <passenger_version>6.0.7</passenger_version>\n'
+    b'   <group_count>2</group_count>\n'
+    b'   <process_count>3</process_count>\n'
+    b'   <max>6</max>\n'
+    b'   <capacity_used>3</capacity_used>\n'
+    b'   <get_wait_list_size>2</get_wait_list_size>\n'
+    b'   <get_wait_list/>\n'
+    b'   <supergroups>\n'
+    b'      <supergroup>\n'
+    b'         <name>/var/www/shop (production)</name>\n'
+    b'         <state>READY</state>\n'
+    b'         <get_wait_list_size>15</get_wait_list_size>\n'
+    b'         <capacity_used>2</capacity_used>\n'
+    b'         <group default="true">\n'
+    b'            <name>/var/www/shop (production)</name>\n'
+    b'            <app_root>/var/www/shop</app_root>\n'
+    b'            <app_type>rack</app_type>\n'
+    b'            <environment>production</environment>\n'
+    b'            <enabled_process_count>2</enabled_process_count>\n'
+    b'            <capacity_used>2</capacity_used>\n'
+    b'            <get_wait_list_size>15</get_wait_list_size>\n'
+    b'            <processes_being_spawned>0</processes_being_spawned>\n'
+    b'            <life_status>ALIVE</life_status>\n'
+    b'            <processes>\n'
+    b'               <process>\n'
+    b'                  <pid>2484960</pid>\n'
+    b'                  <concurrency>1</concurrency>\n'
+    b'                  <sessions>1</sessions>\n'
+    b'                  <busyness>2147483647</busyness>\n'
+    b'                  <processed>6325</processed>\n'
+    b'                  <life_status>ALIVE</life_status>\n'
+    b'                  <enabled>ENABLED</enabled>\n'
+    b'                  <cpu>12</cpu>\n'
+    b'                  <rss>412340</rss>\n'
+    b'                  <real_memory>401220</real_memory>\n'
+    b'                  <command>Passenger RubyApp: /var/www/shop (production)</command>\n'
+    b'               </process>\n'
+    b'               <process>\n'
+    b'                  <pid>2484961</pid>\n'
+    b'                  <concurrency>1</concurrency>\n'
+    b'                  <sessions>1</sessions>\n'
+    b'                  <busyness>2147483647</busyness>\n'
+    b'                  <processed>6324</processed>\n'
+    b'                  <life_status>ALIVE</life_status>\n'
+    b'                  <enabled>ENABLED</enabled>\n'
+    b'                  <cpu>10</cpu>\n'
+    b'                  <rss>398004</rss>\n'
+    b'                  <real_memory>389120</real_memory>\n'
+    b'                  <command>Passenger RubyApp: /var/www/shop (production)</command>\n'
+    b'               </process>\n'
+    b'            </processes>\n'
+    b'         </group>\n'
+    b'      </supergroup>\n'
+    b'      <supergroup>\n'
+    b'         <name>/var/www/api (production)</name>\n'
+    b'         <state>READY</state>\n'
+    b'         <get_wait_list_size>3</get_wait_list_size>\n'
+    b'         <capacity_used>1</capacity_used>\n'
+    b'         <group default="true">\n'
+    b'            <name>/var/www/api (production)</name>\n'
+    b'            <app_root>/var/www/api</app_root>\n'
+    b'            <app_type>rack</app_type>\n'
+    b'            <environment>production</environment>\n'
+    b'            <enabled_process_count>1</enabled_process_count>\n'
+    b'            <capacity_used>1</capacity_used>\n'
+    b'            <get_wait_list_size>3</get_wait_list_size>\n'
+    b'            <processes_being_spawned>0</processes_being_spawned>\n'
+    b'            <life_status>ALIVE</life_status>\n'
+    b'            <processes>\n'
+    b'               <process>\n'
+    b'                  <pid>2485100</pid>\n'
+    b'                  <concurrency>1</concurrency>\n'
+    b'                  <sessions>0</sessions>\n'
+    b'                  <busyness>0</busyness>\n'
+    b'                  <processed>912</processed>\n'
+    b'                  <life_status>ALIVE</life_status>\n'
+    b'                  <enabled>ENABLED</enabled>\n'
+    b'                  <cpu>0</cpu>\n'
+    b'                  <rss>201020</rss>\n'
+    b'                  <real_memory>190440</real_memory>\n'
+    b'                  <command>Passenger RubyApp: /var/www/api (production)</command>\n'
+    b'               </process>\n'
+    b'            </processes>\n'
+    b'         </group>\n'
+    b'      </supergroup>\n'
+    b'   </supergroups>\n'
+    b'</info>\n',
+    None)
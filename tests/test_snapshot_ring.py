@@ -0,0 +1,167 @@
+import io
+import os
+import tempfile
+import zlib
+from unittest import TestCase
+
+from dd_snapshot_ring import HEADER_SIZE, RECORD, DumpCompressor, RingFile, RingFileException, Snapshot, \
+    SnapshotRecorder, read_snapshots, summarize
+
+
+class TestRingFile(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'snapshots.ring')
+
+    def tearDown(self):
+        super().tearDown()
+        self.dir.cleanup()
+
+    def test_append_keeps_newest_records_within_fixed_size(self):
+        # given
+        ring = RingFile(self.path, size=1000)
+        payloads = [bytes([i]) * (50 + i * 7 % 200) for i in range(100)]
+
+        # when
+        for i, payload in enumerate(payloads):
+            ring.append(payload, timestamp=i)
+        records = list(ring)
+        ring.close()
+
+        # then
+        self.assertEqual(os.path.getsize(self.path), HEADER_SIZE + 1000)
+        self.assertEqual(records[-1], (100, 99, payloads[-1]))
+        self.assertEqual([payload for seq, timestamp, payload in records], payloads[-len(records):])
+        self.assertEqual([seq for seq, timestamp, payload in records], list(range(101 - len(records), 101)))
+        self.assertLessEqual(sum(RECORD.size + len(payload) for seq, timestamp, payload in records), 1000)
+
+    def test_append_refuses_record_larger_than_ring(self):
+        # given
+        ring = RingFile(self.path, size=100)
+
+        # when
+        seq = ring.append(b'x' * 100)
+
+        # then
+        self.assertIsNone(seq)
+        self.assertEqual(list(ring), [])
+        ring.close()
+
+    def test_ring_is_shared_between_writers(self):
+        # given
+        first, second = RingFile(self.path, size=1000), RingFile(self.path, size=5000)
+
+        # when
+        first.append(b'first')
+        second.append(b'second')
+
+        # then
+        self.assertEqual(second.capacity, 1000)
+        self.assertEqual([payload for seq, timestamp, payload in first], [b'first', b'second'])
+        first.close()
+        second.close()
+
+    def test_iter_stops_caused_corrupted_record(self):
+        # given
+        ring = RingFile(self.path, size=1000)
+        ring.append(b'intact')
+        ring.append(b'damaged')
+        ring.mm[HEADER_SIZE + RECORD.size * 2 + len(b'intact')] ^= 0xFF
+
+        # when
+        records = list(ring)
+        ring.close()
+
+        # then
+        self.assertEqual([payload for seq, timestamp, payload in records], [b'intact'])
+
+    def test_open_fails_caused_not_a_ring_file(self):
+        # given
+        with open(self.path, 'wb') as fh:
+            fh.write(b'x' * 200)
+
+        # when / then
+        with self.assertRaises(RingFileException):
+            RingFile(self.path)
+
+
+class TestSnapshotRecorder(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'snapshots.ring')
+
+    def tearDown(self):
+        super().tearDown()
+        self.dir.cleanup()
+
+    def test_record_is_rate_limited_and_read_back(self):
+        # given
+        recorder = SnapshotRecorder(self.path, size=4096, min_interval=60)
+
+        # when
+        first = recorder.record({'queue_size': 900, 'threads': [{'thread': 'thread1'}] * 50}, now=0)
+        limited = recorder.record({'queue_size': 950}, now=30)
+        second = recorder.record({'queue_size': 1000}, now=60)
+        recorder.close()
+        snapshots = read_snapshots(self.path)
+
+        # then
+        self.assertEqual(first[0], 1)
+        self.assertLess(first[1], 100)
+        self.assertIsNone(limited)
+        self.assertEqual(second[0], 2)
+        self.assertEqual([snapshot.data['queue_size'] for snapshot in snapshots], [900, 1000])
+        self.assertEqual(summarize(snapshots[0]).split(' ')[2:], ['queue_size=900', 'threads[50]'])
+
+    def test_record_with_dump_and_read_back(self):
+        # given
+        recorder = SnapshotRecorder(self.path, size=64 * 1024, min_interval=0)
+        raw_dump = b''.join(b'{"client": %d, "state": "queued"}\n' % i for i in range(1000))
+        dump = DumpCompressor()
+        stream = dump.wrap(io.BytesIO(raw_dump))
+
+        # when
+        read = b''.join(iter(lambda: stream.read(100), b''))
+        recorder.record({'queue_size': 900}, now=0, dump=dump)
+        recorder.record({'queue_size': 950}, now=1)
+        recorder.close()
+        snapshots = read_snapshots(self.path)
+
+        # then
+        self.assertEqual(read, raw_dump)
+        self.assertLess(len(dump.getvalue()), len(raw_dump) / 4)
+        self.assertEqual([(snapshot.data, snapshot.dump) for snapshot in snapshots],
+                         [({'queue_size': 900}, raw_dump), ({'queue_size': 950}, None)])
+        self.assertTrue(summarize(snapshots[0]).endswith(f' queue_size=900 dump={len(raw_dump)}B'))
+
+    def test_dump_compressor_keeps_bounded_prefix(self):
+        # given
+        raw_dump = os.urandom(64 * 1024)
+        dump = DumpCompressor(max_size=1024)
+        stream = dump.wrap(io.BytesIO(raw_dump))
+
+        # when
+        read = b''.join(iter(lambda: stream.read(256), b''))
+        kept = zlib.decompress(dump.getvalue())
+
+        # then
+        self.assertEqual(read, raw_dump)
+        self.assertTrue(dump.truncated)
+        self.assertLessEqual(len(dump.getvalue()), 1024 + 16)
+        self.assertGreater(len(kept), 0)
+        self.assertTrue(raw_dump.startswith(kept))
+
+    def test_summarize_snapshot(self):
+        # given
+        snapshot = Snapshot(7, 0, {'queue_size': 900, 'groups': [{}, {}], 'threads': None})
+
+        # when
+        summary = summarize(snapshot)
+
+        # then
+        self.assertTrue(summary.startswith('#7 '))
+        self.assertTrue(summary.endswith(' queue_size=900 groups[2]'))
@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, call
+
+from dd_subprocess import CommandRunner, Execution, command_name
+
+
+class TestCommandRunner(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.runner = CommandRunner(timeout=5)
+
+    def assert_reaped(self):
+        # every child started by the runner has been waited for, so none is left as a zombie
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(-1, os.WNOHANG)
+
+    def test_run_pipeline_successfully(self):
+        # when
+        result = self.runner.run(['seq 10', 'grep 1', 'sort -r'])
+
+        # then
+        self.assertEqual(result.stdout, b'10\n1\n')
+        self.assertEqual(result.returncode, 0)
+        self.assertFalse(result.timed_out)
+        self.assertEqual([execution.name for execution in self.runner.executions], ['seq | grep | sort'])
+        self.assert_reaped()
+
+    def test_run_collects_stderr(self):
+        # when
+        result = self.runner.run('ls /nonexistent/dir')
+
+        # then
+        self.assertEqual(result.stdout, b'')
+        self.assertIn(b'/nonexistent/dir', result.stderr)
+        self.assertNotEqual(result.returncode, 0)
+
+    def test_run_kills_whole_pipeline_caused_timeout(self):
+        # when
+        start = time.monotonic()
+        result = self.runner.run(['sleep 10', 'cat', 'cat'], timeout=0.2)
+        elapsed = time.monotonic() - start
+
+        # then
+        self.assertLess(elapsed, 2)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.stderr, b'Timed out after 0.2s')
+        self.assertTrue(self.runner.executions[0].timed_out)
+        self.assert_reaped()
+
+    def test_run_returns_at_timeout_caused_grandchild_holding_pipe(self):
+        # when
+        start = time.monotonic()
+        result = self.runner.run("sh -c 'sleep 4; echo hi'", timeout=0.5)
+        elapsed = time.monotonic() - start
+
+        # then
+        self.assertLess(elapsed, 2)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.stdout, b'')
+        self.assert_reaped()
+
+    def test_run_caps_output(self):
+        # when
+        result = self.runner.run('yes', max_output=100000)
+
+        # then
+        self.assertEqual(len(result.stdout), 100000)
+        self.assertTrue(result.truncated)
+        self.assertFalse(result.timed_out)
+        self.assert_reaped()
+
+    def test_stream_successfully(self):
+        # when
+        with self.runner.stream(['seq 3', 'cat']) as stdout:
+            data = stdout.read()
+
+        # then
+        self.assertEqual(data, b'1\n2\n3\n')
+        self.assertFalse(self.runner.executions[0].timed_out)
+        self.assert_reaped()
+
+    def test_stream_hits_eof_caused_timeout(self):
+        # when
+        with self.runner.stream('sleep 10', timeout=0.2) as stdout:
+            data = stdout.read()
+
+        # then
+        self.assertEqual(data, b'')
+        self.assertTrue(self.runner.executions[0].timed_out)
+        self.assert_reaped()
+
+    def test_stream_hits_eof_caused_grandchild_holding_pipe(self):
+        # when
+        start = time.monotonic()
+        with self.runner.stream("sh -c 'echo first; sleep 4; echo second'", timeout=0.5) as stdout:
+            data = stdout.read()
+        elapsed = time.monotonic() - start
+
+        # then
+        self.assertLess(elapsed, 2)
+        self.assertEqual(data, b'first\n')
+        self.assertTrue(self.runner.executions[0].timed_out)
+
+    def test_counters_count_processes_and_pipe_bytes_per_thread(self):
+        # given
+        other = []
+
+        # when
+        self.runner.run(['seq 3', 'cat'])
+        with self.runner.stream('echo ok') as stdout:
+            stdout.read()
+        thread = threading.Thread(target=lambda: other.append(self.runner.run('echo other') and self.runner.counters()))
+        thread.start()
+        thread.join()
+
+        # then
+        self.assertEqual(self.runner.counters(), (3, len(b'1\n2\n3\n') + len(b'ok\n')))
+        self.assertEqual(other, [(1, len(b'other\n'))])
+
+    def test_flush_metrics_reports_executions_once(self):
+        # given
+        check = MagicMock()
+        self.runner.executions = [Execution('lsof', 0.5, False, False), Execution('lsof', 5.0, True, False),
+                                  Execution('kill', 0.1, False, False)]
+
+        # when
+        self.runner.flush_metrics(check, 'dd.check')
+        self.runner.flush_metrics(check, 'dd.check')
+
+        # then
+        check.histogram.assert_has_calls([call('dd.check.command.duration', 0.5, tags=['command:lsof']),
+                                          call('dd.check.command.duration', 5.0, tags=['command:lsof']),
+                                          call('dd.check.command.duration', 0.1, tags=['command:kill'])])
+        check.gauge.assert_has_calls([call('dd.check.command.count', 2, tags=['command:lsof']),
+                                      call('dd.check.command.timeouts.count', 1, tags=['command:lsof']),
+                                      call('dd.check.command.count', 1, tags=['command:kill']),
+                                      call('dd.check.command.timeouts.count', 0, tags=['command:kill'])])
+        self.assertEqual(check.histogram.call_count, 3)
+
+    def test_command_name(self):
+        # when / then
+        self.assertEqual(command_name('sudo lsof -w -F pun'), 'lsof')
+        self.assertEqual(command_name('sudo passenger-config detach-process 123'), 'passenger-config detach-process')
+        self.assertEqual(command_name('sudo kill -9 123'), 'kill')
+        self.assertEqual(command_name('/usr/bin/passenger-status --show=xml'), 'passenger-status')